@@ -11,8 +11,10 @@ import kalman
 from datetime import date
 import numpy as np
 from collections import OrderedDict
-from scipy.spatial.distance import cdist
+from itertools import groupby
 from functools import partial
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import re
 import dbio
 import logging
@@ -62,9 +64,85 @@ def observationDates(obsnames, dbname, startyear, startmonth, startday, endyear,
     return dates
 
 
-def assimilate(options, dt, models, method="letkf"):
-    """Assimilate multiple observations into the VIC model."""
+def _localizationRadius(vicoptions):
+    """Localization radius (in degrees) of the assimilation, if set."""
+    if 'localization' in vicoptions:
+        return float(vicoptions['localization'])
+    return None
+
+
+def _precision(vicoptions):
+    """Data type of the ensembles in the Kalman filter, single precision halving
+    their memory if requested."""
+    if 'precision' in vicoptions and vicoptions['precision'].strip().lower() == "single":
+        return 'float32'
+    return 'float64'
+
+
+def _observation(name, options):
+    """Create the observation object of dataset *name*, using the error distribution
+    set by the user if any."""
     log = logging.getLogger(__name__)
+    # dynamically load observation module
+    obsmod = __import__("datasets." + name, fromlist=[name])
+    obsobj = getattr(obsmod, name.capitalize())
+    obs = None
+    # check whether user has set uncertainty parameters for observation
+    if 'observations' in options and name in options['observations']:
+        sname = re.split(" |,", options['observations'][name])[0].lower()
+        try:
+            params = map(float, re.split(" |,", options['observations'][name])[1:])
+            smod = __import__("scipy.stats", fromlist=[sname])
+            sdist = getattr(smod, sname)
+        except:
+            log.warning("No distribution {0} available for dataset {1}, falling back to default.".format(sname, name))
+        else:
+            rvs = partial(sdist.rvs, *params)
+            obs = obsobj(rvs)
+    if obs is None:
+        obs = obsobj()
+    return obs
+
+
+class Observations(object):
+
+    def __init__(self, options, models, startdate, enddate):
+        """Retrieve the observations of all assimilated datasets between *startdate*
+        and *enddate* with a single query per dataset, so that each assimilation
+        cycle does not need to query the database or reload the dataset modules."""
+        self.obs = OrderedDict()
+        self.data = {}
+        db = dbio.connect(models.dbname)
+        cur = db.cursor()
+        for name in options['vic']['observations'].split(","):
+            name = name.lower().strip()
+            obs = _observation(name, options)
+            sql = "select fdate,st_x(geom),st_y(geom),val from (select fdate,(st_pixelascentroids(st_clip(rast,geom))).* from {0},{1}.basin where st_intersects(rast,geom) and fdate>=date '{2}' and fdate<=date '{3}') foo order by fdate".format(
+                obs.tablename, models.name, startdate.strftime("%Y-%m-%d"), enddate.strftime("%Y-%m-%d"))
+            cur.execute(sql)
+            self.obs[name] = obs
+            self.data[name] = {}
+            for dt, rows in groupby(cur.fetchall(), key=lambda r: r[0]):
+                _, lon, lat, data = zip(*rows)
+                self.data[name][dt] = (np.array(data).reshape((len(data), 1)), np.array(lat).reshape((len(lat), 1)), np.array(lon).reshape((len(lon), 1)))
+        cur.close()
+        db.close()
+
+    def get(self, name, dt):
+        """Return the observations of dataset *name* for date *dt*, like the *get*
+        method of the dataset."""
+        if dt in self.data[name]:
+            data, lat, lon = self.data[name][dt]
+            self.obs[name].nobs = len(data)
+        else:
+            data = lat = lon = None
+        return data, lat, lon
+
+
+def assimilate(options, dt, models, method="letkf", observations=None):
+    """Assimilate multiple observations into the VIC model. Observations are
+    retrieved from the database, unless they have been prefetched in
+    *observations*."""
     obsnames = options['vic']['observations'].split(",")
     X = OrderedDict()
     Xlat = OrderedDict()
@@ -76,24 +154,12 @@ def assimilate(options, dt, models, method="letkf"):
     Ylon = OrderedDict()
     for name in obsnames:
         name = name.lower().strip()
-        # dynamically load observation module and get data
-        obsmod = __import__("datasets." + name, fromlist=[name])
-        obsobj = getattr(obsmod, name.capitalize())
-        # check whether user has set uncertainty parameters for observation
-        if 'observations' in options and name in options['observations']:
-            try:
-                sname = re.split(" |,", options['observations']['name]'])[0].lower()
-                params = map(float, re.split(" |,", options['observations']['name]'])[1:])
-                smod = __import__("scipy.stats", fromlist=[sname])
-                sdist = getattr(smod, sname)
-            except:
-                log.warning("No distribution {0} available for dataset {1}, falling back to default.".format(sname, name))
-            else:
-                rvs = partial(sdist.rvs, *params)
-                obs = obsobj(rvs)
+        if observations is None:
+            obs = _observation(name, options)
+            data, lat, lon = obs.get(dt, models)
         else:
-            obs = obsobj()
-        data, lat, lon = obs.get(dt, models)
+            obs = observations.obs[name]
+            data, lat, lon = observations.get(name, dt)
         if data is not None:
             if obs.obsvar not in Y:
                 Y[obs.obsvar] = data
@@ -117,11 +183,22 @@ def assimilate(options, dt, models, method="letkf"):
         xlon = np.vstack((Xlon[k] for k in Xlon))
         ylat = np.vstack((Ylat[k] for k in Ylat))
         ylon = np.vstack((Ylon[k] for k in Ylon))
-        dists = cdist(np.vstack((xlat, xlon)).T, np.vstack((ylat, ylon)).T)
+        radius = _localizationRadius(options['vic'])
+        if radius is not None:
+            dists = kalman.neighbours(np.vstack((xlat, xlon)).T, np.vstack((ylat, ylon)).T, radius)
+        else:
+            dists = None
         kfobj = getattr(kalman, method.upper())
         E = obs.E(models.nens)
-        kf = kfobj(x, hx, y, E)
-        kf.analysis(dists)
+        # only the local analyses of the LETKF are distributed to a pool of threads
+        pool = ThreadPool(cpu_count()) if issubclass(kfobj, kalman.LETKF) else None
+        try:
+            kf = kfobj(x, hx, y, E, radius, pool, dtype=_precision(options['vic']))
+            kf.analysis(dists)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
         i = 0
         for k in X:
             for j in range(i, X[k].shape[0] + i):
@@ -14,9 +14,18 @@ import subprocess
 import random
 import psycopg2 as pg
 import string
+import hashlib
 import rpath
 import sys
 import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+_batch = None
+_PARTITIONED = "partitioned by year"
+# maximum length of PostgreSQL identifiers, longer names are truncated
+_MAXNAME = 63
 
 
 def connect(dbname):
@@ -69,6 +78,61 @@ def schemaExists(dbname, schemaname):
     return schema_exists
 
 
+def _createRasterIndexes(dbname, schemaname, tablename, analyze=False):
+    """Create the date and spatial indexes of raster table, and of its partitions
+    if it is partitioned, if they do not exist, and optionally update its planner
+    statistics."""
+    tables = [(schemaname, tablename)] + [("partitions", child) for child in partitions(dbname, schemaname, tablename)]
+    db = connect(dbname)
+    cur = db.cursor()
+    for sname, tname in tables:
+        cur.execute("select indexname from pg_indexes where schemaname='{0}' and tablename='{1}'".format(sname, tname))
+        indexes = [r[0] for r in cur.fetchall()]
+        if "{0}_dtidx".format(tname) not in indexes and "{0}_fdateidx".format(tname) not in indexes:
+            cur.execute("create index {1}_dtidx on {0}.{1}(fdate)".format(sname, tname))
+        if "{0}_spidx".format(tname) not in indexes:
+            cur.execute("create index {1}_spidx on {0}.{1} using gist(st_convexhull(rast))".format(sname, tname))
+    db.commit()
+    if analyze:
+        cur.execute("analyze {0}.{1}".format(schemaname, tablename))
+        db.commit()
+    cur.close()
+    db.close()
+
+
+def indexRasterTable(dbname, schemaname, tablename):
+    """Create the indexes of a raster table after it has been written, unless a write
+    batch is open in which case they are created at the end of the batch. Existing
+    indexes are left in place and maintained by the database."""
+    if _batch is not None:
+        _batch[(dbname, schemaname, tablename)] = True
+    else:
+        _createRasterIndexes(dbname, schemaname, tablename)
+
+
+@contextmanager
+def writeBatch():
+    """Context of a batch of raster table writes, whose index maintenance and planner
+    statistics are deferred until the end of the batch and done once per table.
+    Batches opened within a batch are part of the outermost one. If the batch fails,
+    its error is raised without maintaining the indexes, which is then done by the
+    next write to each table."""
+    global _batch
+    if _batch is not None:
+        yield
+        return
+    _batch = OrderedDict()
+    try:
+        yield
+    except:
+        _batch = None
+        raise
+    tables = list(_batch.keys())
+    _batch = None
+    for dbname, schemaname, tablename in tables:
+        _createRasterIndexes(dbname, schemaname, tablename, analyze=True)
+
+
 def writeGeotif(lat, lon, res, data, filename=None):
     """Writes Geotif in temporary directory so it can be imported into the PostGIS database."""
     if isinstance(data, np.ma.masked_array):
@@ -120,6 +184,22 @@ def deleteRasters(dbname, tablename, dt, squery=""):
     db.close()
 
 
+def deleteRasterRange(dbname, tablename, startdate, enddate, squery=""):
+    """Delete the rasters between *startdate* and *enddate* (inclusive) before
+    ingesting with a single statement, and optionally constrain with subquery."""
+    log = logging.getLogger(__name__)
+    db = connect(dbname)
+    cur = db.cursor()
+    cur.execute("delete from {0} where fdate>=date'{1}' and fdate<=date'{2}' {3}".format(
+        tablename, startdate.strftime("%Y-%m-%d"), enddate.strftime("%Y-%m-%d"), squery))
+    if cur.rowcount > 0:
+        log.warning("Overwriting rasters in {0} table for {1} to {2}".format(
+            tablename, startdate.strftime("%Y-%m-%d"), enddate.strftime("%Y-%m-%d")))
+    db.commit()
+    cur.close()
+    db.close()
+
+
 def _getResamplingMethod(dbname, tablename, res):
     """Return a raster resampling method based on the resolution of the model and the requested datasets."""
     db = connect(dbname)
@@ -154,7 +234,7 @@ def getResampledTables(dbname, options, res):
 
 
 def _createRasterTable(dbname, stname):
-    """Create table *stname* holding rasters in database *dbname*."""
+    """Create table *stname* holding rasters in database *dbname*, partitioned by year."""
     db = connect(dbname)
     cur = db.cursor()
     cur.execute(
@@ -162,6 +242,7 @@ def _createRasterTable(dbname, stname):
     db.commit()
     cur.close()
     db.close()
+    partitionTable(dbname, *stname.split("."))
 
 
 def _createDateIndex(dbname, schemaname, tablename):
@@ -174,6 +255,75 @@ def _createDateIndex(dbname, schemaname, tablename):
     db.close()
 
 
+def partitionTable(dbname, schemaname, tablename):
+    """Partition raster table by year. Its rasters are stored in child tables of the
+    partitions schema, which are created as rasters are ingested."""
+    db = connect(dbname)
+    cur = db.cursor()
+    if not schemaExists(dbname, "partitions"):
+        cur.execute("create schema partitions")
+    cur.execute("comment on table {0}.{1} is '{2}'".format(schemaname, tablename, _PARTITIONED))
+    db.commit()
+    cur.close()
+    db.close()
+
+
+def isPartitioned(dbname, schemaname, tablename):
+    """Check if raster table is partitioned by year."""
+    db = connect(dbname)
+    cur = db.cursor()
+    cur.execute("select obj_description('{0}.{1}'::regclass, 'pg_class')".format(schemaname, tablename))
+    partitioned = cur.fetchone()[0] == _PARTITIONED
+    cur.close()
+    db.close()
+    return partitioned
+
+
+def _partitionName(schemaname, tablename, year, columns):
+    """Name of the child table of a partitioned raster table holding *year*. If the
+    name or the names of its indexes would exceed the identifier length, the parent
+    table name is shortened and a hash of it is appended to keep it unique."""
+    name = "{0}_{1}_{2}".format(schemaname, tablename, year)
+    suffix = max(len("_{0}idx".format(column)) for column in list(columns) + ["dt", "sp"])
+    if len(name) + suffix > _MAXNAME:
+        digest = hashlib.md5("{0}.{1}".format(schemaname, tablename).encode("utf-8")).hexdigest()[:8]
+        prefix = "{0}_{1}".format(schemaname, tablename)[:_MAXNAME - suffix - len(digest) - len(str(year)) - 2]
+        name = "{0}_{1}_{2}".format(prefix, digest, year)
+    return name
+
+
+def partition(dbname, schemaname, tablename, year, columns=["fdate"]):
+    """Return the child table holding the rasters of *year* for a partitioned raster
+    table, creating it with indexes on *columns* if it does not exist. The date
+    constraint of each child table lets queries on the parent table that select dates
+    skip the years outside them (constraint exclusion). Concurrent writers that
+    create the same child table are serialized by a transaction lock."""
+    name = _partitionName(schemaname, tablename, year, columns)
+    if not tableExists(dbname, "partitions", name):
+        db = connect(dbname)
+        cur = db.cursor()
+        cur.execute("select pg_advisory_xact_lock(hashtext('partitions.{0}'))".format(name))
+        cur.execute("create table if not exists partitions.{0} (check (fdate >= date'{1}-1-1' and fdate < date'{2}-1-1')) inherits ({3}.{4})".format(
+            name, year, year + 1, schemaname, tablename))
+        for column in columns:
+            cur.execute("create index if not exists {0}_{1}idx on partitions.{0}({1})".format(name, column))
+        db.commit()
+        cur.close()
+        db.close()
+    return "partitions.{0}".format(name)
+
+
+def partitions(dbname, schemaname, tablename):
+    """Return the child tables of a partitioned raster table."""
+    db = connect(dbname)
+    cur = db.cursor()
+    cur.execute("select c.relname from pg_inherits i inner join pg_class c on i.inhrelid=c.oid inner join pg_class p on i.inhparent=p.oid inner join pg_namespace n on p.relnamespace=n.oid where n.nspname='{0}' and p.relname='{1}' order by c.relname".format(schemaname, tablename))
+    children = [r[0] for r in cur.fetchall()]
+    cur.close()
+    db.close()
+    return children
+
+
 def createResampledCatalog(dbname):
     """Create catalog that holds information on resampled rasters."""
     db = connect(dbname)
@@ -195,6 +345,7 @@ def createResampledCatalog(dbname):
 
 def resampleRaster(dbname, sname, tname, dt, res, method, tilesize, overwrite, squery=""):
     """Resample raster to target resolution."""
+    rname = "{0}_{1}".format(tname, int(1.0 / res))
     db = connect(dbname)
     cur = db.cursor()
     # check if resampled table exists
@@ -204,16 +355,21 @@ def resampleRaster(dbname, sname, tname, dt, res, method, tilesize, overwrite, s
         # check if date already exists and delete it before ingesting
         if overwrite:
             deleteRasters(dbname, "{0}.{1}_{2}".format(sname, tname, int(1.0 / res)), dt, squery)
-        sql = "insert into {0}.{1}_{2} (with dt as (select max(fdate) as maxdate from {0}.{1}_{2}), f as (select fdate,st_rescale(st_tile(rast,{5},{6}),{3},'{4}') as rast from {0}.{1} where fdate=date'{7}' {8}) select fdate,rast,dense_rank() over (order by st_upperleftx(rast),st_upperlefty(rast)) as rid from f)".format(sname, tname, int(1.0 / res), res, method, tilesize[0], tilesize[1], dt.strftime("%Y-%m-%d"), squery)
-        cur.execute(sql)
     else:
-        sql = "create table {0}.{1}_{2} as (with f as (select fdate,st_rescale(st_tile(rast,{5},{6}),{3},'{4}') as rast from {0}.{1} where fdate=date'{7}' {8}) select fdate,rast,dense_rank() over (order by st_upperleftx(rast),st_upperlefty(rast)) as rid from f)".format(
+        sql = "create table {0}.{1}_{2} as (with f as (select fdate,st_rescale(st_tile(rast,{5},{6}),{3},'{4}') as rast from {0}.{1} where fdate=date'{7}' {8}) select fdate,rast,dense_rank() over (order by st_upperleftx(rast),st_upperlefty(rast)) as rid from f) with no data".format(
             sname, tname, int(1.0 / res), res, method, tilesize[0], tilesize[1], dt.strftime("%Y-%m-%d"), squery)
         cur.execute(sql)
         cur.execute("create index {1}_{2}_t on {0}.{1}_{2}(fdate)".format(
             sname, tname, int(1.0 / res)))
         cur.execute("create index {1}_{2}_r on {0}.{1}_{2}(rid)".format(
             sname, tname, int(1.0 / res)))
+        db.commit()
+        partitionTable(dbname, sname, rname)
+    target = "{0}.{1}".format(sname, rname)
+    if isPartitioned(dbname, sname, rname):
+        target = partition(dbname, sname, rname, dt.year, ["fdate", "rid"])
+    sql = "insert into {9} (with dt as (select max(fdate) as maxdate from {0}.{1}_{2}), f as (select fdate,st_rescale(st_tile(rast,{5},{6}),{3},'{4}') as rast from {0}.{1} where fdate=date'{7}' {8}) select fdate,rast,dense_rank() over (order by st_upperleftx(rast),st_upperlefty(rast)) as rid from f)".format(sname, tname, int(1.0 / res), res, method, tilesize[0], tilesize[1], dt.strftime("%Y-%m-%d"), squery, target)
+    cur.execute(sql)
     db.commit()
 
 
@@ -263,8 +419,11 @@ def ingest(dbname, filename, dt, stname, resample=True, overwrite=True):
     if overwrite:
         deleteRasters(dbname, "{0}.{1}".format(schemaname, tablename), dt)
     # create tiles from imported raster and insert into table
-    cur.execute("insert into {0}.{1} (fdate,rast) select fdate,rast from {2}".format(
-        schemaname, tablename, temptable))
+    target = "{0}.{1}".format(schemaname, tablename)
+    if isPartitioned(dbname, schemaname, tablename):
+        target = partition(dbname, schemaname, tablename, dt.year)
+    cur.execute("insert into {0} (fdate,rast) select fdate,rast from {1}".format(
+        target, temptable))
     db.commit()
     # create materialized views for resampled rasters
     if resample:
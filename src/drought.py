@@ -12,10 +12,198 @@ from dateutil.relativedelta import relativedelta
 import scipy.stats as stats
 from datetime import date
 import pandas
+from io import BytesIO
+import psycopg2 as pg
 import dbio
 import logging
 
 
+_climatology = {}
+_pixels = {}
+
+_CUBES = 8  # number of float32 climatology cubes (and temporaries) held at the same time
+
+
+def chunks(model, memory=None):
+    """Partition the raster tiles of the model output tables into chunks whose
+    climatology cubes fit within *memory* megabytes. Each chunk is a tuple of tiles,
+    identified by their upper-left corner and size in pixels, and the whole domain
+    is processed at once (a single chunk of None) if no *memory* budget is given."""
+    log = logging.getLogger(__name__)
+    tables = [t for t in ["rainf", "runoff", "soil_moist", "par"] if dbio.tableExists(model.dbname, model.name, t)]
+    if memory is None or len(tables) < 1:
+        return [None]
+    db = dbio.connect(model.dbname)
+    cur = db.cursor()
+    cur.execute("select count(distinct fdate) from {0}.{1}".format(model.name, tables[0]))
+    nt = cur.fetchone()[0]
+    # tiles are aligned across output tables, so they can be retrieved from any of them
+    cur.execute("select distinct st_upperleftx(rast),st_upperlefty(rast),st_width(rast),st_height(rast) from {0}.{1} where fdate=(select max(fdate) from {0}.{1})".format(model.name, tables[0]))
+    tiles = sorted(cur.fetchall(), key=lambda t: (-t[1], t[0]))
+    cur.close()
+    db.close()
+    capacity = memory * 1024.**2 / (4 * _CUBES * max(nt, 1))
+    out = []
+    chunk = []
+    npix = 0
+    for tile in tiles:
+        if len(chunk) > 0 and npix + tile[2] * tile[3] > capacity:
+            out.append(tuple(chunk))
+            chunk = []
+            npix = 0
+        chunk.append(tuple(tile))
+        npix += tile[2] * tile[3]
+        if npix > capacity:
+            log.warning("Raster tile of {0} pixels exceeds the drought memory budget of {1} MB.".format(tile[2] * tile[3], memory))
+    if len(chunk) > 0:
+        out.append(tuple(chunk))
+    return out
+
+
+def pixels(model, tiles=None):
+    """Return the grid (row, column) indices of the pixels in the climatology cubes
+    of chunk *tiles*, i.e. the location of each column of the drought indices."""
+    return _pixels.get((model.dbname, model.name, tiles))
+
+
+def _loadClimatology(model, varname, layers=None, startdate=None, tiles=None):
+    """Load the entire history of *varname* (or the part after *startdate*) from the
+    database as a (time, pixel) float32 array that only contains valid pixels, along
+    with the dates and the grid indices of valid pixels (pixels with no data are
+    returned as NaN by PostGIS). Layered variables are summed over *layers*. If
+    *tiles* is given, only these raster tiles are streamed from the database one at
+    a time. If the model is a member of an ensemble (its *ensemble* attribute is
+    set) only its own rasters are loaded from ensemble tables. Each cube is memoized
+    so that it is only retrieved once per run, until :func:`clearClimatology` is
+    called."""
+    member = getattr(model, 'ensemble', None)
+    key = (model.dbname, model.name, varname, layers, startdate, tiles, member)
+    if key not in _climatology:
+        db = dbio.connect(model.dbname)
+        cur = db.cursor()
+        where = []
+        if layers is not None:
+            where.append("layer in ({0})".format(",".join(map(str, layers))))
+        if startdate is not None:
+            where.append("fdate>=date'{0}'".format(startdate.strftime("%Y-%m-%d")))
+        if member is not None and dbio.columnExists(model.dbname, model.name, varname, "ensemble"):
+            where.append("ensemble={0}".format(member))
+        if tiles is None:
+            queries = [where]
+        else:
+            # select each tile with its center point, which can use the spatial index
+            queries = [where + ["st_convexhull(rast) && st_setsrid(st_makepoint({0},{1}),4326)".format(ulx + w * model.res / 2., uly - h * model.res / 2.)] for ulx, uly, w, h in tiles]
+        agg = "" if layers is None else ",'sum'"
+        dates = None
+        cubes = []
+        rows = []
+        cols = []
+        for q in queries:
+            q = "where " + " and ".join(q) if len(q) > 0 else ""
+            sql = "select fdate,st_upperleftx(rast),st_upperlefty(rast),(ST_DumpValues(rast)).valarray from (select fdate,st_union(rast{3}) as rast from {0}.{1} {2} group by fdate) as u order by fdate".format(model.name, varname, q, agg)
+            cur.execute(sql)
+            if bool(cur.rowcount):
+                nt = cur.rowcount
+                tdates = np.zeros(nt, dtype='datetime64[D]')
+                for t, r in enumerate(cur):
+                    vals = np.array(r[3], dtype='float32')
+                    if t == 0:
+                        mask = ~np.isnan(vals)
+                        data = np.zeros((nt, mask.sum()), dtype='float32')
+                        i, j = np.where(mask)
+                        rows.append(i + int(round((max(model.lat) + model.res / 2. - r[2]) / model.res)))
+                        cols.append(j + int(round((r[1] - min(model.lon) + model.res / 2.) / model.res)))
+                    tdates[t] = r[0]
+                    data[t, :] = vals[mask]
+                dates = tdates
+                cubes.append(data)
+        if len(cubes) > 0:
+            data = cubes[0] if len(cubes) == 1 else np.hstack(cubes)
+            _pixels[(model.dbname, model.name, tiles)] = (np.concatenate(rows), np.concatenate(cols))
+            _climatology[key] = (dates, data, _pixels[(model.dbname, model.name, tiles)])
+        else:
+            _climatology[key] = None
+        cur.close()
+        db.close()
+    return _climatology[key]
+
+
+def clearClimatology():
+    """Clear the climatology cache, e.g. after the database tables have been updated
+    or a chunk of tiles has been processed."""
+    _climatology.clear()
+    _pixels.clear()
+
+
+def _stateName(varname, tiles=None):
+    """Return the name under which the state of drought index *varname* is persisted
+    for chunk *tiles*."""
+    if tiles is None:
+        return varname
+    return "{0}@{1},{2}+{3}".format(varname, tiles[0][0], tiles[0][1], len(tiles))
+
+
+def _readState(model, varname, tiles=None):
+    """Read the state persisted by the last calculation of drought index *varname*,
+    if it ended on the day before the simulation start date."""
+    log = logging.getLogger(__name__)
+    state = None
+    if dbio.tableExists(model.dbname, model.name, "drought_state"):
+        db = dbio.connect(model.dbname)
+        cur = db.cursor()
+        startdate = date(model.startyear, model.startmonth, model.startday)
+        cur.execute("select fdate,state from {0}.drought_state where varname=%s".format(model.name), (_stateName(varname, tiles),))
+        if bool(cur.rowcount):
+            fdate, buf = cur.fetchone()
+            if (startdate - fdate).days == 1:
+                state = dict(np.load(BytesIO(bytes(buf))))
+            else:
+                log.warning("Drought state for {0} ends on {1}, recalculating from the simulation period.".format(varname, fdate))
+        cur.close()
+        db.close()
+    return state
+
+
+def _writeState(model, varname, tiles=None, **state):
+    """Persist the accumulators of drought index *varname* at the end of the simulation
+    period so that the next run can only process the new days. It is only called by
+    incremental runs, so that other runs (e.g. forecasts or ensemble members) do not
+    replace the state the next nowcast continues from."""
+    db = dbio.connect(model.dbname)
+    cur = db.cursor()
+    if not dbio.tableExists(model.dbname, model.name, "drought_state"):
+        cur.execute("create table {0}.drought_state (varname text primary key, fdate date, state bytea)".format(model.name))
+    buf = BytesIO()
+    np.savez(buf, **state)
+    statename = _stateName(varname, tiles)
+    cur.execute("delete from {0}.drought_state where varname=%s".format(model.name), (statename,))
+    cur.execute("insert into {0}.drought_state values (%s, date'{1}-{2}-{3}', %s)".format(model.name, model.endyear, model.endmonth, model.endday), (statename, pg.Binary(buf.getvalue())))
+    db.commit()
+    cur.close()
+    db.close()
+
+
+def _climatologyFrame(model, varname, layers=None, period=False, incremental=False, tiles=None):
+    """Return data frame with a view of the climatology cube of *varname*, with one
+    column per valid pixel. If *period* is set, the data frame only contains the
+    simulation period, and if *incremental* is set only the simulation period is
+    retrieved from the database."""
+    if incremental:
+        clim = _loadClimatology(model, varname, layers, date(model.startyear, model.startmonth, model.startday), tiles)
+    else:
+        clim = _loadClimatology(model, varname, layers, tiles=tiles)
+    if clim is None:
+        p = None
+    else:
+        dates, data, _ = clim
+        if period:
+            t0 = np.searchsorted(dates, np.datetime64(date(model.startyear, model.startmonth, model.startday)))
+            t1 = np.searchsorted(dates, np.datetime64(date(model.endyear, model.endmonth, model.endday)), side='right')
+            dates, data = dates[t0:t1], data[t0:t1]
+        p = pandas.DataFrame(data, index=dates, columns=range(data.shape[1]), copy=False)
+    return p
+
+
 def _clipToValidRange(data):
     """Clip data series to valid intervals for drought index values."""
     valid_min = -3.09
@@ -30,66 +218,76 @@ def _movingAverage(data, n):
     return out[n - 1:] / n
 
 
-def _calcSuctionHead(model, nlayers=3):
+def _soilParameters(model, Ksat, nlayers=3):
+    """Return the index of the soil class (identified by the closest saturated
+    hydraulic conductivity in *Ksat*) and the depth (mm) of the surface and root
+    zone layers for each basin grid cell, along with their grid coordinates.
+    Parameters are resolved with a single join against the VIC soil table and
+    cached as columns of the basin table."""
+    db = dbio.connect(model.dbname)
+    cur = db.cursor()
+    if not dbio.columnExists(model.dbname, model.name, "basin", "soilclass"):
+        cur.execute("select b.gid,v.line from {0}.basin as b inner join vic.soils as v on v.id=b.gid".format(model.name))
+        gid, lines = zip(*cur.fetchall())
+        params = np.array([line.split() for line in lines])
+        k = np.mean(params[:, 9+nlayers:nlayers+11].astype('float'), axis=1)
+        z = np.sum(params[:, 4*nlayers+10:4*nlayers+12].astype('float'), axis=1) * 1000.
+        ki = np.argmin(abs(Ksat[np.newaxis, :] - k[:, np.newaxis]), axis=1)
+        cur.execute("alter table {0}.basin add column soilclass int, add column soildepth real".format(model.name))
+        values = ",".join("({0},{1},{2})".format(*v) for v in zip(gid, ki, z))
+        cur.execute("update {0}.basin as b set soilclass=v.ki,soildepth=v.z from (values {1}) as v(gid,ki,z) where b.gid=v.gid".format(model.name, values))
+        db.commit()
+    cur.execute("select st_y(geom),st_x(geom),soilclass,soildepth from {0}.basin".format(model.name))
+    lat, lon, ki, z = map(np.array, zip(*cur.fetchall()))
+    cur.close()
+    db.close()
+    return lat, lon, ki, z
+
+
+def _calcSuctionHead(model, nlayers=3, tiles=None):
     """Calculate soil suction from soil moisture using the Clapp
     and Hornberger (1978) model and parameters."""
     Ksat = np.array([63.36, 56.16, 12.49, 2.59, 2.5, 2.27, 0.612, 0.882, 0.781, 0.371, 0.461])
     Ksat *= (10 * 24.)  # convert from cm/hr to mm/day
-    n = [.395, .41, .435, .485, .451, .42, .477, .476, .426, .492, .482]
-    psi_a = [121., 90., 218., 786., 478., 299., 356., 630., 153., 490., 405.]
-    b = [4.05, 4.38, 4.9, 5.3, 5.39, 7.12, 7.75, 8.52, 10.4, 10.4, 11.4]
-    db = dbio.connect(model.dbname)
-    cur = db.cursor()
-    # get georeference information
-    cur.execute("select st_upperleftx(rast), st_upperlefty(rast), st_scalex(rast), st_scaley(rast) from {0}.soil_moist".format(model.name))
-    results = cur.fetchone()
-    ulx, uly, xres, yres = results
+    n = np.array([.395, .41, .435, .485, .451, .42, .477, .476, .426, .492, .482])
+    psi_a = np.array([121., 90., 218., 786., 478., 299., 356., 630., 153., 490., 405.])
+    b = np.array([4.05, 4.38, 4.9, 5.3, 5.39, 7.12, 7.75, 8.52, 10.4, 10.4, 11.4])
     # get soil moisture for surface and root zone layer
-    sql = "select fdate,(ST_DumpValues(st_union(rast,'sum'))).valarray from {0}.soil_moist where layer<3 group by fdate order by fdate".format(model.name)
-    cur.execute(sql)
-    if bool(cur.rowcount):
+    sm = _climatologyFrame(model, "soil_moist", (1, 2), tiles=tiles)
+    if sm is not None:
         st = "{0}-{1}-{2}".format(model.startyear, model.startmonth, model.startday)
         et = "{0}-{1}-{2}".format(model.endyear, model.endmonth, model.endday)
-        results = cur.fetchall()
-        data = np.array([np.array(r[1]).ravel() for r in results])
-        i = np.where(np.not_equal(data[0, :], None))[0]
-        sm = pandas.DataFrame(data[:, i], index=np.array([r[0] for r in results], dtype='datetime64'), columns=range(len(i)))
-        pfz = np.zeros(sm[st:et].shape)
-        ii, jj = np.unravel_index(i, np.array(results[0][1]).shape)
-        for j in sm.columns:
-            # identify soil type by saturated conductivity
-            cur.execute("select line from vic.soils order by geom <-> st_geomfromtext('POINT({0} {1})', 4326) limit 1".format(ulx+xres*jj[j], uly+yres*ii[j]))
-            line = cur.fetchone()[0]
-            k = np.mean(np.array(map(float, line.split()[9+nlayers:nlayers+11])))
-            z = sum(map(float, line.split()[4*nlayers+10:4*nlayers+12])) * 1000.
-            ki = np.argmin(abs(Ksat - k))
-            # convert into dekad averages
-            d = sm[j].index.day - np.clip((sm[j].index.day-1) // 10, 0, 2)*10 - 1
-            date = sm[j].index.values - np.array(d, dtype='timedelta64[D]')
-            sm_dekad = sm[j].groupby(date).apply(np.mean)
-            # calculate soil suction
-            pf = np.log(psi_a[ki] * ((sm_dekad / z) / n[ki])**(-b[ki]))
-            # calculate z-score of soil suction
-            pf = (pf[st:et] - pf.mean()) / pf.std()
-            pfz[:, j] = pf.reindex(sm[st:et].index).ffill().values
+        pi, pj = _loadClimatology(model, "soil_moist", (1, 2), tiles=tiles)[2]
+        # match soil parameters to the raster pixels
+        lat, lon, soilclass, soildepth = _soilParameters(model, Ksat, nlayers)
+        ii = np.round((max(model.lat) - lat) / model.res).astype('int')
+        jj = np.round((lon - min(model.lon)) / model.res).astype('int')
+        cells = np.zeros((max(ii.max(), pi.max()) + 1, max(jj.max(), pj.max()) + 1), dtype='int') - 1
+        cells[ii, jj] = range(len(lat))
+        cells = cells[pi, pj]
+        # pixels without a soil cell have no suction head
+        missing = cells < 0
+        cells[missing] = 0
+        ki = soilclass[cells]
+        z = np.where(missing, np.nan, soildepth[cells])
+        # convert into dekad averages
+        d = sm.index.day - np.clip((sm.index.day-1) // 10, 0, 2)*10 - 1
+        date = sm.index.values - np.array(d, dtype='timedelta64[D]')
+        sm_dekad = sm.groupby(date).mean()
+        # calculate soil suction
+        pf = np.log(psi_a[ki] * ((sm_dekad / z) / n[ki])**(-b[ki]))
+        # calculate z-score of soil suction
+        pf = (pf[st:et] - pf.mean()) / pf.std()
+        pfz = pf.reindex(sm[st:et].index).ffill().values
     else:
         pfz = None
-    cur.close()
-    db.close()
     return pfz
 
 
-def _calcFpar(model):
+def _calcFpar(model, tiles=None):
     """Retrieve the Photosynthetically Active Radiation from the model simulation."""
-    db = dbio.connect(model.dbname)
-    cur = db.cursor()
-    sql = "select fdate,(ST_DumpValues(rast)).valarray from {0}.par order by fdate".format(model.name)
-    cur.execute(sql)
-    if bool(cur.rowcount):
-        results = cur.fetchall()
-        data = np.array([np.array(r[1]).ravel() for r in results])
-        i = np.where(np.not_equal(data[0, :], None))[0]
-        fpar = pandas.DataFrame(data[:, i], index=np.array([r[0] for r in results], dtype='datetime64'), columns=range(len(i)))
+    fpar = _climatologyFrame(model, "par", tiles=tiles)
+    if fpar is not None:
         d = fpar.index.day - np.clip((fpar.index.day-1) // 10, 0, 2)*10 - 1
         date = fpar.index.values - np.array(d, dtype='timedelta64[D]')
         fpar_dekad = fpar.groupby(date, axis=0).apply(np.mean)
@@ -99,12 +297,10 @@ def _calcFpar(model):
         fparz = fparz.reindex(fpar[st:et].index).ffill().values
     else:
         fparz = None
-    cur.close()
-    db.close()
     return fparz
 
 
-def calcCDI(model):
+def calcCDI(model, tiles=None):
     """Calculate Combined Drought Index as a monthly time series. The index is
     categorical with the values corresponding to:
     0 = No drought
@@ -112,9 +308,9 @@ def calcCDI(model):
     2 = Warning (Soil moisture deficit)
     3 = Alert 1 (Vegetation stress following precipitation deficit)
     4 = Alert 2 (Vegetation stress following precipitation/soil moisture deficit)."""
-    spi = calcSPI(3, model)
-    sma = _calcSuctionHead(model)
-    fapar = _calcFpar(model)
+    spi = calcSPI(3, model, tiles=tiles)
+    sma = _calcSuctionHead(model, tiles=tiles)
+    fapar = _calcFpar(model, tiles)
     if all(v is not None for v in [spi, sma, fapar]):
         cdi = np.zeros(spi.shape, dtype='int')
         cdi[spi < -1] = 1
@@ -126,7 +322,54 @@ def calcCDI(model):
     return cdi
 
 
-def calcSRI(duration, model):
+def _rollingMean(data, window, tail=None):
+    """Calculate the moving average over *window* days of (time, pixel) array *data*,
+    continuing from the last values *tail* of the previous period. Returns the moving
+    average (NaN where there are not enough days) and the tail for the next period."""
+    if tail is None:
+        tail = np.zeros((0, data.shape[1]))
+    x = np.vstack((tail, data)).astype('float')
+    c = np.vstack((np.zeros((1, x.shape[1])), np.cumsum(x, axis=0)))
+    out = np.zeros(x.shape) + np.nan
+    out[window-1:] = (c[window:] - c[:-window]) / window
+    return out[len(tail):], x[max(len(x)-window+1, 0):]
+
+
+def _standardizedIndex(pm, params, ndays, window):
+    """Transform moving averages *pm* into a standardized index using fitted gamma
+    distribution parameters *params* for each pixel. The first *window* days of the
+    entire record (*ndays* have been processed previously) are set to zero."""
+    cdf = np.array([stats.gamma.cdf(pm[:, j], *params[j]) for j in range(pm.shape[1])]).T
+    out = np.zeros(pm.shape)
+    t0 = max(window - ndays, 0)
+    out[t0:, :] = stats.norm.ppf(cdf[t0:, :])
+    return _clipToValidRange(out)
+
+
+def _calcStandardizedIndex(varname, duration, model, incremental=False, tiles=None, state=None):
+    """Calculate standardized index of *varname* for specified month *duration*
+    by fitting a gamma distribution to its moving average. In *incremental* mode
+    the moving average and distribution parameters are continued from the
+    *state* persisted by the previous run if given, and the state at the end of
+    the simulation period is persisted."""
+    window = duration * 30  # assume each month is 30 days
+    statename = "{0}{1}".format(varname, duration)
+    p = _climatologyFrame(model, varname, period=True, incremental=state is not None, tiles=tiles)
+    if state is None:
+        pm, tail = _rollingMean(p.values, window)
+        params = np.array([stats.gamma.fit(pm[window:, j]) for j in range(pm.shape[1])])
+        ndays = 0
+    else:
+        pm, tail = _rollingMean(p.values, window, state['tail'])
+        params = state['params']
+        ndays = int(state['ndays'])
+    out = _standardizedIndex(pm, params, ndays, window)
+    if incremental:
+        _writeState(model, statename, tiles, tail=tail, params=params, ndays=ndays + len(p))
+    return out
+
+
+def calcSRI(duration, model, incremental=False, tiles=None):
     """Calculate Standardized Runoff Index for specified month
     *duration*."""
     log = logging.getLogger(__name__)
@@ -134,30 +377,17 @@ def calcSRI(duration, model):
     enddate = date(model.endyear, model.endmonth, model.endday)
     nt = (enddate - startdate).days + 1
     ndays = ((startdate + relativedelta(months=duration)) - startdate).days + 1
-    if duration < 1 or ndays > nt:
+    state = _readState(model, "runoff{0}".format(duration), tiles) if incremental and duration > 0 else None
+    # a shorter period can only be processed by continuing from the previous run
+    if duration < 1 or (ndays > nt and state is None):
         log.warning("Cannot calculate SRI with {0} months duration.".format(duration))
         sri = None
     else:
-        db = dbio.connect(model.dbname)
-        cur = db.cursor()
-        sql = "select fdate,(ST_DumpValues(rast)).valarray from {0}.runoff where fdate>=date'{1}-{2}-{3}' and fdate<=date'{4}-{5}-{6}' order by fdate".format(model.name, model.startyear, model.startmonth, model.startday, model.endyear, model.endmonth, model.endday)
-        cur.execute(sql)
-        results = cur.fetchall()
-        data = np.array([np.array(r[1]).ravel() for r in results])
-        i = np.where(np.not_equal(data[0, :], None))[0]
-        p = pandas.DataFrame(data[:, i], index=np.array([r[0] for r in results], dtype='datetime64'), columns=range(len(i)))
-        pm = p.rolling(duration*30).mean()  # assume each month is 30 days
-        g = [stats.gamma.fit(pm[j][duration*30:]) for j in pm.columns]
-        cdf = np.array([stats.gamma.cdf(pm[j],*g[j]) for j in pm.columns]).T
-        sri = np.zeros(cdf.shape)
-        sri[duration*30:, :] = stats.norm.ppf(cdf[duration*30:, :])
-        sri = _clipToValidRange(sri)
-        cur.close()
-        db.close()
+        sri = _calcStandardizedIndex("runoff", duration, model, incremental, tiles, state)
     return sri
 
 
-def calcSPI(duration, model):
+def calcSPI(duration, model, incremental=False, tiles=None):
     """Calculate Standardized Precipitation Index for specified month
     *duration*."""
     log = logging.getLogger(__name__)
@@ -166,124 +396,161 @@ def calcSPI(duration, model):
     nt = (enddate - startdate).days + 1
     ndays = ((startdate + relativedelta(months=duration)) - startdate).days + 1
     # tablename = "precip."+model.precip
-    if duration < 1 or ndays > nt:
+    state = _readState(model, "rainf{0}".format(duration), tiles) if incremental and duration > 0 else None
+    # a shorter period can only be processed by continuing from the previous run
+    if duration < 1 or (ndays > nt and state is None):
         log.warning("Cannot calculate SPI with {0} months duration.".format(duration))
         spi = None
     else:
-        db = dbio.connect(model.dbname)
-        cur = db.cursor()
-        sql = "select fdate,(ST_DumpValues(rast)).valarray from {0}.rainf where fdate>=date'{1}-{2}-{3}' and fdate<=date'{4}-{5}-{6}' order by fdate".format(model.name, model.startyear, model.startmonth, model.startday, model.endyear, model.endmonth, model.endday)
-        cur.execute(sql)
-        results = cur.fetchall()
-        data = np.array([np.array(r[1]).ravel() for r in results])
-        i = np.where(np.not_equal(data[0, :], None))[0]
-        p = pandas.DataFrame(data[:, i], index=np.array([r[0] for r in results], dtype='datetime64'), columns=range(len(i)))
-        pm = p.rolling(duration*30).mean()  # assume each month is 30 days
-        g = [stats.gamma.fit(pm[j][duration*30:]) for j in pm.columns]
-        cdf = np.array([stats.gamma.cdf(pm[j],*g[j]) for j in pm.columns]).T
-        spi = np.zeros(cdf.shape)
-        spi[duration*30:, :] = stats.norm.ppf(cdf[duration*30:, :])
-        spi = _clipToValidRange(spi)
-        cur.close()
-        db.close()
+        spi = _calcStandardizedIndex("rainf", duration, model, incremental, tiles, state)
     return spi
 
 
-def calcSeverity(model, varname="soil_moist"):
+def calcSeverity(model, varname="soil_moist", tiles=None):
     """Calculate drought severity from *climatology* table stored in database."""
-    db = dbio.connect(model.dbname)
-    cur = db.cursor()
     if varname == "soil_moist":
-        sql = "select fdate,(ST_DumpValues(st_union(rast,'sum'))).valarray from {0}.soil_moist group by fdate order by fdate".format(model.name)
+        p = _climatologyFrame(model, "soil_moist", tuple(range(1, model.nlayers + 1)), tiles=tiles)
     else:
-        sql = "select fdate,(ST_DumpValues(rast)).valarray from {0}.runoff order by fdate".format(model.name)
-    cur.execute(sql)
-    results = cur.fetchall()
-    data = np.array([np.array(r[1]).ravel() for r in results])
-    i = np.where(np.not_equal(data[0, :], None))[0]
-    p = pandas.DataFrame(data[:, i], index=np.array([r[0] for r in results], dtype='datetime64'), columns=range(len(i)))
+        p = _climatologyFrame(model, "runoff", tiles=tiles)
     p = p.rolling('10D').mean()  # calculate percentiles with dekad rolling mean
     st = "{0}-{1}-{2}".format(model.startyear, model.startmonth, model.startday)
     et = "{0}-{1}-{2}".format(model.endyear, model.endmonth, model.endday)
     s = np.array([[stats.percentileofscore(p[pi].values, v) for v in p[pi][st:et]] for pi in p.columns]).T
     s = 100.0 - s
-    cur.close()
-    db.close()
     return s
 
 
-def calcDrySpells(model, droughtfun=np.mean, duration=14, recovduration=2):
-    """Calculate maps of number of dry spells during simulation period."""
-    # FIXME: Currently only uses precipitation to identify dry spells. Need to change it to also use soil moisture and runoff
-    db = dbio.connect(model.dbname)
-    cur = db.cursor()
-    sql = "select fdate,(ST_DumpValues(rast)).valarray from {0}.rainf where fdate>=date'{1}-{2}-{3}' and fdate<=date'{4}-{5}-{6}' order by fdate".format(model.name, model.startyear, model.startmonth, model.startday, model.endyear, model.endmonth, model.endday)
-    cur.execute(sql)
-    results = cur.fetchall()
-    data = np.array([np.array(r[1]).ravel() for r in results])
-    i = np.where(np.not_equal(data[0, :], None))[0]
-    p = pandas.DataFrame(data[:, i], index=np.array([r[0] for r in results], dtype='datetime64'), columns=range(len(i)))
-    cur.close()
-    db.close()
-    ndroughts = np.zeros(p.values.shape)
-    for pi in p.columns:
-        drought_thresh = droughtfun(p[pi])
-        days = 0
-        for i in range(recovduration-1, len(p[pi])):
-            if p.values[i, pi] <= drought_thresh:
-                days += 1
-            elif all(p.values[i-j, pi] > drought_thresh for j in range(recovduration)):
-                days = 0
-            else:
-                days += 1
-            if days == duration:
-                ndroughts[i, pi] = 1
-    return np.cumsum(ndroughts, axis=0)
+def _drySpells(dry, duration, recovduration, days=None, chunksize=4096):
+    """Identify the days when a dry spell reaches *duration* days from a boolean
+    (time, pixel) array *dry*. A spell is only terminated after *recovduration*
+    consecutive non-dry days, so the day counter is the distance from the last
+    recovery day and is calculated with a running maximum along the time axis.
+    When continuing from a previous period, *days* holds the day counters at its
+    end and the first *recovduration* - 1 rows of *dry* are its last days. Returns
+    the spell events and the day counters at the last day."""
+    nt, npix = dry.shape
+    events = np.zeros(dry.shape, dtype='bool')
+    counter = np.zeros(npix, dtype='int')
+    if days is None:
+        days = np.zeros(npix, dtype='int')
+    t = np.arange(nt, dtype='int32').reshape((nt, 1))
+    for c in range(0, npix, chunksize):
+        wet = ~dry[:, c:c+chunksize]
+        reset = wet.copy()
+        for j in range(1, recovduration):
+            reset[j:] &= wet[:-j]
+        reset[:recovduration-1] = False
+        last = np.where(reset, t, (recovduration - 2 - days[c:c+chunksize]).astype('int32'))
+        np.maximum.accumulate(last, axis=0, out=last)
+        events[:, c:c+chunksize] = (t - last) == duration
+        counter[c:c+chunksize] = nt - 1 - last[-1]
+    events[:recovduration-1] = False
+    return events, counter
 
 
-def calcSMDI(model):
-    """Calculate Soil Moisture Deficit Index (Narasimhan & Srinivasan, 2005)."""
-    db = dbio.connect(model.dbname)
-    cur = db.cursor()
-    sql = "select fdate,(ST_DumpValues(rast)).valarray from {0}.soil_moist where layer=2 order by fdate".format(model.name)
-    cur.execute(sql)
-    results = cur.fetchall()
-    data = np.array([np.array(r[1]).ravel() for r in results])
-    i = np.where(np.not_equal(data[0, :], None))[0]
-    clim = pandas.DataFrame(data[:, i], index=np.array([r[0] for r in results], dtype='datetime64'), columns=range(len(i)))
-    st = "{0}-{1}-{2}".format(model.startyear, model.startmonth, model.startday)
-    et = "{0}-{1}-{2}".format(model.endyear, model.endmonth, model.endday)
-    p = clim[st:et]
-    smdi = np.zeros(p.shape)
-    for j in clim.columns:
-        MSW = clim[j].median()
-        maxSW = clim[j].max()
-        minSW = clim[j].min()
-        SW = p[j].rolling('7D').median().values[7:]
-        SD = (SW - MSW) / (maxSW - MSW) * 100.0
-        SD[SD == 0.0] = (SW[SD == 0.0] - MSW) / (MSW - minSW) * 100.0
-        smdi[:7, j] = SD[:7] / 50.0
-        smdi[7:, j] = 0.5 * smdi[6:-1, j] + SD / 50.0
-    cur.close()
-    db.close()
+def calcDrySpells(model, droughtfun=np.mean, duration=14, recovduration=2, varnames=None, incremental=False, tiles=None):
+    """Calculate maps of number of dry spells during simulation period. A day is
+    considered dry when all variables in *varnames* (any of rainf, soil_moist and
+    runoff, default is rainf) are below their respective thresholds, calculated for
+    each pixel with *droughtfun*. In *incremental* mode the thresholds and spell
+    counters are continued from the state persisted by the previous run."""
+    if varnames is None:
+        varnames = ["rainf"]
+    state = _readState(model, "dryspells", tiles) if incremental else None
+    dry = None
+    thresh = []
+    for vi, varname in enumerate(varnames):
+        if varname == "soil_moist":
+            p = _climatologyFrame(model, varname, tuple(range(1, model.nlayers + 1)), period=True, incremental=state is not None, tiles=tiles)
+        else:
+            p = _climatologyFrame(model, varname, period=True, incremental=state is not None, tiles=tiles)
+        p = p.values.astype('float')
+        if state is None:
+            thresh.append(droughtfun(p, axis=0))
+        else:
+            thresh.append(state['thresh'][vi])
+        if dry is None:
+            dry = p <= thresh[vi]
+        else:
+            dry &= p <= thresh[vi]
+    if state is None:
+        ndroughts, days = _drySpells(dry, duration, recovduration)
+        nspells = np.cumsum(ndroughts, axis=0, dtype='float')
+    else:
+        ntail = len(state['tail'])
+        dry = np.vstack((state['tail'], dry))
+        ndroughts, days = _drySpells(dry, duration, recovduration, state['days'])
+        nspells = state['nspells'] + np.cumsum(ndroughts[ntail:], axis=0, dtype='float')
+    if incremental:
+        _writeState(model, "dryspells", tiles, thresh=np.array(thresh), tail=dry[max(len(dry)-recovduration+1, 0):], days=days, nspells=nspells[-1])
+    return nspells
+
+
+def _smdi(sm, MSW, maxSW, minSW, tail=None, smdi0=None):
+    """Calculate the Soil Moisture Deficit Index recursively from (time, pixel) array
+    *sm*, using the weekly median soil water and the climatological median, maximum
+    and minimum for each pixel. The previous period can be continued from its last
+    six days *tail* and last index values *smdi0*."""
+    if tail is None:
+        tail = np.zeros((0, sm.shape[1]))
+    SW = pandas.DataFrame(np.vstack((tail, sm))).rolling(7, min_periods=1).median().values[len(tail):]
+    SD = (SW - MSW) / (maxSW - MSW) * 100.0
+    i = SD == 0.0
+    SD[i] = ((SW - MSW) / (MSW - minSW) * 100.0)[i]
+    smdi = np.zeros(SD.shape)
+    for t in range(SD.shape[0]):
+        if t > 0:
+            smdi[t] = 0.5 * smdi[t-1] + SD[t] / 50.0
+        elif smdi0 is not None:
+            smdi[t] = 0.5 * smdi0 + SD[t] / 50.0
+        else:
+            smdi[t] = SD[t] / 50.0
+    return smdi
+
+
+def calcSMDI(model, incremental=False, tiles=None):
+    """Calculate Soil Moisture Deficit Index (Narasimhan & Srinivasan, 2005). In
+    *incremental* mode the climatology and recursion are continued from the state
+    persisted by the previous run."""
+    state = _readState(model, "smdi", tiles) if incremental else None
+    if state is None:
+        clim = _climatologyFrame(model, "soil_moist", (2,), tiles=tiles)
+        st = "{0}-{1}-{2}".format(model.startyear, model.startmonth, model.startday)
+        et = "{0}-{1}-{2}".format(model.endyear, model.endmonth, model.endday)
+        p = clim[st:et].values.astype('float')
+        MSW = clim.median().values
+        maxSW = clim.max().values
+        minSW = clim.min().values
+        smdi = _smdi(p, MSW, maxSW, minSW)
+    else:
+        p = _climatologyFrame(model, "soil_moist", (2,), period=True, incremental=True, tiles=tiles).values.astype('float')
+        MSW, maxSW, minSW = state['MSW'], state['maxSW'], state['minSW']
+        smdi = _smdi(p, MSW, maxSW, minSW, state['tail'], state['smdi'])
+        p = np.vstack((state['tail'], p))
+    if incremental:
+        _writeState(model, "smdi", tiles, MSW=MSW, maxSW=maxSW, minSW=minSW, tail=p[max(len(p)-6, 0):], smdi=smdi[-1])
     smdi = np.clip(smdi, -4.0, 4.0)
     return smdi
 
 
-def calc(varname, model):
-    """Calculate drought-related variable."""
+def calc(varname, model, incremental=False, tiles=None):
+    """Calculate drought-related variable. In *incremental* mode, indices that can
+    be updated from persisted accumulators (SPI, SRI, SMDI and dry spells) only
+    process the simulation period. If *tiles* is given (see :func:`chunks`), the
+    variable is only calculated for the pixels of these raster tiles, which are
+    located on the model grid with :func:`pixels`."""
     if varname.find("spi") == 0:
         duration = int(varname[3])
-        output = calcSPI(duration, model)
+        output = calcSPI(duration, model, incremental, tiles)
     elif varname.startswith("sri"):
         duration = int(varname[3])
-        output = calcSRI(duration, model)
+        output = calcSRI(duration, model, incremental, tiles)
     elif varname == "severity":
-        output = calcSeverity(model)
+        output = calcSeverity(model, tiles=tiles)
     elif varname == "cdi":
-        output = calcCDI(model)
+        output = calcCDI(model, tiles)
     elif varname == "smdi":
-        output = calcSMDI(model)
+        output = calcSMDI(model, incremental, tiles)
     elif varname == "dryspells":
-        output = calcDrySpells(model)
+        output = calcDrySpells(model, incremental=incremental, tiles=tiles)
     return output
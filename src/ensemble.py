@@ -8,21 +8,121 @@
 """
 
 import vic
-from vic import state
+from vic import state, parameters, output
+from vic.library import StateLibrary, digest
 import tempfile
 import sys
 import random
 from datetime import date, timedelta
-from multiprocessing import Process
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+import threading
+import time
 import numpy as np
+from collections import OrderedDict
+from scipy.signal import lfilter
+from scipy.ndimage import gaussian_filter
 import shutil
 import os
 from dateutil.relativedelta import relativedelta
-import rpath
 import dbio
+import products
 import logging
 
 
+def _link(source, dest, symlink=True):
+    """Hard link *source* to *dest*, falling back to a symbolic link (e.g. across file
+    systems, unless *symlink* is False) or a copy. Files shared this way are read-only;
+    writers must replace them instead of writing in place."""
+    if os.path.abspath(source) == os.path.abspath(dest):
+        return
+    if not os.path.exists(source):
+        raise OSError("{0} does not exist".format(source))
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(source, dest)
+    except OSError:
+        if symlink:
+            try:
+                os.symlink(os.path.abspath(source), dest)
+                return
+            except OSError:
+                pass
+        shutil.copy(source, dest)
+
+
+_esp = {}
+
+
+def _initESP(models, forcings):
+    """Attach the ensemble members and the historical forcings they are sampled from."""
+    _esp['models'] = models
+    _esp['forcings'] = forcings
+
+
+def _writeESPForcings(args):
+    """Write the forcings of ensemble member *e* for *ndays* from the shared historical
+    record, starting *i* days after its first day. Returns whether they were written."""
+    e, i, ndays = args
+    gids, prec, tmax, tmin, wind = _esp['forcings']
+    try:
+        _esp['models'][e].writeForcings(*[f[:, i:i + ndays + 1] for f in (prec, tmax, tmin, wind)], gids=gids)
+    except SystemExit:
+        return False
+    return True
+
+
+def runModels(models, vicexe, nprocs=None, timeout=None, retries=1):
+    """Run VIC *models* from a queue of jobs with *nprocs* workers (defaults to the
+    number of processors). Runs that fail or exceed *timeout* seconds are retried
+    up to *retries* times. Returns the indices of the models that failed."""
+    log = logging.getLogger(__name__)
+    if nprocs is None:
+        nprocs = cpu_count()
+    lock = threading.Lock()
+    finished = []
+    t0 = time.time()
+
+    def job(m):
+        for attempt in range(max(0, retries) + 1):
+            returncode = models[m].run(vicexe, timeout)
+            if returncode == 0:
+                break
+            log.warning("VIC run {0} failed with exit code {1}.{2}".format(
+                m + 1, returncode, " Retrying..." if attempt < retries else ""))
+        with lock:
+            finished.append(m)
+            log.info("Finished {0} of {1} VIC runs ({2:.1f} runs per hour).".format(
+                len(finished), len(models), 3600.0 * len(finished) / max(time.time() - t0, 1e-6)))
+        return returncode
+
+    pool = ThreadPool(max(1, min(nprocs, len(models))))
+    returncodes = pool.map(job, range(len(models)), chunksize=1)
+    pool.close()
+    pool.join()
+    failed = [m for m, returncode in enumerate(returncodes) if returncode != 0]
+    if len(failed) > 0:
+        log.error("VIC runs {0} failed.".format(", ".join(str(m + 1) for m in failed)))
+    return failed
+
+
+def _statistics(data, nodata, percentiles=[]):
+    """Calculate the ensemble mean, standard deviation and *percentiles* of the
+    (member, time, layer, row, column) *data*, keeping *nodata* where any member
+    is missing."""
+    valid = np.all(data != nodata, axis=0)
+    stats = OrderedDict()
+    stats['mean'] = np.mean(data, axis=0)
+    stats['std'] = np.std(data, axis=0, ddof=1 if len(data) > 1 else 0)
+    if len(percentiles) > 0:
+        for p, q in zip(percentiles, products.quantiles(data, percentiles)):
+            stats["p{0:g}".format(p).replace(".", "_")] = q
+    for stat in stats:
+        stats[stat][~valid] = nodata
+    return stats
+
+
 class Ensemble:
 
     def __init__(self, nens, dbname, resolution, startyear, startmonth, startday,
@@ -36,25 +136,27 @@ class Ensemble:
         self.startyear, self.startmonth, self.startday = startyear, startmonth, startday
         self.endyear, self.endmonth, self.endday = endyear, endmonth, endday
         self.dbname = dbname
+        self.nprocs = cpu_count()
+        self.timeout = None
+        self.retries = 1
+        self.dbstatistics = False
+        self.percentiles = []
+        self.quantiles = []
+        self.thresholds = {}
         for e in range(nens):
             modelpath = tempfile.mkdtemp(dir=".")
             model = vic.VIC(modelpath, dbname, resolution, startyear, startmonth, startday,
                             endyear, endmonth, endday, name=name)
             self.models.append(model)
 
-    def _ensembleTable(self, write, e):
-        def write_wrapper(data, dates, tablename, initialize, skipsave):
-            return write(data, dates, tablename, initialize, e, skipsave=skipsave)
-        return write_wrapper
-
     def setStateFiles(self, statefiles):
-        """Set initial state files for each ensemble member."""
+        """Set initial state files for each ensemble member, linking them into the member directories."""
         for e in range(len(statefiles)):
+            filename = statefiles[e].split("/")[-1]
             try:
-                shutil.copy(statefiles[e], self.models[e].model_path)
+                _link(statefiles[e], "{0}/{1}".format(self.models[e].model_path, filename))
             except:
                 pass
-            filename = statefiles[e].split("/")[-1]
             statefiles[
                 e] = "{0}/{1}".format(self.models[e].model_path, filename)
         self.statefiles = statefiles
@@ -62,30 +164,20 @@ class Ensemble:
     def readStateFiles(self):
         """Read initial state files for each ensemble member."""
         cells = []
-        _, vegfile, snowbandfile = self.models[0].paramFromDB()
-        veg = state.readVegetation("{0}/{1}".format(rpath.data, vegfile))
-        bands, _ = state.readSnowbands(
-            "{0}/{1}".format(rpath.data, snowbandfile))
+        veg, bands = parameters.tables(self.models[0])
         for filename in self.statefiles:
             c, _, _, _ = state.readStateFile(filename)
             cells.append(c)
         return cells, veg, bands
 
-    def updateStateFiles(self, data, alat, alon, agid):
-        """Update initial state files with *data*."""
-        _, vegparam, snowbands = self.models[0].paramFromDB()
-        veg = state.readVegetation("{0}/{1}".format(rpath.data, vegparam))
-        bands, _ = state.readSnowbands("{0}/{1}".format(rpath.data, snowbands))
-        for e, statefile in enumerate(self.statefiles):
-            states, nlayer, nnodes, dateline = state.readStateFile(statefile)
-            for var in data:
-                x = state.readVariable(self.models[e], states, alat[var], alon[
-                                       var], veg, bands, nlayer, var)
-
-                states = state.updateVariable(self.models[e], states, x, data[var][:, e], alat[
-                                              var], alon[var], agid, veg, bands, nlayer, var)
-            state.writeStateFile(statefile, states, "{0}\n{1} {2}".format(
-                dateline.strip(), nlayer, nnodes))
+    def updateStateFiles(self, data, alat, alon, agid, nprocs=None):
+        """Update initial state files with *data*, using *nprocs* processes
+        (defaults to the number of processors)."""
+        veg, bands = parameters.tables(self.models[0])
+        cellids = dict((var, [self.models[0].lgid[(alat[var][i], alon[var][i])] for i in range(len(alat[var]))]) for var in data)
+        if nprocs is None:
+            nprocs = cpu_count()
+        state.updateStateFiles(self.statefiles, data, cellids, veg, bands, nprocs)
 
     def setDates(self, startyear, startmonth, startday, endyear, endmonth, endday):
         """Set simulation dates for entire ensemble."""
@@ -124,14 +216,19 @@ class Ensemble:
         """Write soil parameter files based on domain shapefile."""
         self.models[0].writeSoilFile(shapefile)
         for model in self.models[1:]:
-            shutil.copy(
-                "{0}/soil.txt".format(self.models[0].model_path), "{0}/".format(model.model_path))
-            model.lat = self.models[0].lat
-            model.lon = self.models[0].lon
-            model.gid = self.models[0].gid
-            model.lgid = self.models[0].lgid
-            model.depths = self.models[0].depths
-            model.elev = self.models[0].elev
+            self._shareSoil(model)
+
+    def _shareSoil(self, model):
+        """Link the soil parameter file of *model* to the one written for the ensemble
+        and share the domain grid cells."""
+        source = self.models[0]
+        _link("{0}/soil.txt".format(source.model_path), "{0}/soil.txt".format(model.model_path))
+        model.lat = source.lat
+        model.lon = source.lon
+        model.gid = source.gid
+        model.lgid = source.lgid
+        model.depths = source.depths
+        model.elev = source.elev
 
     def writeForcings(self, method, options):
         """Write forcings for the ensemble based on method (ESP, BCSD)."""
@@ -153,39 +250,66 @@ class Ensemble:
         dsmod = __import__("datasets." + dataset, fromlist=[dataset])
         dsmod.generate(options, self)
 
-    def perturb(self, prec, tmax, tmin, wind, nens=None, perr=0.25, terr=2.0):
-        """Perturb meteorological forcings."""
+    def _noise(self, e, gids, ndays, seed, tcorr, scorr):
+        """Generate standard normal noise for the precipitation and temperature of ensemble
+        member *e* from its own seed, with lag-1 autocorrelation *tcorr* in time and a
+        Gaussian spatial correlation of length scale *scorr* (degrees)."""
+        rs = np.random.RandomState((seed + e) % 2**32)
+        z = rs.standard_normal((2, len(gids), ndays))
+        if tcorr > 0.0:
+            z[:, :, 0] /= np.sqrt(1.0 - tcorr**2)
+            z = lfilter([np.sqrt(1.0 - tcorr**2)], [1.0, -tcorr], z, axis=-1)
+        if scorr > 0.0:
+            model = self.models[0]
+            lat = np.array([model.gid[g][0] for g in gids])
+            lon = np.array([model.gid[g][1] for g in gids])
+            i = np.round((lat - lat.min()) / model.res).astype('int')
+            j = np.round((lon - lon.min()) / model.res).astype('int')
+            sigma = (0, 0, scorr / model.res, scorr / model.res)
+            grid = np.zeros((2, ndays, i.max() + 1, j.max() + 1))
+            grid[:, :, i, j] = np.transpose(z, (0, 2, 1))
+            delta = np.zeros(grid.shape[2:])
+            delta[delta.shape[0] // 2, delta.shape[1] // 2] = 1.0
+            # rescale the smoothed noise to unit variance
+            norm = np.sqrt(np.sum(gaussian_filter(delta, sigma[2:], mode='constant')**2))
+            z = np.transpose(gaussian_filter(grid, sigma, mode='constant')[:, :, i, j], (0, 2, 1)) / norm
+        return z
+
+    @staticmethod
+    def _perturbForcings(prec, tmax, tmin, z, perr, terr):
+        """Perturb (cell, day) forcings with noise *z*: precipitation with a relative
+        error *perr* and mean daily temperature with an error *terr*. Noise can have a
+        leading ensemble dimension."""
+        eprec = np.where(prec > 0.0, prec + np.abs(perr * prec) * z[..., 0, :, :], prec)
+        tavgp = 0.5 * (tmax + tmin) + terr * z[..., 1, :, :]
+        return eprec, (tavgp - 0.5 * tmin) / 0.5, (tavgp - 0.5 * tmax) / 0.5
+
+    def perturb(self, prec, tmax, tmin, wind, nens=None, perr=0.25, terr=2.0, seed=None, tcorr=0.0, scorr=0.0, lazy=False):
+        """Perturb meteorological forcings. Each ensemble member draws its noise from
+        *seed* plus its index, so that members are reproducible. Returns the grid cell
+        ids and the (ensemble, cell, day) arrays of the perturbed forcings, or if *lazy*
+        a generator of each member's (cell, day) arrays perturbed as they are needed."""
         if nens is None:
             nens = self.nens
-        ensprec = []
-        enstmax = []
-        enstmin = []
-        enswind = []
-        for e in range(nens):
-            p = []
-            tx = []
-            tn = []
-            w = []
-            for i in range(len(prec)):
-                p.append(list(prec[i]))
-                if prec[i][2] > 0.0:
-                    p[-1][2] = np.log(np.random.lognormal(prec[i]
-                                                          [2], abs(perr * prec[i][2])))
-                tx.append(list(tmax[i]))
-                tn.append(list(tmin[i]))
-                tavgp = 0.5 * (tmax[i][2] + tmin[i][2]) + \
-                    np.random.normal(0., terr)
-                tx[-1][2] = (tavgp - 0.5 * tmin[i][2]) / 0.5
-                tn[-1][2] = (tavgp - 0.5 * tmax[i][2]) / 0.5
-                w.append(list(wind[i]))
-            ensprec.append(p)
-            enstmax.append(tx)
-            enstmin.append(tn)
-            enswind.append(w)
-        return ensprec, enstmax, enstmin, enswind
+        if seed is None:
+            seed = np.random.randint(2**31)
+        gids, prec, tmax, tmin, wind = self.models[0].forcingArrays(prec, tmax, tmin, wind)
+
+        def members():
+            for e in range(nens):
+                z = self._noise(e, gids, prec.shape[1], seed, tcorr, scorr)
+                yield self._perturbForcings(prec, tmax, tmin, z, perr, terr) + (wind,)
+
+        if lazy:
+            return gids, members()
+        z = np.array([self._noise(e, gids, prec.shape[1], seed, tcorr, scorr) for e in range(nens)])
+        eprec, etmax, etmin = self._perturbForcings(prec, tmax, tmin, z, perr, terr)
+        return gids, eprec, etmax, etmin, np.repeat(wind[np.newaxis], nens, axis=0)
 
     def _ESP(self, options):
-        """Generate meteorological forcings using the Ensemble Streamflow Prediction method."""
+        """Generate meteorological forcings using the Ensemble Streamflow Prediction method.
+        The members' forcings are written by a pool of processes."""
+        log = logging.getLogger(__name__)
         ndays = (date(self.endyear, self.endmonth, self.endday) -
                  date(self.startyear, self.startmonth, self.startday)).days
         db = dbio.connect(self.models[0].dbname)
@@ -199,28 +323,76 @@ class Ensemble:
         random.shuffle(years)
         while len(years) < self.nens:
             years += years
+        cur.close()
+        db.close()
+        # extract the historical record spanning all the members' years at once
+        starts = [date(years[e], self.startmonth, self.startday) for e in range(self.nens)]
+        model = self.models[0]
+        t0, t1 = min(starts), max(starts) + timedelta(ndays)
+        model.startyear, model.startmonth, model.startday = t0.year, t0.month, t0.day
+        model.endyear, model.endmonth, model.endday = t1.year, t1.month, t1.day
+        prec, tmax, tmin, wind = model.getForcings(options['vic'])
+        t0 = min(r[1] for r in prec)
+        gids, prec, tmax, tmin, wind = model.forcingArrays(prec, tmax, tmin, wind)
+        jobs = []
         for e in range(self.nens):
             model = self.models[e]
-            model.startyear = years[e]
-            t = date(model.startyear, model.startmonth,
-                     model.startday) + timedelta(ndays)
+            t = starts[e] + timedelta(ndays)
+            model.startyear, model.startmonth, model.startday = starts[e].year, starts[e].month, starts[e].day
             model.endyear, model.endmonth, model.endday = t.year, t.month, t.day
-            prec, tmax, tmin, wind = model.getForcings(options['vic'])
-            model.writeForcings(prec, tmax, tmin, wind)
-        cur.close()
-        db.close()
+            jobs.append((e, (starts[e] - t0).days, ndays))
+        nprocs = min(self.nprocs, self.nens)
+        if nprocs > 1:
+            pool = Pool(nprocs, _initESP, (self.models, (gids, prec, tmax, tmin, wind)))
+            try:
+                written = pool.map(_writeESPForcings, jobs)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            _initESP(self.models, (gids, prec, tmax, tmin, wind))
+            written = [_writeESPForcings(job) for job in jobs]
+        _esp.clear()
+        failed = [e for e, ok in enumerate(written) if not ok]
+        if len(failed) > 0:
+            log.error("Could not write the forcings of ensemble members {0}, exiting!".format(", ".join(str(e + 1) for e in failed)))
+            sys.exit()
+
+    def setRunOptions(self, vicoptions):
+        """Set the number of VIC runs in parallel, their timeout (seconds), the
+        retries of failed runs and the ensemble statistics and products from the VIC options."""
+        if 'processes' in vicoptions:
+            self.nprocs = int(vicoptions['processes'])
+        if 'run timeout' in vicoptions:
+            self.timeout = float(vicoptions['run timeout'])
+        if 'run retries' in vicoptions:
+            self.retries = max(0, int(vicoptions['run retries']))
+        if 'ensemble statistics' in vicoptions:
+            self.dbstatistics = vicoptions['ensemble statistics'] == "database"
+        if 'ensemble percentiles' in vicoptions:
+            self.percentiles = [float(p) for p in vicoptions['ensemble percentiles'].split(",")]
+        if 'ensemble quantiles' in vicoptions:
+            self.quantiles = [float(q) for q in vicoptions['ensemble quantiles'].split(",")]
+        if 'ensemble thresholds' in vicoptions:
+            self.thresholds = {}
+            for item in vicoptions['ensemble thresholds'].split(","):
+                varname, threshold = item.split(":")
+                self.thresholds.setdefault(varname.strip(), []).append(float(threshold))
 
-    def run(self, vicexe):
-        """Run ensemble of VIC models using multi-threading."""
-        procs = [Process(target=self.models[e].run, args=(vicexe,))
-                 for e in range(self.nens)]
-        for p in procs:
-            p.start()
-        for p in procs:
-            p.join()
-
-    def _initializeDeterm(self, basin, forcings, vicexe):
-        """Initialize ensemble of VIC models deterministically."""
+    def run(self, vicexe, models=None):
+        """Run ensemble of VIC models (or *models* if given) with a bounded pool of workers.
+        Exits if any of the runs failed, since their output and state files are missing."""
+        log = logging.getLogger(__name__)
+        if models is None:
+            models = self.models
+        if len(runModels(models, vicexe, self.nprocs, self.timeout, self.retries)) > 0:
+            log.error("Ensemble simulation failed, exiting!")
+            sys.exit()
+
+    def _initializeDeterm(self, basin, forcings, vicexe, library=None):
+        """Initialize ensemble of VIC models deterministically, reusing the spin-up
+        state from the state *library* if given."""
+        log = logging.getLogger(__name__)
         db = dbio.connect(self.dbname)
         cur = db.cursor()
         dt = "{0}-{1}-{2}".format(self.startyear,
@@ -239,36 +411,52 @@ class Ensemble:
             statefile = ""
         if statefile == "":
             t = date(self.startyear - 1, self.startmonth, self.startday)
+            seed = "determ"
+        else:
+            # spin-ups from different initial states are different library states
+            seed = "determ-{0}".format(digest(statefile))
         # checks if statefile corresponds to requested forecast start date
         if (t - date(self.startyear, self.startmonth, self.startday)).days < 0:
-            if (t - date(self.startyear - 1, self.startmonth, self.startday)).days < 0:
-                # if statefile is older than a year, start the model
-                # uninitialized for 1 year
-                t = date(self.startyear - 1, self.startmonth, self.startday)
-            modelpath = tempfile.mkdtemp(dir=".")
-            model = vic.VIC(modelpath, self.dbname, self.res, t.year, t.month,
-                            t.day, self.startyear, self.startmonth, self.startday, self.name)
-            model.writeParamFile(save_state=modelpath,
-                                 init_state=bool(statefile))
-            model.writeSoilFile(basin)
-            prec, tmax, tmin, wind = model.getForcings(forcings)
-            model.writeForcings(prec, tmax, tmin, wind)
-            model.run(vicexe)
-            statefile = model.model_path + \
-                "/vic.state_{0:04d}{1:02d}{2:02d}".format(
-                    self.startyear, self.startmonth, self.startday)
-            for emodel in self.models:
-                shutil.copy(statefile, emodel.model_path)
-            shutil.rmtree(model.model_path)
+            startdate = date(self.startyear, self.startmonth, self.startday)
+            libfile = "{0}/vic.state_{1:04d}{2:02d}{3:02d}".format(
+                self.models[0].model_path, self.startyear, self.startmonth, self.startday)
+            if library is not None and library.get(startdate, seed, libfile) is not None:
+                statefile = libfile
+            else:
+                if (t - date(self.startyear - 1, self.startmonth, self.startday)).days < 0:
+                    # if statefile is older than a year, start the model
+                    # uninitialized for 1 year
+                    t = date(self.startyear - 1, self.startmonth, self.startday)
+                modelpath = tempfile.mkdtemp(dir=".")
+                model = vic.VIC(modelpath, self.dbname, self.res, t.year, t.month,
+                                t.day, self.startyear, self.startmonth, self.startday, self.name)
+                model.writeParamFile(save_state=modelpath,
+                                     init_state=bool(statefile))
+                self._shareSoil(model)
+                prec, tmax, tmin, wind = model.getForcings(forcings)
+                model.writeForcings(prec, tmax, tmin, wind)
+                self.run(vicexe, [model])
+                statefile = model.model_path + \
+                    "/vic.state_{0:04d}{1:02d}{2:02d}".format(
+                        self.startyear, self.startmonth, self.startday)
+                if not os.path.isfile(statefile):
+                    log.error("Deterministic spin-up did not write a state file, exiting!")
+                    sys.exit()
+                if library is not None:
+                    library.put(startdate, seed, statefile)
+                for emodel in self.models:
+                    _link(statefile, "{0}/{1}".format(emodel.model_path, os.path.basename(statefile)), symlink=False)
+                shutil.rmtree(model.model_path)
         statefiles = [statefile] * self.nens
         self.setStateFiles(statefiles)
         cur.close()
         db.close()
         return statefiles
 
-    def _initializeRandom(self, basin, forcings, vicexe, initdays=90, saveindb=False, saveto="db", saveargs=[], overwrite=True, skipsave=0):
+    def _initializeRandom(self, basin, forcings, vicexe, initdays=90, saveindb=False, saveto="db", saveargs=[], overwrite=True, skipsave=0, library=None):
         """Initialize ensemble of VIC models by sampling the meterological forcings
-        and running them *initmonths* prior to simulation start date."""
+        and running them *initmonths* prior to simulation start date. Members whose
+        sampled year was spun up before are taken from the state *library* if given."""
         db = dbio.connect(self.dbname)
         cur = db.cursor()
         sql = "select distinct (date_part('year', fdate)) as year from precip.{0}".format(
@@ -279,7 +467,6 @@ class Ensemble:
             years.remove(max(years))
         cur.close()
         db.close()
-        statefiles = []
         t = date(self.startyear, self.startmonth, self.startday) - \
             relativedelta(days=initdays)
         ndays = (date(self.startyear, self.startmonth, self.startday) - t).days
@@ -287,13 +474,21 @@ class Ensemble:
         model = vic.VIC(modelpath, self.dbname, self.res, t.year, t.month,
                         t.day, self.startyear, self.startmonth, self.startday, self.name)
         years = np.random.choice(years, self.nens)
+        startdate = date(self.startyear, self.startmonth, self.startday)
+        statefiles = [None] * self.nens
         pmodels = []
+        members = []
         for e in range(self.nens):
+            if library is not None:
+                statefiles[e] = library.get(startdate, "{0}d{1}".format(initdays, years[e]), "{0}/vic.state_{1:04d}{2:02d}{3:02d}".format(
+                    self.models[e].model_path, self.startyear, self.startmonth, self.startday))
+                if statefiles[e] is not None:
+                    continue
             modelpath = tempfile.mkdtemp()  # (dir=".")
             model = vic.VIC(modelpath, self.dbname, self.res, t.year, t.month,
                             t.day, self.startyear, self.startmonth, self.startday, self.name)
             model.writeParamFile(save_state=modelpath, init_state=False)
-            model.writeSoilFile(basin)
+            self._shareSoil(model)
             model.startyear = years[e]
             model.endyear = years[e] + (model.endyear - t.year)
             ddays = (date(model.endyear, model.endmonth, model.endday) -
@@ -306,31 +501,24 @@ class Ensemble:
             model.startyear, model.startmonth, model.startday = t.year, t.month, t.day
             model.endyear, model.endmonth, model.endday = self.startyear, self.startmonth, self.startday
             pmodels.append(model)
-        procs = [Process(target=pmodels[e].run, args=(vicexe,))
-                 for e in range(self.nens)]
-        for p in procs:
-            p.start()
-        for p in procs:
-            p.join()
+            members.append(e)
+        self.run(vicexe, pmodels)
         if saveindb:
             if skipsave < 0:
                 skipdays = (date(self.startyear, self.startmonth,
                                  self.startday) - t).days + 1 + skipsave
             else:
                 skipdays = skipsave
-            init = overwrite
-            for e in range(len(pmodels)):
-                model = pmodels[e]
-                if getattr(model.writeToDB, 'func_name') is not 'write_wrapper':
-                    model.writeToDB = self._ensembleTable(
-                        model.writeToDB, e + 1)
-                if e > 0:
-                    init = False
-                model.save(saveto, saveargs, init, skipsave=skipdays)
-        for e in range(self.nens):
-            statefile = pmodels[e].model_path + "/vic.state_{0:04d}{1:02d}{2:02d}".format(
+            if saveto == "db":
+                self.saveToDB(pmodels, saveargs, overwrite, skipsave=skipdays)
+            else:
+                for e, model in enumerate(pmodels):
+                    model.save(saveto, saveargs, overwrite and e == 0, skipsave=skipdays)
+        for e, model in zip(members, pmodels):
+            statefiles[e] = model.model_path + "/vic.state_{0:04d}{1:02d}{2:02d}".format(
                 self.startyear, self.startmonth, self.startday)
-            statefiles.append(statefile)
+            if library is not None:
+                library.put(startdate, "{0}d{1}".format(initdays, years[e]), statefiles[e])
         return statefiles
 
     def _initializePerturb(self, basin, forcings, vicexe, initdays=90, saveindb=False, saveto="db", saveargs=[], overwrite=True, skipsave=0):
@@ -343,60 +531,85 @@ class Ensemble:
         model = vic.VIC(modelpath, self.dbname, self.res, t.year, t.month,
                         t.day, self.startyear, self.startmonth, self.startday, self.name)
         prec, tmax, tmin, wind = model.getForcings(forcings)
-        eprec, etmax, etmin, ewind = self.perturb(prec, tmax, tmin, wind)
+        gids, members = self.perturb(prec, tmax, tmin, wind, lazy=True)
         pmodels = []
-        for e in range(self.nens):
+        for e, (eprec, etmax, etmin, ewind) in enumerate(members):
             modelpath = tempfile.mkdtemp()
             model = vic.VIC(modelpath, self.dbname, self.res, t.year, t.month,
                             t.day, self.startyear, self.startmonth, self.startday, self.name)
             model.writeParamFile(save_state=modelpath, init_state=False)
-            model.writeSoilFile(basin)
-            model.writeForcings(eprec[e], etmax[e], etmin[e], ewind[e])
+            self._shareSoil(model)
+            model.writeForcings(eprec, etmax, etmin, ewind, gids=gids)
             pmodels.append(model)
-        procs = [Process(target=pmodels[e].run, args=(vicexe,))
-                 for e in range(self.nens)]
-        for p in procs:
-            p.start()
-        for p in procs:
-            p.join()
+        self.run(vicexe, pmodels)
         if saveindb:
             if skipsave < 0:
                 skipdays = (date(self.startyear, self.startmonth,
                                  self.startday) - t).days + 1 + skipsave
             else:
                 skipdays = skipsave
-            init = overwrite
-            for e in range(len(pmodels)):
-                model = pmodels[e]
-                if getattr(model.writeToDB, 'func_name') is not 'write_wrapper':
-                    model.writeToDB = self._ensembleTable(
-                        model.writeToDB, e + 1)
-                if e > 0:
-                    init = False
-                model.save(saveto, saveargs, init, skipsave=skipdays)
+            if saveto == "db":
+                self.saveToDB(pmodels, saveargs, overwrite, skipsave=skipdays)
+            else:
+                for e, model in enumerate(pmodels):
+                    model.save(saveto, saveargs, overwrite and e == 0, skipsave=skipdays)
         for e in range(self.nens):
             statefile = pmodels[e].model_path + "/vic.state_{0:04d}{1:02d}{2:02d}".format(
                 self.startyear, self.startmonth, self.startday)
             statefiles.append(statefile)
         return statefiles
 
+    def _forcingOptions(self, options):
+        """Return the datasets of the meteorological forcings used by the ensemble."""
+        forcings = {'temperature': options['vic'][
+            'temperature'], 'wind': options['vic']['wind']}
+        if 'lai' in options['vic']:
+            forcings['lai'] = options['vic']['lai']
+        forcings['precip'] = options['vic']['precip'].split(",")[0]
+        return forcings
+
+    def runInterval(self, options, vicexe, startdate, enddate, saveto="db", saveargs=[], overwrite=True, binarystate=False):
+        """Run the ensemble between *startdate* and *enddate*, restarting each member
+        from its current state file (e.g. updated by the assimilation) instead of
+        spinning it up again, with perturbed meteorological forcings. The start date
+        was the last day of the previous interval, so its output is only saved when
+        the interval is the first one (*overwrite*). The state files at *enddate*
+        become the initial states of the next interval, written in VIC's binary state
+        format if *binarystate* is set."""
+        self.setDates(startdate.year, startdate.month, startdate.day, enddate.year, enddate.month, enddate.day)
+        prec, tmax, tmin, wind = self.models[0].getForcings(self._forcingOptions(options))
+        gids, members = self.perturb(prec, tmax, tmin, wind, lazy=True)
+        for e, (model, (eprec, etmax, etmin, ewind)) in enumerate(zip(self.models, members)):
+            if binarystate and not state.isBinary(self.statefiles[e]):
+                state.StateFile(self.statefiles[e]).write(binary=True)
+            model.writeParamFile(save_state=model.model_path, state_file=self.statefiles[e], binary_state=binarystate)
+            model.writeForcings(eprec, etmax, etmin, ewind, gids=gids)
+        self.run(vicexe)
+        self.save(saveto, saveargs, overwrite, skipsave=0 if overwrite else 1)
+        self.statefiles = ["{0}/vic.state_{1:04d}{2:02d}{3:02d}".format(model.model_path, enddate.year, enddate.month, enddate.day) for model in self.models]
+
+    def _stateLibrary(self, vicoptions, forcings):
+        """Return the library of spin-up states from the VIC options, if requested."""
+        if 'state library' in vicoptions:
+            maxage = float(vicoptions['state library age']) if 'state library age' in vicoptions else None
+            maxsize = float(vicoptions['state library size']) if 'state library size' in vicoptions else None
+            return StateLibrary(vicoptions['state library'], self.name, self.res, forcings, list(self.models[0].gid), maxage, maxsize)
+        return None
+
     def initialize(self, options, basin, method, vicexe, saveindb=False, saveto="db", saveargs=[], overwrite=True, skipsave=0, initdays=90):
         """Initialize ensemble of VIC models using one of three methods:
         1) deterministic (default): each ensemble member has an identical state
         2) random: each ensemble member gets a random day from climatology
         3) perturb: perturb precipitation and temperature"""
         log = logging.getLogger(__name__)
-        forcings = {'temperature': options['vic'][
-            'temperature'], 'wind': options['vic']['wind']}
-        if 'lai' in options['vic']:
-            forcings['lai'] = options['vic']['lai']
-        forcings['precip'] = options['vic']['precip'].split(",")[0]
+        forcings = self._forcingOptions(options)
         self.writeParamFiles()
         # write soil file for each ensemble member and populate
         # latitude/longitude arrays
         self.writeSoilFiles(basin)
+        library = self._stateLibrary(options['vic'], forcings)
         if method.find("determ") == 0:
-            statefiles = self._initializeDeterm(basin, forcings, vicexe)
+            statefiles = self._initializeDeterm(basin, forcings, vicexe, library=library)
         elif method.find("states") == 0:
             db = dbio.connect(self.dbname)
             cur = db.cursor()
@@ -413,8 +626,10 @@ class Ensemble:
             cur.close()
             db.close()
         elif method.find("random") == 0:
+            # spin-up outputs saved in the database need all members to be run
             statefiles = self._initializeRandom(
-                basin, forcings, vicexe, initdays=initdays, saveindb=saveindb, saveto=saveto, saveargs=saveargs, skipsave=skipsave, overwrite=overwrite)
+                basin, forcings, vicexe, initdays=initdays, saveindb=saveindb, saveto=saveto, saveargs=saveargs, skipsave=skipsave, overwrite=overwrite,
+                library=None if saveindb else library)
         elif method.find("perturb") == 0:
             statefiles = self._initializePerturb(
                 basin, forcings, vicexe, initdays=initdays, saveindb=saveindb, saveto=saveto, saveargs=saveargs, skipsave=skipsave, overwrite=overwrite)
@@ -423,27 +638,84 @@ class Ensemble:
             sys.exit()
         self.setStateFiles(statefiles)
 
-    def save(self, saveto, args, initialize=True):
+    def saveToDB(self, models, args, initialize=True, skipsave=0):
+        """Reads the output of ensemble *models* concurrently and imports each variable
+        for all members at once, numbering them in the ensemble column by their order.
+        Table indexes are maintained once at the end of the enclosing write batch."""
+        log = logging.getLogger(__name__)
+        if len(models) < 1 or len(models[0].lat) < 1 or len(models[0].lon) < 1:
+            log.info("No pixels simulated, not saving any output!")
+            return
+        args = output.variableGroup(list(args))
+        pool = ThreadPool(min(self.nprocs, len(models)))
+        outputs = pool.map(lambda m: m.readOutput(args), models, chunksize=1)
+        pool.close()
+        pool.join()
+        dates = outputs[0][1]
+        outdata = [out for out, _ in outputs]
+        with dbio.writeBatch():
+            for var in [v for v in args if v in outdata[0] and v not in vic.droughtvars]:
+                data = np.array([out.pop(var) for out in outdata])
+                models[0].writeEnsembleToDB(data, dates, var, initialize, skipsave=skipsave)
+                self._saveStatistics(models[0], data, dates, var, skipsave)
+                self._saveProducts(models[0], data, dates, var, skipsave)
+                log.info("Saved {0} for {1} ensemble members.".format(var, len(models)))
+            if any(v in vic.droughtvars for v in outdata[0]):
+                # drought indices are calculated from the variables each member wrote above
+                for e, model in enumerate(models):
+                    model.ensemble = e + 1
+                    outdata[e] = model.droughtOutput(outdata[e])
+                for var in [v for v in args if v in outdata[0] and v in vic.droughtvars]:
+                    members = [e for e in range(len(models)) if outdata[e][var] is not None]
+                    if len(members) > 0:
+                        data = np.array([outdata[e].pop(var) for e in members])
+                        models[0].writeEnsembleToDB(data, dates, var, initialize, [e + 1 for e in members], skipsave=skipsave)
+                        self._saveStatistics(models[0], data, dates, var, skipsave)
+                        self._saveProducts(models[0], data, dates, var, skipsave)
+
+    def _saveStatistics(self, model, data, dates, varname, skipsave=0):
+        """Saves the ensemble mean, standard deviation and percentiles of *varname*
+        calculated from the stacked member *data*, replacing only the saved dates
+        since the statistics are not stored per member. Nothing is saved if the
+        statistics are calculated in the database instead."""
+        log = logging.getLogger(__name__)
+        if self.dbstatistics:
+            return
+        stats = _statistics(data, model.nodata, self.percentiles)
+        for stat in stats:
+            tablename = "{0}_{1}".format(varname, stat)
+            if dbio.tableExists(model.dbname, model.name, tablename) and not dbio.columnExists(model.dbname, model.name, tablename, "rid"):
+                log.warning("Table {0} was created by the database ensemble statistics. Overwriting entire table!".format(tablename))
+                db = dbio.connect(model.dbname)
+                cur = db.cursor()
+                cur.execute("drop table {0}.{1}".format(model.name, tablename))
+                db.commit()
+                cur.close()
+                db.close()
+            model.writeToDB(stats[stat], dates, tablename, True, skipsave=skipsave)
+
+    def _saveProducts(self, model, data, dates, varname, skipsave=0):
+        """Saves the ensemble quantiles of *varname* and the probabilities of falling
+        below its thresholds, calculated from the stacked member *data*, as multi-band
+        rasters with a band for each quantile or threshold in the configured order.
+        Like the statistics, they replace the rasters of the saved dates."""
+        if len(self.quantiles) > 0:
+            out = products.quantiles(data, self.quantiles, model.nodata)
+            model.writeToDB(np.rollaxis(out, 0, 3), dates, "{0}_quantiles".format(varname), True, skipsave=skipsave)
+        if varname in self.thresholds:
+            out = products.probability(data, self.thresholds[varname], model.nodata)
+            model.writeToDB(np.rollaxis(out, 0, 3), dates, "{0}_prob".format(varname), True, skipsave=skipsave)
+
+    def save(self, saveto, args, initialize=True, skipsave=0):
         """Reads and saves selected output data variables from the ensemble into the database
-        or a user-defined directory."""
-        def ensembleTable(write, e):
-            def write_wrapper(data, dates, tablename, initialize, skipsave):
-                return write(data, dates, tablename, initialize, e)
-            return write_wrapper
-        for e in range(self.nens):
-            model = self.models[e]
-            if getattr(model.writeToDB, 'func_name') is not 'write_wrapper':
-                # decorate function to add ensemble information
-                model.writeToDB = ensembleTable(model.writeToDB, e + 1)
-            if saveto == "db":
-                if e > 0:
-                    initialize = False
-                model.save(saveto, args, initialize)
-            else:
-                if e < 1:
-                    if os.path.isdir(saveto):
-                        shutil.rmtree(saveto)
-                    elif os.path.isfile(saveto):
-                        os.remove(saveto)
-                    os.makedirs(saveto)
+        or a user-defined directory, skipping the first *skipsave* days."""
+        if saveto == "db":
+            self.saveToDB(self.models, args, initialize, skipsave=skipsave)
+        else:
+            if os.path.isdir(saveto):
+                shutil.rmtree(saveto)
+            elif os.path.isfile(saveto):
+                os.remove(saveto)
+            os.makedirs(saveto)
+            for e, model in enumerate(self.models):
                 model.save(saveto + "/{0}".format(e + 1), args, False)
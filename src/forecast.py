@@ -38,6 +38,7 @@ def runVIC(dbname, options):
     name = options['forecast']['name'].lower()
     models = ensemble.Ensemble(nens, dbname, res, startyear,
                                startmonth, startday, endyear, endmonth, endday, name)
+    models.setRunOptions(options['vic'])
     if 'initialize' in options['vic'] and options['vic']['initialize'] in ['perturb', 'random']:
         init_method = options['vic']['initialize']
     else:
@@ -58,11 +59,12 @@ def runVIC(dbname, options):
     models.run(vicexe)
     models.setDates(startyear, startmonth, startday, endyear, endmonth, endday)
     models.save(saveto, savevars)
-    for varname in savevars:
-        raster.stddev(models.dbname, "{0}.{1}".format(
-            models.name, varname))
-        raster.mean(models.dbname, "{0}.{1}".format(
-            models.name, varname))
+    if models.dbstatistics:
+        for varname in savevars:
+            raster.stddev(models.dbname, "{0}.{1}".format(
+                models.name, varname))
+            raster.mean(models.dbname, "{0}.{1}".format(
+                models.name, varname))
     for e in range(nens):
         shutil.rmtree(models[e].model_path)
 
@@ -8,75 +8,184 @@
 """
 
 import numpy as np
-from scipy.linalg import sqrtm
+from scipy import sparse
+from scipy.spatial import cKDTree
+from collections import OrderedDict
+from functools import partial
+
+
+def gaspariCohn(dists, radius):
+    """Fifth-order piecewise rational localization function of Gaspari and Cohn (1999),
+    which decreases from 1 at zero distance to 0 at distances beyond *radius*."""
+    r = 2.0 * np.abs(np.asarray(dists, dtype='float')) / radius
+    rho = np.zeros(r.shape)
+    i = r <= 1.0
+    ri = r[i]
+    rho[i] = (((-0.25 * ri + 0.5) * ri + 0.625) * ri - 5.0 / 3.0) * ri**2 + 1.0
+    i = (r > 1.0) & (r < 2.0)
+    ri = r[i]
+    rho[i] = ((((ri / 12.0 - 0.5) * ri + 0.625) * ri + 5.0 / 3.0) * ri - 5.0) * ri + 4.0 - 2.0 / (3.0 * ri)
+    return rho
+
+
+def neighbours(xloc, yloc, radius):
+    """Return a sparse (CSR) matrix with the distances between the state locations
+    *xloc* and the observation locations *yloc* that are within *radius*, found with a
+    KD-tree so that memory is proportional to the number of neighbours. The distances
+    of co-located points are stored as explicit zeros."""
+    xloc = np.asarray(xloc, dtype='float')
+    yloc = np.asarray(yloc, dtype='float')
+    nbrs = cKDTree(yloc).query_ball_point(xloc, radius)
+    indptr = np.zeros(len(xloc) + 1, dtype='int')
+    indptr[1:] = np.cumsum([len(n) for n in nbrs])
+    indices = np.array([j for n in nbrs for j in sorted(n)], dtype='int')
+    rows = np.repeat(np.arange(len(xloc)), np.diff(indptr))
+    data = np.sqrt(np.sum((xloc[rows] - yloc[indices])**2, axis=1))
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(xloc), len(yloc)))
+
+
+def _localGroups(dists, radius):
+    """Group the state elements (rows of *dists*, either a dense array or a sparse
+    neighbour matrix) that share the same local observations and localization weights,
+    so that their analysis can be performed once. Returns a list of (observation indices,
+    weights, state element indices)."""
+    ndim, nobs = dists.shape
+    if sparse.issparse(dists):
+        dists = dists.tocsr()
+        ptr, j, d = dists.indptr, dists.indices, dists.data
+        inside = np.zeros(len(d) + 1, dtype='int')
+        inside[1:] = np.cumsum(d < radius)
+        j, d = j[d < radius], d[d < radius]
+        ptr = inside[ptr]
+    else:
+        i, j = np.nonzero(dists < radius)
+        d = dists[i, j]
+        ptr = np.searchsorted(i, np.arange(ndim + 1))
+    w = gaspariCohn(d, radius)
+    groups = OrderedDict()
+    for row in range(ndim):
+        lobs = j[ptr[row]:ptr[row + 1]]
+        if len(lobs) > 0:
+            lw = w[ptr[row]:ptr[row + 1]]
+            key = lobs.tobytes() + lw.tobytes()
+            if key not in groups:
+                groups[key] = (lobs, lw, [])
+            groups[key][2].append(row)
+    return [(lobs, lw, np.array(rows)) for lobs, lw, rows in groups.values()]
 
 
 class ENKF:
 
-    def __init__(self, A, HA, d, E):
+    def __init__(self, A, HA, d, E, radius=None, executor=None, dtype='float64'):
         """Initialize Ensemble Kalman Filter object using a state matrix *A*,
         a predicted measurement matrix *HA*, an observation vector *d*,
-        and an observation error covariance matrix *R*."""
+        and an observation error matrix *E*, from which the observation error
+        variances *R* are calculated. Local filters only use the observations
+        within the localization *radius* of each state element, and perform their
+        local analyses with the *executor* (any object with a map method sharing
+        memory with the caller, e.g. a multiprocessing.pool.ThreadPool) if given.
+        Ensembles are stored as *dtype* arrays (e.g. float32 to halve memory) and
+        the state ensemble is updated in place."""
+        self.A = np.array(A, dtype=dtype)
         if HA is not None:
-            self.HA = HA
+            self.HA = np.array(HA, dtype=dtype)
         else:
-            self.HA = A
-        self.A = np.mat(A)
-        self.HA = np.mat(self.HA)
-        self.d = np.mat(d)
-        self.E = np.mat(E)
-        self.ndim, self.nens = A.shape
-        self.nobs = len(d)
-        self.R = np.mat(
-            np.diag(np.diag((1.0 / (self.nens - 1)) * self.E * self.E.T)))
+            self.HA = self.A.copy()
+        self.d = np.array(d, dtype=dtype).reshape((-1, 1))
+        self.E = np.array(E, dtype=dtype)
+        self.ndim, self.nens = self.A.shape
+        self.nobs = len(self.d)
+        self.radius = radius
+        self.executor = executor
+        self.R = np.sum(self.E * self.E, axis=1) / (self.nens - 1)
 
     def analysis(self, dists):
         """Perform the analysis step of the Ensemble Kalman Filter and return
         an updated state matrix."""
-        Dp = self.d + np.mean(self.E, axis=1) - self.HA
-        HAp = self.HA - np.mean(self.HA, axis=1)
-        HAY = HAp + self.E
-        U, S, V = np.linalg.svd(HAY)
+        Dp = self.d + np.mean(self.E, axis=1)[:, np.newaxis] - self.HA
+        HAp = self.HA - np.mean(self.HA, axis=1)[:, np.newaxis]
+        U, S, V = np.linalg.svd(HAp + self.E, full_matrices=False)
         i = np.where(np.cumsum(S) / np.sum(S[:self.nens]) > 0.999)[0]
-        U = np.mat(U[:, :self.nens])
-        L1 = np.mat(np.diag(1.0 / (S * S)))
+        L1 = 1.0 / (S * S)
         L1[i] = 0.0
-        X1 = L1 * U.T
-        X2 = X1 * Dp
-        X3 = U * X2
-        X4 = HAp.T * X3
-        Ap = self.A - np.mean(self.A, axis=1)
-        self.Aa = self.A + Ap * X4
+        X4 = HAp.T.dot(U.dot(L1[:, np.newaxis] * U.T.dot(Dp)))
+        Ap = self.A - np.mean(self.A, axis=1)[:, np.newaxis]
+        self.A += Ap.dot(X4)
+        self.Aa = self.A
+
+
+def _localAnalysis(batch, X, xm, Y, dy, r, rho, xa):
+    """Solve a *batch* of local analyses with the same number of observations and
+    write the updated state elements into *xa*. Batches update disjoint state elements,
+    so they can be solved concurrently."""
+    nl = len(batch[0][0])
+    k = X.shape[1]
+    a = (k - 1) / rho
+    lobs = np.array([g[0] for g in batch])
+    # scale the local observation perturbations by the localized error variances
+    sw = np.sqrt(np.array([g[1] for g in batch]) / r[lobs])
+    B = Y[lobs] * sw[:, :, np.newaxis]
+    Bt = np.transpose(B, (0, 2, 1))
+    Bz = np.matmul(Bt, (dy[lobs] * sw)[:, :, np.newaxis])
+    if nl < k:
+        # the ensemble space matrix is a rank-nl update of the identity, so decompose
+        # the smaller observation space matrix instead
+        lam, U = np.linalg.eigh(np.matmul(B, Bt))
+        lam = np.clip(lam, 0.0, None)
+        sv = np.sqrt(lam)
+        V = np.matmul(Bt, U) / np.where(sv > 1e-10 * sv[:, -1:], sv, np.inf)[:, np.newaxis, :]
+        Vt = np.transpose(V, (0, 2, 1))
+        pc = 1.0 / (a + lam) - 1.0 / a
+        wc = np.sqrt((k - 1) / (a + lam)) - np.sqrt((k - 1) / a)
+        w = Bz / a + np.matmul(V * pc[:, np.newaxis, :], np.matmul(Vt, Bz))
+        W = np.sqrt((k - 1) / a) * np.eye(k) + np.matmul(V * wc[:, np.newaxis, :], Vt) + w
+    else:
+        lam, Q = np.linalg.eigh(np.matmul(Bt, B) + a * np.eye(k))
+        Qt = np.transpose(Q, (0, 2, 1))
+        w = np.matmul(Q / lam[:, np.newaxis, :], np.matmul(Qt, Bz))
+        W = np.matmul(Q * np.sqrt((k - 1) / lam)[:, np.newaxis, :], Qt) + w
+    single = [i for i, g in enumerate(batch) if len(g[2]) == 1]
+    rows = np.array([batch[i][2][0] for i in single], dtype='int')
+    xa[rows, :] = xm[rows, np.newaxis] + np.einsum('rk,rkj->rj', X[rows], W[single])
+    for i, g in enumerate(batch):
+        if len(g[2]) > 1:
+            xa[g[2], :] = xm[g[2], np.newaxis] + X[g[2]].dot(W[i])
 
 
 class LETKF(ENKF):
 
+    batchsize = 1024  # number of local analyses that are solved together
+
     def analysis(self, dists):
-        """Implements the Local Ensemble Transform Kalman Filter."""
-        n = 1
+        """Implements the Local Ensemble Transform Kalman Filter (Hunt et al., 2007).
+        Each state element is updated with the observations within the localization
+        radius, whose error variances are inflated with the Gaspari-Cohn function of
+        their distances *dists* (see :func:`neighbours`). State elements that share the
+        same observations and weights are updated together, and the local analyses of
+        equal size are batched and solved with an eigen-decomposition of the ensemble
+        space matrix (or of the observation space matrix when there are fewer local
+        observations than members). Batches are distributed across the workers of the
+        executor, if one was given, with results that do not depend on their number."""
         rho = 1.05
-        localizer = lambda s: s
-        Y = self.HA - np.mean(self.HA, axis=1)
-        X = self.A - np.mean(self.A, axis=1)
-        xa = np.zeros(self.A.shape)
-        segs = [np.arange((i * n), min((i + 1) * n - 1, self.ndim - 1) + 1)
-                for i in range(np.divide(self.ndim, n) + 1)]
-        segs = [s for s in segs if len(s) > 0]
-        for l in range(len(segs)):
-            lx = segs[l]
-            ly = range(self.nobs)  # localizer(segs[l])
-            Xl = X[lx, :]
-            Yl = Y[ly, :]
-            Rl = np.diag(np.diag(np.array(self.R))[ly])
-            C = Yl.T * np.linalg.pinv(Rl)
-            P = np.linalg.pinv((self.nens - 1) *
-                               np.eye(self.nens) / rho + C * Yl)
-            W = np.real(sqrtm((self.nens - 1) * P))
-            w = P * C * (np.mat(self.d[ly]) - np.mean(self.HA[ly, :], axis=1))
-            W = W + w
-            Xla = Xl * W + np.mean(self.A[lx, :], axis=1)
-            xa[lx, :] = Xla
-        self.Aa = xa
+        xm = np.mean(self.A, axis=1)
+        X = self.A - xm[:, np.newaxis]
+        Y = self.HA - np.mean(self.HA, axis=1)[:, np.newaxis]
+        dy = self.d.ravel() - np.mean(self.HA, axis=1)
+        if self.radius is None:
+            groups = [(np.arange(self.nobs), np.ones(self.nobs), np.arange(self.ndim))]
+        else:
+            groups = _localGroups(dists, self.radius)
+        sizes = np.array([len(g[0]) for g in groups])
+        batches = []
+        for nl in np.unique(sizes):
+            same = [groups[g] for g in np.where(sizes == nl)[0]]
+            batches += [same[b:b + self.batchsize] for b in range(0, len(same), self.batchsize)]
+        solve = partial(_localAnalysis, X=X, xm=xm, Y=Y, dy=dy, r=self.R, rho=rho, xa=self.A)
+        if self.executor is None:
+            list(map(solve, batches))
+        else:
+            list(self.executor.map(solve, batches))
+        self.Aa = self.A
 
 
 class SQRTENKF(ENKF):
@@ -84,32 +193,24 @@ class SQRTENKF(ENKF):
     def analysis(self, dists):
         """Perform the analysis step of the Ensemble Kalman Filter and return
         an updated state matrix, using the square root algorithm from Evensen (2004)."""
-        S = self.HA - np.mean(self.HA, axis=1)
-        U0, S0, V0 = np.linalg.svd(S)
+        S = self.HA - np.mean(self.HA, axis=1)[:, np.newaxis]
+        U0, S0, V0 = np.linalg.svd(S, full_matrices=False)
         S0 = 1.0 / S0
         i = np.where(np.cumsum(S0) / np.sum(S0) > 0.999)[0][0]
         S0[i:] = 0.0
-        S0 = np.mat(np.diag(S0))
-        U0 = np.mat(U0)
-        X0 = S0 * U0.T * self.E
+        X0 = (S0[:, np.newaxis] * U0.T).dot(self.E)
         U1, S1, V1 = np.linalg.svd(X0)
-        U1 = np.mat(U1)
-        X1 = U0 * S0.T * U1
-        y0 = X1.T * (self.d - np.mean(self.HA, axis=1))
-        S1i = np.mat(np.diag(1.0 / (1.0 + S1 ** 2.0)))
-        y2 = S1i * y0
-        y3 = X1 * y2
-        y4 = S.T * y3
-        Ap = self.A - np.mean(self.A, axis=1)
-        xa = np.mean(self.A, axis=1) + Ap * y4
-        S1q = np.mat(np.diag(np.sqrt(1.0 / (1.0 + S1 * S1))))
-        X2 = S1q * X1.T * S
+        X1 = (U0 * S0).dot(U1)
+        y0 = X1.T.dot(self.d - np.mean(self.HA, axis=1)[:, np.newaxis])
+        y4 = S.T.dot(X1.dot(y0 / (1.0 + S1 ** 2.0)[:, np.newaxis]))
+        Ap = self.A - np.mean(self.A, axis=1)[:, np.newaxis]
+        X2 = (np.sqrt(1.0 / (1.0 + S1 * S1))[:, np.newaxis] * X1.T).dot(S)
         U2, s2, V2 = np.linalg.svd(X2)
         _, _, Theta = np.linalg.svd(
             np.random.normal(0.0, 1.0, (self.nens, self.nens)))
-        S2 = np.mat(np.zeros((self.nobs, self.nens)))
-        S2[:self.nobs, :self.nobs] = np.mat(np.diag(s2))
-        S2[S2 < 0.0] = 0.0
-        I = np.mat(np.eye(self.nens))
-        Stheta = np.sqrt(I - S2.T * S2) * Theta
-        self.Aa = xa + Ap * V2.T * Stheta
+        # the singular values are the diagonal of S2, so only the rows of Theta are scaled
+        s = np.zeros(self.nens)
+        s[:len(s2)] = np.clip(s2, 0.0, None)
+        Stheta = np.sqrt(1.0 - s * s)[:, np.newaxis] * Theta
+        self.A[...] = np.mean(self.A, axis=1)[:, np.newaxis] + Ap.dot(y4 + V2.T.dot(Stheta))
+        self.Aa = self.A
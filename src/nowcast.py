@@ -13,7 +13,7 @@ import ensemble
 import sys
 import tempfile
 import shutil
-from assimilation import assimilate, observationDates
+from assimilation import assimilate, observationDates, Observations
 from datetime import date, timedelta
 import rpath
 import raster
@@ -53,8 +53,26 @@ def _initialize(vicoptions):
     return init, statefile
 
 
+def _droughtUpdate(vicoptions):
+    """Should drought indices be updated incrementally from the previous nowcast?"""
+    return 'drought update' in vicoptions and vicoptions['drought update'].strip().lower() == "incremental"
+
+
+def _droughtMemory(vicoptions):
+    """Memory budget (MB) for calculating drought indices in chunks of raster tiles."""
+    if 'drought memory' in vicoptions:
+        return float(vicoptions['drought memory'])
+    return None
+
+
+def _binaryState(vicoptions):
+    """Should the ensemble state files be kept in VIC's binary format between assimilation updates?"""
+    return 'state format' in vicoptions and vicoptions['state format'].strip().lower() == "binary"
+
+
 def runDeterministicVIC(dbname, options):
     """Driver function for performing a deterministic VIC nowcast simulation."""
+    log = logging.getLogger(__name__)
     res = config.getResolution(options['nowcast'])
     vicexe = "{0}/vicNl".format(rpath.bins)
     basin = config.getBasinFile(options['nowcast'])
@@ -74,8 +92,11 @@ def runDeterministicVIC(dbname, options):
     model.writeSoilFile(basin)
     prec, tmax, tmin, wind = model.getForcings(options['vic'])
     model.writeForcings(prec, tmax, tmin, wind)
-    model.run(vicexe)
-    model.save(saveto, savevars)
+    if len(ensemble.runModels([model], vicexe, 1)) > 0:
+        log.error("VIC simulation failed, exiting!")
+        sys.exit()
+    with dbio.writeBatch():
+        model.save(saveto, savevars, incremental=_droughtUpdate(options['vic']), memory=_droughtMemory(options['vic']))
     shutil.rmtree(path)
 
 
@@ -100,15 +121,15 @@ def runEnsembleVIC(dbname, options):
         nens = len(precipdatasets)
     models = ensemble.Ensemble(nens, dbname, res, startyear,
                                startmonth, startday, endyear, endmonth, endday, name)
+    models.setRunOptions(options['vic'])
     if 'initialize' in options['vic'] and options['vic']['initialize']:
         init_method = options['vic']['initialize']
         if isinstance(init_method, bool):
             init_method = "determ"
-        models.initialize(options, basin, init_method, vicexe)
     else:
-        models.writeSoilFiles(basin)
+        init_method = None
     if 'observations' in options['vic']:
-        method = "random"
+        method = "random" if init_method is None else init_method
         obsnames = options['vic']['observations'].split(",")
         if 'update' in options['vic']:
             update = options['vic']['update']
@@ -116,45 +137,38 @@ def runEnsembleVIC(dbname, options):
             update = None
         updateDates = observationDates(
             obsnames, dbname, startyear, startmonth, startday, endyear, endmonth, endday, update)
+        # spin up the ensemble once with the requested method, and keep the members
+        # warm between assimilation dates
+        models.initialize(options, basin, method, vicexe)
+        observations = Observations(options, models, date(startyear, startmonth, startday), date(endyear, endmonth, endday))
         t0 = date(startyear, startmonth, startday)
-        updateDates += [date(endyear, endmonth, endday)]
-        for t in updateDates:
-            if t0 == date(startyear, startmonth, startday):
-                overwrite = True
-            else:
-                overwrite = False
-            ndays = (date(t.year, t.month, t.day) - t0).days
-            t1 = t + timedelta(1)
-            models.setDates(t.year, t.month, t.day, t1.year, t1.month, t1.day)
-            models.initialize(options, basin, method, vicexe, saveindb=True,
-                              saveto=saveto, saveargs=savevars, initdays=ndays, overwrite=overwrite)
-            data, alat, alon, agid = assimilate(options, date(
-                models.startyear, models.startmonth, models.startday), models)
-            db = dbio.connect(models.dbname)
-            cur = db.cursor()
-            sql = "select tablename from pg_tables where schemaname='{0}'".format(
-                models.name)
-            cur.execute(sql)
-            tables = [tbl[0] for tbl in cur.fetchall() if tbl[0] != "dssat"]
-            for tbl in tables:
-                sql = "delete from {0}.{1} where fdate=date '{2}-{3}-{4}'".format(
-                    models.name, tbl, t.year, t.month, t.day)
-            cur.close()
-            db.close()
-            if bool(data):
-                models.updateStateFiles(data, alat, alon, agid)
-            t0 = date(t.year, t.month, t.day)
+        intervals = sorted(set(t for t in updateDates if t0 < t < date(endyear, endmonth, endday)) | set([date(endyear, endmonth, endday)]))
+        with dbio.writeBatch():
+            for i, t in enumerate(intervals):
+                models.runInterval(options, vicexe, t0, t, saveto=saveto, saveargs=savevars,
+                                   overwrite=i == 0, binarystate=_binaryState(options['vic']))
+                if t < date(endyear, endmonth, endday):
+                    data, alat, alon, agid = assimilate(options, t, models, observations=observations)
+                    if bool(data):
+                        models.updateStateFiles(data, alat, alon, agid)
+                t0 = t
     else:
+        if init_method is not None:
+            models.initialize(options, basin, init_method, vicexe)
+        else:
+            models.writeSoilFiles(basin)
         method = "random"
         t = date(endyear, endmonth, endday)
         t1 = t + timedelta(1)
         models.setDates(t.year, t.month, t.day, t1.year, t1.month, t1.day)
         ndays = (t - date(startyear, startmonth, startday)).days
-        models.initialize(options, basin, method, vicexe, saveindb=True,
-                          saveto=saveto, saveargs=savevars, initdays=ndays)
-    for varname in savevars:
-        raster.stddev(models.dbname, "{0}.{1}".format(
-            models.name, varname))
+        with dbio.writeBatch():
+            models.initialize(options, basin, method, vicexe, saveindb=True,
+                              saveto=saveto, saveargs=savevars, initdays=ndays)
+    if models.dbstatistics:
+        for varname in savevars:
+            raster.stddev(models.dbname, "{0}.{1}".format(
+                models.name, varname))
     for model in models:
         shutil.rmtree(model.model_path)
 
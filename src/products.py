@@ -0,0 +1,40 @@
+""" RHEAS module for generating probabilistic ensemble products.
+
+.. module:: products
+   :synopsis: Module that contains functionality for generating ensemble quantiles and probabilities
+
+.. moduleauthor:: Kostas Andreadis <kandread@jpl.nasa.gov>
+
+"""
+
+import numpy as np
+
+
+def _mask(out, data, nodata):
+    """Set *nodata* where any ensemble member of *data* is missing."""
+    if nodata is not None:
+        out[:, np.any(data == nodata, axis=0)] = nodata
+    return out
+
+
+def quantiles(data, q, nodata=None):
+    """Calculate the quantiles *q* (in percent) of the ensemble *data* along its first
+    dimension, interpolating linearly between members like :func:`numpy.percentile`.
+    Only the order statistics that are needed are selected with a partial sort.
+    Returns an array with a leading dimension of the same length as *q*."""
+    q = np.asarray(q, dtype='float')
+    pos = q / 100.0 * (data.shape[0] - 1)
+    lo = np.floor(pos).astype('int')
+    hi = np.ceil(pos).astype('int')
+    part = np.partition(data, np.unique(np.concatenate((lo, hi))), axis=0)
+    w = (pos - lo).reshape((-1,) + (1,) * (data.ndim - 1))
+    out = part[lo] * (1.0 - w) + part[hi] * w
+    return _mask(out, data, nodata)
+
+
+def probability(data, thresholds, nodata=None):
+    """Calculate the probability of the ensemble *data* falling below each of the
+    *thresholds*, as the fraction of members along its first dimension. Returns an
+    array with a leading dimension of the same length as *thresholds*."""
+    out = np.array([np.mean(data < t, axis=0) for t in thresholds])
+    return _mask(out, data, nodata)
@@ -59,7 +59,7 @@ def stddev(dbname, name):
             schemaname, tablename)
         cur.execute(sql)
         if bool(cur.rowcount):
-            cur.execute("drop table {0}_std".format(name))
+            cur.execute("drop table {0}_std cascade".format(name))
         sql = "create table {0}.{1}_std as ({2})".format(
             schemaname, tablename, ssql)
         cur.execute(sql)
@@ -84,7 +84,7 @@ def mean(dbname, name):
             schemaname, tablename)
         cur.execute(sql)
         if bool(cur.rowcount):
-            cur.execute("drop table {0}_mean".format(name))
+            cur.execute("drop table {0}_mean cascade".format(name))
         sql = "create table {0}.{1}_mean as ({2})".format(schemaname, tablename, ssql)
         cur.execute(sql)
     else:
@@ -7,5 +7,9 @@
 
 """
 
-from testnowcast import testNowcast
+from testnowcast import testNowcast, testEnsembleSpinup
 from testforecast import testForecast
+from testdrought import testDrought
+from testkalman import testKalman
+from teststate import testState
+from testproducts import testProducts
@@ -0,0 +1,96 @@
+""" RHEAS benchmarks for computationally intensive kernels.
+
+   :synopsis: Benchmarks for RHEAS kernels, run with python -m tests.benchmark [name]
+
+.. moduleauthor:: Kostas Andreadis <kandread@jpl.nasa.gov>
+
+"""
+
+import sys
+import time
+import numpy as np
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+import drought
+import kalman
+from testkalman import _enkfMatrix, _sqrtenkfMatrix
+
+
+def _timeit(fun, *args, **kwargs):
+    """Return wall-clock time of a function call in seconds."""
+    t0 = time.time()
+    fun(*args, **kwargs)
+    return time.time() - t0
+
+
+def drySpells(nt=3650, npix=50000):
+    """Benchmark dry spell detection on a 10-year x 50k-pixel cube."""
+    dry = np.random.rand(nt, npix) < 0.6
+    print("dryspells ({0} x {1}): {2:.2f} s".format(nt, npix, _timeit(drought._drySpells, dry, 14, 2)))
+
+
+def _letkfProblem(ndim, nens):
+    """Generate a synthetic assimilation problem with *ndim* state cells and *nens*
+    members, with observations on a grid 20 times coarser than the state."""
+    n = int(np.sqrt(ndim))
+    lat, lon = np.meshgrid(np.arange(n) * 0.01, np.arange(n) * 0.01)
+    xloc = np.vstack((lat.ravel(), lon.ravel())).T
+    yloc = xloc.reshape((n, n, 2))[::20, ::20].reshape((-1, 2)) + 0.005
+    A = np.random.rand(len(xloc), nens)
+    HA = np.random.rand(len(yloc), nens)
+    d = np.random.rand(len(yloc), 1)
+    E = 0.1 * np.random.randn(len(yloc), nens)
+    return xloc, yloc, A, HA, d, E
+
+
+def letkf(ndim=100000, nens=50, radius=0.5):
+    """Benchmark the localized LETKF analysis of 100k state cells x 50 members."""
+    xloc, yloc, A, HA, d, E = _letkfProblem(ndim, nens)
+    t0 = time.time()
+    dists = kalman.neighbours(xloc, yloc, radius)
+    print("neighbours ({0} x {1}, {2} pairs): {3:.2f} s".format(len(xloc), len(yloc), dists.nnz, time.time() - t0))
+    kf = kalman.LETKF(A, HA, d, E, radius)
+    print("letkf ({0} x {1}, {2} obs): {3:.2f} s".format(len(xloc), nens, len(yloc), _timeit(kf.analysis, dists)))
+
+
+def letkfScaling(ndim=100000, nens=50, radius=0.5):
+    """Benchmark the scaling of the localized LETKF analysis from 1 to N threads,
+    checking that the analysis does not depend on the number of threads."""
+    xloc, yloc, A, HA, d, E = _letkfProblem(ndim, nens)
+    dists = kalman.neighbours(xloc, yloc, radius)
+    Aa = None
+    nthreads = 1
+    while nthreads <= cpu_count():
+        pool = ThreadPool(nthreads)
+        kf = kalman.LETKF(A, HA, d, E, radius, pool)
+        t = _timeit(kf.analysis, dists)
+        pool.close()
+        if Aa is None:
+            Aa, t1 = kf.Aa, t
+        print("letkf ({0} threads): {1:.2f} s, speedup {2:.2f}, identical {3}".format(nthreads, t, t1 / t, np.array_equal(Aa, kf.Aa)))
+        nthreads *= 2
+
+
+def filters(ndim=100000, nens=50, nobs=40):
+    """Benchmark the global filters on 100k state cells x 50 members against their
+    matrix implementations, in double and single precision."""
+    A = np.random.rand(ndim, nens)
+    HA = A[:nobs] + 0.01 * np.random.randn(nobs, nens)
+    d = np.random.rand(nobs, 1)
+    E = 0.1 * np.random.randn(nobs, nens)
+    for method, reference in [("ENKF", _enkfMatrix), ("SQRTENKF", _sqrtenkfMatrix)]:
+        np.random.seed(1)
+        tm = _timeit(reference, A, HA, d, E)
+        for dtype in ['float64', 'float32']:
+            np.random.seed(1)
+            kf = getattr(kalman, method)(A, HA, d, E, dtype=dtype)
+            t = _timeit(kf.analysis, None)
+            print("{0} {1} ({2} x {3}, {4} obs): {5:.2f} s, matrix {6:.2f} s".format(method.lower(), dtype, ndim, nens, nobs, t, tm))
+
+
+benchmarks = {'filters': filters, 'dryspells': drySpells, 'letkf': letkf, 'letkfscaling': letkfScaling}
+
+
+if __name__ == '__main__':
+    for name in (sys.argv[1:] or sorted(benchmarks)):
+        benchmarks[name]()
@@ -0,0 +1,180 @@
+""" RHEAS drought testing suite.
+
+   :synopsis: Unit tests for RHEAS drought module
+
+.. moduleauthor:: Kostas Andreadis <kandread@jpl.nasa.gov>
+
+"""
+
+import unittest
+import numpy as np
+import pandas
+from datetime import date
+import drought
+
+
+def _drySpellsLoop(p, droughtfun=np.mean, duration=14, recovduration=2):
+    """Reference pixel-by-pixel implementation of the dry spell detector."""
+    ndroughts = np.zeros(p.shape)
+    for pi in range(p.shape[1]):
+        drought_thresh = droughtfun(p[:, pi])
+        days = 0
+        for i in range(recovduration-1, p.shape[0]):
+            if p[i, pi] <= drought_thresh:
+                days += 1
+            elif all(p[i-j, pi] > drought_thresh for j in range(recovduration)):
+                days = 0
+            else:
+                days += 1
+            if days == duration:
+                ndroughts[i, pi] = 1
+    return np.cumsum(ndroughts, axis=0)
+
+
+class _Model(object):
+    """Minimal model exposing the simulation period."""
+
+    def __init__(self, startdate, enddate):
+        self.startyear, self.startmonth, self.startday = startdate.year, startdate.month, startdate.day
+        self.endyear, self.endmonth, self.endday = enddate.year, enddate.month, enddate.day
+        self.skipyear = 0
+
+
+class testDrought(unittest.TestCase):
+
+    def setUp(self):
+        """Generate synthetic precipitation time series."""
+        rs = np.random.RandomState(42)
+        self.p = rs.gamma(0.5, 4.0, (730, 50)) * (rs.rand(730, 50) < 0.3)
+
+    def testDrySpells(self):
+        """Test vectorized dry spell detector against pixel loop."""
+        dry = self.p <= np.mean(self.p, axis=0)
+        for duration, recovduration in [(14, 2), (7, 1), (5, 3), (1, 2)]:
+            ndroughts = np.cumsum(drought._drySpells(dry, duration, recovduration, chunksize=16)[0], axis=0)
+            np.testing.assert_array_equal(ndroughts, _drySpellsLoop(self.p, duration=duration, recovduration=recovduration))
+
+    def testIncrementalDrySpells(self):
+        """Test that continuing dry spell counters reproduces a full calculation."""
+        dry = self.p <= np.mean(self.p, axis=0)
+        full, _ = drought._drySpells(dry, 14, 2)
+        first, days = drought._drySpells(dry[:400], 14, 2)
+        second, _ = drought._drySpells(dry[399:], 14, 2, days)
+        np.testing.assert_array_equal(np.vstack((first, second[1:])), full)
+
+    def testIncrementalStandardizedIndex(self):
+        """Test that continuing the moving average and gamma parameters reproduces
+        a full calculation of the standardized index."""
+        window = 90
+        pm, _ = drought._rollingMean(self.p, window)
+        params = np.array([drought.stats.gamma.fit(pm[window:, j]) for j in range(pm.shape[1])])
+        full = drought._standardizedIndex(pm, params, 0, window)
+        pm1, tail = drought._rollingMean(self.p[:60], window)
+        pm2, _ = drought._rollingMean(self.p[60:], window, tail)
+        inc = np.vstack((drought._standardizedIndex(pm1, params, 0, window), drought._standardizedIndex(pm2, params, 60, window)))
+        np.testing.assert_allclose(inc, full, atol=1e-8)
+
+    def testIncrementalSMDI(self):
+        """Test that continuing the SMDI recursion reproduces a full calculation."""
+        sm = 100.0 + np.cumsum(self.p - np.mean(self.p, axis=0), axis=0)
+        MSW, maxSW, minSW = np.median(sm, axis=0), np.max(sm, axis=0), np.min(sm, axis=0)
+        full = drought._smdi(sm, MSW, maxSW, minSW)
+        first = drought._smdi(sm[:300], MSW, maxSW, minSW)
+        second = drought._smdi(sm[300:], MSW, maxSW, minSW, sm[294:300], first[-1])
+        np.testing.assert_allclose(np.vstack((first, second)), full)
+
+    def testResumeStandardizedIndex(self):
+        """Test that a nowcast shorter than the SPI window resumes from the state
+        persisted by the previous incremental run, and is skipped without one."""
+        states = {}
+        dates = pandas.date_range("2001-1-1", periods=len(self.p))
+
+        def readState(model, varname, tiles=None):
+            if varname in states and (date(model.startyear, model.startmonth, model.startday) - states[varname][0]).days == 1:
+                return states[varname][1]
+            return None
+
+        def writeState(model, varname, tiles=None, **state):
+            states[varname] = (date(model.endyear, model.endmonth, model.endday), state)
+
+        def climatologyFrame(model, varname, layers=None, period=False, incremental=False, tiles=None):
+            st = date(model.startyear, model.startmonth, model.startday)
+            et = date(model.endyear, model.endmonth, model.endday)
+            return pandas.DataFrame(self.p, index=dates)[st:et]
+
+        patched = dict((f, getattr(drought, f)) for f in ["_readState", "_writeState", "_climatologyFrame"])
+        drought._readState, drought._writeState, drought._climatologyFrame = readState, writeState, climatologyFrame
+        try:
+            first = _Model(date(2001, 1, 1), date(2001, 12, 31))
+            drought.calcSPI(3, first)
+            self.assertEqual(len(states), 0)
+            second = _Model(date(2002, 1, 1), date(2002, 1, 20))
+            self.assertTrue(drought.calcSPI(3, second, incremental=True) is None)
+            drought.calcSPI(3, first, incremental=True)
+            spi = drought.calcSPI(3, second, incremental=True)
+        finally:
+            for f in patched:
+                setattr(drought, f, patched[f])
+        window = 90
+        pm, _ = drought._rollingMean(self.p[:365], window)
+        params = np.array([drought.stats.gamma.fit(pm[window:, j]) for j in range(pm.shape[1])])
+        pm, _ = drought._rollingMean(self.p[:385], window)
+        np.testing.assert_allclose(spi, drought._standardizedIndex(pm, params, 0, window)[365:], atol=1e-8)
+        self.assertEqual(states["rainf3"][0], date(2002, 1, 20))
+
+    def testSuctionHeadWithoutSoil(self):
+        """Test that pixels without a soil cell get no suction head."""
+        dates = pandas.date_range("2001-1-1", periods=60)
+        sm = pandas.DataFrame(50. + 100. * np.random.RandomState(1).rand(60, 3), index=dates)
+        model = _Model(date(2001, 1, 1), date(2001, 3, 1))
+        model.lat, model.lon, model.res = [0.5, 0.0], [0.0, 0.5], 0.5
+        patched = dict((f, getattr(drought, f)) for f in ["_climatologyFrame", "_loadClimatology", "_soilParameters"])
+        drought._climatologyFrame = lambda model, varname, layers=None, period=False, incremental=False, tiles=None: sm
+        drought._loadClimatology = lambda model, varname, layers=None, startdate=None, tiles=None: (None, None, (np.array([0, 0, 1]), np.array([0, 1, 1])))
+        drought._soilParameters = lambda model, Ksat, nlayers: (np.array([0.5, 0.5]), np.array([0.0, 0.5]), np.array([2, 5]), np.array([300., 500.]))
+        try:
+            pfz = drought._calcSuctionHead(model)
+        finally:
+            for f in patched:
+                setattr(drought, f, patched[f])
+        self.assertTrue(np.all(np.isfinite(pfz[:, :2])))
+        self.assertTrue(np.all(np.isnan(pfz[:, 2])))
+
+    def testEnsembleClimatology(self):
+        """Test that the climatology of an ensemble member is loaded from its own
+        rasters, instead of merging all members of ensemble tables."""
+        queries = []
+
+        class Cursor(object):
+            rowcount = 0
+
+            def execute(self, sql):
+                queries.append(sql)
+
+            def close(self):
+                pass
+
+        class Connection(object):
+
+            def cursor(self):
+                return Cursor()
+
+            def close(self):
+                pass
+
+        model = _Model(date(2001, 1, 1), date(2001, 12, 31))
+        model.dbname, model.name = "rheas", "basin"
+        patched = dict((f, getattr(drought.dbio, f)) for f in ["connect", "columnExists"])
+        drought.dbio.connect = lambda dbname: Connection()
+        drought.dbio.columnExists = lambda dbname, schemaname, tablename, colname: True
+        try:
+            drought._loadClimatology(model, "rainf")
+            model.ensemble = 2
+            drought._loadClimatology(model, "rainf")
+        finally:
+            for f in patched:
+                setattr(drought.dbio, f, patched[f])
+            drought.clearClimatology()
+        self.assertEqual(len(queries), 2)
+        self.assertFalse("ensemble" in queries[0])
+        self.assertTrue("where ensemble=2 group by fdate" in queries[1])
@@ -0,0 +1,176 @@
+""" RHEAS Kalman filter testing suite.
+
+   :synopsis: Unit tests for RHEAS Kalman filter module
+
+.. moduleauthor:: Kostas Andreadis <kandread@jpl.nasa.gov>
+
+"""
+
+import unittest
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from scipy.linalg import sqrtm
+from scipy.spatial.distance import cdist
+import kalman
+
+
+def _letkfLoop(A, HA, d, R, rho=1.05, weights=None):
+    """Reference implementation of the LETKF analysis updating one state element at a
+    time with the observation error variances localized by *weights*."""
+    ndim, nens = A.shape
+    X = A - np.mean(A, axis=1)[:, np.newaxis]
+    Y = HA - np.mean(HA, axis=1)[:, np.newaxis]
+    xa = A.copy()
+    for i in range(ndim):
+        w = np.ones(len(d)) if weights is None else weights[i]
+        ly = np.where(w > 0)[0]
+        if len(ly) > 0:
+            C = Y[ly].T.dot(np.diag(w[ly] / R[ly]))
+            P = np.linalg.pinv((nens - 1) * np.eye(nens) / rho + C.dot(Y[ly]))
+            W = np.real(sqrtm((nens - 1) * P)) + P.dot(C).dot(d[ly] - np.mean(HA[ly], axis=1))[:, np.newaxis]
+            xa[i] = X[i].dot(W) + np.mean(A[i])
+    return xa
+
+
+def _enkfMatrix(A, HA, d, E):
+    """Reference matrix implementation of the Ensemble Kalman Filter analysis."""
+    A, HA, d, E = map(np.asmatrix, (A, HA, d, E))
+    Dp = d + np.mean(E, axis=1) - HA
+    HAp = HA - np.mean(HA, axis=1)
+    U, S, V = np.linalg.svd(HAp + E)
+    i = np.where(np.cumsum(S) / np.sum(S[:A.shape[1]]) > 0.999)[0]
+    U = np.asmatrix(U[:, :A.shape[1]])
+    L1 = np.asmatrix(np.diag(1.0 / (S * S)))
+    L1[i] = 0.0
+    return np.asarray(A + (A - np.mean(A, axis=1)) * (HAp.T * (U * (L1 * U.T * Dp))))
+
+
+def _sqrtenkfMatrix(A, HA, d, E):
+    """Reference matrix implementation of the square root Ensemble Kalman Filter
+    analysis (Evensen, 2004)."""
+    A, HA, d, E = map(np.asmatrix, (A, HA, d, E))
+    nobs, nens = HA.shape
+    S = HA - np.mean(HA, axis=1)
+    U0, S0, V0 = np.linalg.svd(S)
+    S0 = 1.0 / S0
+    i = np.where(np.cumsum(S0) / np.sum(S0) > 0.999)[0][0]
+    S0[i:] = 0.0
+    S0 = np.asmatrix(np.diag(S0))
+    U0 = np.asmatrix(U0)
+    U1, S1, V1 = np.linalg.svd(S0 * U0.T * E)
+    X1 = U0 * S0.T * np.asmatrix(U1)
+    y4 = S.T * (X1 * (np.asmatrix(np.diag(1.0 / (1.0 + S1 ** 2.0))) * (X1.T * (d - np.mean(HA, axis=1)))))
+    Ap = A - np.mean(A, axis=1)
+    xa = np.mean(A, axis=1) + Ap * y4
+    X2 = np.asmatrix(np.diag(np.sqrt(1.0 / (1.0 + S1 * S1)))) * X1.T * S
+    U2, s2, V2 = np.linalg.svd(X2)
+    _, _, Theta = np.linalg.svd(np.random.normal(0.0, 1.0, (nens, nens)))
+    S2 = np.asmatrix(np.zeros((nobs, nens)))
+    S2[:nobs, :nobs] = np.asmatrix(np.diag(s2))
+    S2[S2 < 0.0] = 0.0
+    Stheta = np.sqrt(np.asmatrix(np.eye(nens)) - S2.T * S2) * Theta
+    return np.asarray(xa + Ap * np.asmatrix(V2).T * Stheta)
+
+
+class testKalman(unittest.TestCase):
+
+    def setUp(self):
+        """Generate synthetic state and observation ensembles on a grid."""
+        rs = np.random.RandomState(42)
+        self.nens = 20
+        lat, lon = np.meshgrid(np.arange(0, 3, 0.25), np.arange(0, 3, 0.25))
+        self.xloc = np.vstack((lat.ravel(), lon.ravel())).T
+        self.yloc = self.xloc[::5] + 0.1
+        self.A = 0.3 + 0.05 * rs.randn(len(self.xloc), self.nens)
+        self.HA = self.A[::5] + 0.01 * rs.randn(len(self.yloc), self.nens)
+        self.d = 0.32 + 0.01 * rs.randn(len(self.yloc), 1)
+        self.E = 0.02 * rs.randn(len(self.yloc), self.nens)
+        self.dists = cdist(self.xloc, self.yloc)
+
+    def testGaspariCohn(self):
+        """Test that the localization function decreases from one to zero at the radius."""
+        rho = kalman.gaspariCohn(np.linspace(0, 2, 201), 1.5)
+        self.assertAlmostEqual(rho[0], 1.0)
+        self.assertTrue(np.all(np.diff(rho) <= 1e-12))
+        self.assertTrue(np.all(rho[150:] < 1e-12))
+
+    def testGlobalLETKF(self):
+        """Test the batched LETKF without localization against the reference analysis."""
+        kf = kalman.LETKF(self.A, self.HA, self.d, self.E)
+        kf.analysis(self.dists)
+        np.testing.assert_allclose(kf.Aa, _letkfLoop(self.A, self.HA, self.d.ravel(), kf.R), atol=1e-10)
+
+    def testLocalizedLETKF(self):
+        """Test the localized LETKF against the reference analysis, and that state
+        elements without observations within the radius are not updated."""
+        radius = 0.6
+        kf = kalman.LETKF(self.A, self.HA, self.d, self.E, radius)
+        kf.batchsize = 7
+        kf.analysis(self.dists)
+        w = kalman.gaspariCohn(self.dists, radius)
+        np.testing.assert_allclose(kf.Aa, _letkfLoop(self.A, self.HA, self.d.ravel(), kf.R, weights=w), atol=1e-10)
+        far = np.all(self.dists >= radius, axis=1)
+        np.testing.assert_array_equal(kf.Aa[far], self.A[far])
+
+    def testNeighbours(self):
+        """Test that the sparse neighbour distances match the dense distances within
+        the radius, including co-located points, and give the same analysis."""
+        radius = 0.6
+        yloc = np.vstack((self.yloc, self.xloc[:1]))
+        nbrs = kalman.neighbours(self.xloc, yloc, radius)
+        dists = cdist(self.xloc, yloc)
+        i, j = np.nonzero(dists <= radius)
+        np.testing.assert_allclose(np.asarray(nbrs[i, j]).ravel(), dists[i, j])
+        self.assertEqual(nbrs.nnz, len(i))
+        HA = np.vstack((self.HA, self.A[:1]))
+        d = np.vstack((self.d, [[0.3]]))
+        E = np.vstack((self.E, self.E[:1]))
+        kf = kalman.LETKF(self.A, HA, d, E, radius)
+        kf.analysis(dists)
+        kfs = kalman.LETKF(self.A, HA, d, E, radius)
+        kfs.analysis(nbrs)
+        np.testing.assert_allclose(kfs.Aa, kf.Aa)
+
+    def testParallelLETKF(self):
+        """Test that local analyses distributed across threads reproduce the serial analysis."""
+        radius = 0.6
+        kf = kalman.LETKF(self.A, self.HA, self.d, self.E, radius)
+        kf.batchsize = 4
+        kf.analysis(self.dists)
+        pool = ThreadPool(3)
+        kfp = kalman.LETKF(self.A, self.HA, self.d, self.E, radius, pool)
+        kfp.batchsize = 4
+        kfp.analysis(self.dists)
+        pool.close()
+        np.testing.assert_array_equal(kfp.Aa, kf.Aa)
+
+    def testENKF(self):
+        """Test the Ensemble Kalman Filter against the reference matrix implementation."""
+        kf = kalman.ENKF(self.A, self.HA, self.d, self.E)
+        kf.analysis(None)
+        np.testing.assert_allclose(kf.Aa, _enkfMatrix(self.A, self.HA, self.d, self.E), atol=1e-10)
+        np.testing.assert_allclose(kf.R, np.diag(self.E.dot(self.E.T)) / (self.nens - 1))
+
+    def testSQRTENKF(self):
+        """Test the square root Ensemble Kalman Filter against the reference matrix
+        implementation. The random rotation of the perturbations in the null space of
+        the transform depends on round-off, so the analysis mean and covariance are
+        compared."""
+        HA, d, E = self.HA[:15], self.d[:15], self.E[:15]
+        np.random.seed(1)
+        kf = kalman.SQRTENKF(self.A, HA, d, E)
+        kf.analysis(None)
+        np.random.seed(1)
+        Aa = _sqrtenkfMatrix(self.A, HA, d, E)
+        np.testing.assert_allclose(np.mean(kf.Aa, axis=1), np.mean(Aa, axis=1), atol=1e-10)
+        np.testing.assert_allclose(np.cov(kf.Aa), np.cov(Aa), atol=1e-10)
+
+    def testSinglePrecision(self):
+        """Test that the filters with float32 ensembles are close to double precision."""
+        for method in ["ENKF", "LETKF"]:
+            kf = getattr(kalman, method)(self.A, self.HA, self.d, self.E, 0.6)
+            kf.analysis(self.dists)
+            kf32 = getattr(kalman, method)(self.A, self.HA, self.d, self.E, 0.6, dtype='float32')
+            kf32.analysis(self.dists)
+            self.assertEqual(kf32.Aa.dtype, np.float32)
+            np.testing.assert_allclose(kf32.Aa, kf.Aa, atol=1e-4)
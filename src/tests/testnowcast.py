@@ -12,6 +12,7 @@ import rpath
 import config
 import dbio
 import tempfile
+import os
 import tests.database
 
 
@@ -103,3 +104,67 @@ class testNowcast(unittest.TestCase):
         self.options['nowcast']['startdate'] = "2011-2-1"
         self.options['nowcast']['enddate'] = "2011-2-2"
         nowcast.execute(self.dbname, self.options)
+
+
+class _Ensemble(object):
+    """Ensemble that records how it is spun up instead of running VIC."""
+
+    def __init__(self, nens, dbname, resolution, startyear, startmonth, startday,
+                 endyear, endmonth, endday, name=""):
+        self.nens = nens
+        self.dbname = dbname
+        self.name = name
+        self.dbstatistics = False
+        self.spinups = []
+
+    def setRunOptions(self, vicoptions):
+        pass
+
+    def initialize(self, options, basin, method, vicexe, **kwargs):
+        self.spinups.append(method)
+
+    def writeSoilFiles(self, basin):
+        pass
+
+    def runInterval(self, *args, **kwargs):
+        pass
+
+    def __iter__(self):
+        return iter([])
+
+
+class testEnsembleSpinup(unittest.TestCase):
+
+    def setUp(self):
+        """Replace the ensemble and the observations of the nowcast module."""
+        self.ensembles = []
+
+        def Ensemble(*args, **kwargs):
+            self.ensembles.append(_Ensemble(*args, **kwargs))
+            return self.ensembles[-1]
+
+        self.patched = {'Ensemble': nowcast.ensemble.Ensemble, 'observationDates': nowcast.observationDates,
+                        'Observations': nowcast.Observations, 'assimilate': nowcast.assimilate}
+        nowcast.ensemble.Ensemble = Ensemble
+        nowcast.observationDates = lambda *args: []
+        nowcast.Observations = lambda *args: None
+        nowcast.assimilate = lambda *args, **kwargs: ({}, None, None, None)
+        fd, self.basin = tempfile.mkstemp(suffix=".shp")
+        os.close(fd)
+        self.options = {'nowcast': {'name': "basin", 'resolution': 0.25, 'basin': self.basin,
+                                    'startdate': "2011-1-1", 'enddate': "2011-1-2", 'model': "vic"},
+                        'vic': {'precip': "chirps", 'ensemble size': 2, 'observations': "smos", 'save to': "db", 'save': "rainf"}}
+
+    def tearDown(self):
+        nowcast.ensemble.Ensemble = self.patched.pop('Ensemble')
+        for name in self.patched:
+            setattr(nowcast, name, self.patched[name])
+        os.remove(self.basin)
+
+    def testAssimilationSpinup(self):
+        """Test that an assimilation ensemble is spun up once, with the requested method."""
+        nowcast.runEnsembleVIC("testdb", self.options)
+        self.assertEqual(self.ensembles[0].spinups, ["random"])
+        self.options['vic']['initialize'] = True
+        nowcast.runEnsembleVIC("testdb", self.options)
+        self.assertEqual(self.ensembles[1].spinups, ["determ"])
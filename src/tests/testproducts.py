@@ -0,0 +1,84 @@
+""" RHEAS ensemble products testing suite.
+
+   :synopsis: Unit tests for RHEAS ensemble products module
+
+.. moduleauthor:: Kostas Andreadis <kandread@jpl.nasa.gov>
+
+"""
+
+import unittest
+import numpy as np
+import products
+import ensemble
+
+
+class _Model(object):
+    """Model whose raster tables are lists of saved dates, replaced like the database."""
+
+    nodata = -9999.
+    dbname = "testdb"
+    name = "basin"
+
+    def __init__(self):
+        self.tables = {}
+
+    def writeToDB(self, data, dates, tablename, initialize, ensemble=False, skipsave=0):
+        rows = self.tables.setdefault(tablename, [])
+        if initialize:
+            rows[:] = [dt for dt in rows if dt not in dates[skipsave:]]
+        rows.extend(dates[skipsave:])
+
+
+class testProducts(unittest.TestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(3)
+        self.nodata = -9999.
+        self.data = rs.randn(15, 10, 2, 4, 5)
+        self.data[:, :, :, 0, 0] = self.nodata
+        self.data[4, :, :, 1, 2] = self.nodata
+
+    def testQuantiles(self):
+        """Test that the ensemble quantiles match the numpy percentiles."""
+        q = [0, 10, 25, 50, 90, 97.5, 100]
+        out = products.quantiles(self.data, q, self.nodata)
+        self.assertEqual(out.shape, (len(q),) + self.data.shape[1:])
+        np.testing.assert_allclose(out[:, :, :, 2:, :], np.percentile(self.data[:, :, :, 2:, :], q, axis=0))
+        self.assertTrue(np.all(out[:, :, :, 0, 0] == self.nodata))
+        self.assertTrue(np.all(out[:, :, :, 1, 2] == self.nodata))
+
+    def testProbability(self):
+        """Test the probability of the ensemble falling below thresholds."""
+        out = products.probability(self.data, [-1.0, 0.0, 1.5], self.nodata)
+        self.assertEqual(out.shape, (3,) + self.data.shape[1:])
+        for i, t in enumerate([-1.0, 0.0, 1.5]):
+            np.testing.assert_array_equal(out[i, :, :, 2:, :], (self.data[:, :, :, 2:, :] < t).sum(axis=0) / 15.0)
+        self.assertTrue(np.all(out[:, :, :, 1, 2] == self.nodata))
+
+    def testSaveStatisticsTwice(self):
+        """Test that saving the ensemble statistics of the same dates again replaces them."""
+        models = ensemble.Ensemble(0, "testdb", 0.25, 2011, 1, 1, 2011, 1, 10, "basin")
+        models.percentiles = [50]
+        model = _Model()
+        tableExists = ensemble.dbio.tableExists
+        ensemble.dbio.tableExists = lambda dbname, schemaname, tablename: False
+        try:
+            for _ in range(2):
+                models._saveStatistics(model, self.data, list(range(10)), "rainf", skipsave=1)
+        finally:
+            ensemble.dbio.tableExists = tableExists
+        self.assertEqual(sorted(model.tables), ["rainf_mean", "rainf_p50", "rainf_std"])
+        for tablename in model.tables:
+            self.assertEqual(sorted(model.tables[tablename]), list(range(1, 10)))
+
+    def testSaveProductsTwice(self):
+        """Test that saving the ensemble quantiles and probabilities of the same dates again replaces them."""
+        models = ensemble.Ensemble(0, "testdb", 0.25, 2011, 1, 1, 2011, 1, 10, "basin")
+        models.quantiles = [10, 90]
+        models.thresholds = {'rainf': [0.0]}
+        model = _Model()
+        for _ in range(2):
+            models._saveProducts(model, self.data, list(range(10)), "rainf")
+        self.assertEqual(sorted(model.tables), ["rainf_prob", "rainf_quantiles"])
+        for tablename in model.tables:
+            self.assertEqual(sorted(model.tables[tablename]), list(range(10)))
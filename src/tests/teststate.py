@@ -0,0 +1,222 @@
+""" RHEAS VIC state testing suite.
+
+   :synopsis: Unit tests for RHEAS VIC state module
+
+.. moduleauthor:: Kostas Andreadis <kandread@jpl.nasa.gov>
+
+"""
+
+import unittest
+import tempfile
+import shutil
+import os
+import filecmp
+import time
+import numpy as np
+from vic import state, parameters
+from vic.library import StateLibrary
+from datetime import date
+
+
+class _Model(object):
+    """Minimal model exposing the coordinates of each grid cell."""
+
+    def __init__(self, cells):
+        self.lgid = dict(((float(c), -float(c)), c) for c in cells)
+
+
+def _writeStateFile(filename, veg, bands, nlayer=3, nnodes=3):
+    """Write a synthetic VIC text state file, where every third cell is snow free."""
+    np.random.seed(7)
+    with open(filename, 'w') as fout:
+        fout.write("2015 1 1\n{0} {1}\n".format(nlayer, nnodes))
+        for k in sorted(veg):
+            nveg, nbands = len(veg[k]), len(bands[k])
+            fout.write("{0} {1} {2}".format(k, nveg, nbands) + "".join(" %f " % v for v in np.random.rand(2 * nnodes)) + "\n")
+            for vi in range(nveg + 1):
+                for bi in range(nbands):
+                    swq = 0.0 if k % 3 == 0 or np.random.rand() < 0.3 else np.random.rand() * 0.5
+                    line = "{0} {1}".format(vi, bi) + "".join(" %f" % v for v in 100 * np.random.rand(2 * nlayer))
+                    if vi < nveg:
+                        line += " %f" % np.random.rand()
+                    line += " %i %i %f %f" % (np.random.randint(100), swq > 0, float(swq > 0), swq)
+                    line += "".join(" %f" % v for v in np.random.randn(7)) + "".join(" %f" % v for v in np.random.randn(nnodes))
+                    fout.write(line + "\n")
+
+
+def _writeParameters(path, veg, bands):
+    """Write synthetic VIC vegetation and snow band parameter files."""
+    with open("{0}/vegparam.txt".format(path), 'w') as fout:
+        for k in sorted(veg):
+            fout.write("{0} {1}\n".format(k, len(veg[k])))
+            for vi, v in enumerate(veg[k]):
+                fout.write("{0} {1:f} 0.10 0.10 1.00 0.65 0.50 0.25\n".format(vi + 1, v))
+                fout.write("  " + " ".join(["1.000"] * 12) + "\n")
+    with open("{0}/snowbands.txt".format(path), 'w') as fout:
+        for k in sorted(bands):
+            fout.write("{0} {1} {2} {3}\n".format(k, " ".join("%f" % b for b in bands[k]), " ".join(
+                "%f" % (500 * (b + 1)) for b in range(len(bands[k]))), " ".join("%f" % b for b in bands[k])))
+
+
+class testState(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        rs = np.random.RandomState(11)
+        veg, bands = {}, {}
+        for k in range(1, 41):
+            veg[k] = rs.dirichlet(np.ones(rs.randint(1, 5)))[:-1] if k % 5 else np.zeros(0)
+            bands[k] = rs.dirichlet(np.ones(3))
+        _writeParameters(self.path, veg, bands)
+        self.veg = state.readVegetation("{0}/vegparam.txt".format(self.path))
+        self.bands, _ = state.readSnowbands("{0}/snowbands.txt".format(self.path))
+        self.tables = (parameters.vegetationTable("{0}/vegparam.txt".format(self.path)),
+                       parameters.snowbandTable("{0}/snowbands.txt".format(self.path)))
+        self.model = _Model(self.veg.keys())
+        cells = sorted(self.veg)[::2]
+        self.alat = [float(c) for c in cells]
+        self.alon = [-float(c) for c in cells]
+        self.xa = {'swe': np.where(np.arange(len(cells)) % 4 == 0, 0.0, 50 * rs.rand(len(cells)) - 5),
+                   'soil_moist': 300 * rs.rand(len(cells))}
+        self.filename = "{0}/vic.state".format(self.path)
+        _writeStateFile(self.filename, self.veg, self.bands)
+
+    def tearDown(self):
+        parameters.clear()
+        shutil.rmtree(self.path)
+
+    def _updateLines(self, filename):
+        """Update state file with the per-line functions."""
+        states, nlayer, nnodes, dateline = state.readStateFile(filename)
+        for var in ['swe', 'soil_moist']:
+            x = state.readVariable(self.model, states, self.alat, self.alon, self.veg, self.bands, nlayer, var)
+            states = state.updateVariable(self.model, states, x, self.xa[var], self.alat, self.alon, None, self.veg, self.bands, nlayer, var)
+        state.writeStateFile(filename, states, "{0}\n{1} {2}".format(dateline.strip(), nlayer, nnodes))
+
+    def _updateArrays(self, filename):
+        """Update state file with the structured state."""
+        states = state.StateFile(filename)
+        weights = states.weights(*self.tables)
+        for var in ['swe', 'soil_moist']:
+            cells = states.cellIndex(self.model, self.alat, self.alon)
+            x = states.read(var, cells, weights)
+            states.update(var, cells, x, self.xa[var])
+        states.write()
+        return states
+
+    def testRead(self):
+        """Test reading state variables."""
+        states, nlayer, _, _ = state.readStateFile(self.filename)
+        s = state.StateFile(self.filename)
+        cells = s.cellIndex(self.model, self.alat, self.alon)
+        for var in ['swe', 'soil_moist', 'snow_cover']:
+            x = state.readVariable(self.model, states, self.alat, self.alon, self.veg, self.bands, nlayer, var)
+            np.testing.assert_array_equal(s.read(var, cells, s.weights(*self.tables)), x)
+
+    def testParameters(self):
+        """Test the cached vegetation and snow band parameter tables."""
+        parameters.clear()
+        for filename in ["vegparam.txt", "snowbands.txt"]:
+            self.assertTrue(os.path.exists("{0}/{1}.npz".format(self.path, filename)))
+        veg = parameters.vegetationTable("{0}/vegparam.txt".format(self.path))
+        bands = parameters.snowbandTable("{0}/snowbands.txt".format(self.path))
+        self.assertEqual(sorted(veg.keys()), sorted(self.veg.keys()))
+        for k in self.veg:
+            np.testing.assert_array_equal(veg[k], self.veg[k])
+            np.testing.assert_array_equal(bands[k], self.bands[k])
+        self.assertEqual(bands.nbands, 3)
+        self.assertTrue(parameters.vegetationTable("{0}/vegparam.txt".format(self.path)) is veg)
+
+    def testUnchanged(self):
+        """Test that writing an unchanged state gives the same file as the per-line writer."""
+        states, nlayer, nnodes, dateline = state.readStateFile(self.filename)
+        state.writeStateFile("{0}/lines.state".format(self.path), states, "{0}\n{1} {2}".format(dateline.strip(), nlayer, nnodes))
+        state.StateFile(self.filename).write("{0}/copy.state".format(self.path))
+        self.assertTrue(filecmp.cmp("{0}/lines.state".format(self.path), "{0}/copy.state".format(self.path), shallow=False))
+
+    def testUpdate(self):
+        """Test that the structured update writes the same state file as the per-line update."""
+        shutil.copy(self.filename, "{0}/lines.state".format(self.path))
+        self._updateLines("{0}/lines.state".format(self.path))
+        self._updateArrays(self.filename)
+        self.assertTrue(filecmp.cmp(self.filename, "{0}/lines.state".format(self.path), shallow=False))
+
+    def testParallelUpdate(self):
+        """Test that updating the ensemble state files in parallel gives the same files as in serial."""
+        nens = 4
+        rs = np.random.RandomState(5)
+        data = dict((var, np.outer(self.xa[var], np.ones(nens)) * (0.5 + rs.rand(len(self.alat), nens))) for var in self.xa)
+        cellids = dict((var, [self.model.lgid[(lat, lon)] for lat, lon in zip(self.alat, self.alon)]) for var in data)
+        statefiles = {}
+        for nprocs in [1, 2]:
+            statefiles[nprocs] = ["{0}/vic.state.{1}.{2}".format(self.path, nprocs, e) for e in range(nens)]
+            for filename in statefiles[nprocs]:
+                shutil.copy(self.filename, filename)
+            state.updateStateFiles(statefiles[nprocs], data, cellids, self.tables[0], self.tables[1], nprocs)
+        for e in range(nens):
+            self.assertTrue(filecmp.cmp(statefiles[1][e], statefiles[2][e], shallow=False))
+        self.assertFalse(filecmp.cmp(statefiles[1][0], self.filename, shallow=False))
+
+    def testLinkedUpdate(self):
+        """Test that updating a state file linked to other ensemble members leaves theirs unchanged."""
+        shutil.copy(self.filename, "{0}/original.state".format(self.path))
+        os.link(self.filename, "{0}/linked.state".format(self.path))
+        self._updateArrays(self.filename)
+        self.assertTrue(filecmp.cmp("{0}/linked.state".format(self.path), "{0}/original.state".format(self.path), shallow=False))
+        self.assertFalse(filecmp.cmp(self.filename, "{0}/original.state".format(self.path), shallow=False))
+
+    def testLibrary(self):
+        """Test storing, retrieving and removing states in the spin-up state library."""
+        library = StateLibrary("{0}/library".format(self.path), "basin", 0.25, {'precip': "chirps", 'temperature': "ncep"})
+        self.assertTrue(library.get(date(2015, 1, 1), "determ", "{0}/copy.state".format(self.path)) is None)
+        library.put(date(2015, 1, 1), "determ", self.filename)
+        library.get(date(2015, 1, 1), "determ", "{0}/copy.state".format(self.path))
+        self.assertTrue(filecmp.cmp(self.filename, "{0}/copy.state".format(self.path), shallow=False))
+        self.assertTrue(library.get(date(2015, 1, 1), "90d2001", "{0}/copy.state".format(self.path)) is None)
+        library.maxsize = 0
+        library.collect()
+        self.assertTrue(library.get(date(2015, 1, 1), "determ", "{0}/copy.state".format(self.path)) is None)
+
+    def testLibraryBasins(self):
+        """Test that simulations with the same name over different basins do not share states."""
+        forcings = {'precip': "chirps", 'temperature': "ncep"}
+        library = StateLibrary("{0}/library".format(self.path), "basin", 0.25, forcings, [1, 2, 3])
+        library.put(date(2015, 1, 1), "determ", self.filename)
+        other = StateLibrary("{0}/library".format(self.path), "basin", 0.25, forcings, [1, 2, 4])
+        self.assertTrue(other.get(date(2015, 1, 1), "determ", "{0}/copy.state".format(self.path)) is None)
+        same = StateLibrary("{0}/library".format(self.path), "basin", 0.25, forcings, [3, 2, 1])
+        self.assertTrue(same.get(date(2015, 1, 1), "determ", "{0}/copy.state".format(self.path)) is not None)
+
+    def testLibraryExpiry(self):
+        """Test that states expire by the time they were added to the state library, and
+        that the least recently used ones are removed first."""
+        library = StateLibrary("{0}/library".format(self.path), "basin", 0.25, {'precip': "chirps", 'temperature': "ncep"})
+        library.put(date(2015, 1, 1), "determ", self.filename)
+        library.put(date(2015, 2, 1), "determ", self.filename)
+        old = library._filename(date(2015, 1, 1), "determ")
+        os.utime(old, (time.time() - 86400 * 3, time.time() - 86400 * 10))
+        os.utime(library._filename(date(2015, 2, 1), "determ"), (time.time() - 86400 * 2, time.time() - 86400 * 2))
+        # using a state does not make it younger, but makes it the most recently used
+        self.assertTrue(library.get(date(2015, 1, 1), "determ", "{0}/copy.state".format(self.path)) is not None)
+        library.maxsize = os.path.getsize(old) / (1024. * 1024.)
+        library.collect()
+        self.assertTrue(os.path.exists(old))
+        self.assertFalse(os.path.exists(library._filename(date(2015, 2, 1), "determ")))
+        library.maxage = 5
+        library.collect()
+        self.assertFalse(os.path.exists(old))
+
+    def testBinary(self):
+        """Test conversion to and updating of binary state files."""
+        text = state.StateFile(self.filename)
+        text.write("{0}/binary.state".format(self.path), binary=True)
+        self.assertTrue(state.isBinary("{0}/binary.state".format(self.path)))
+        binary = state.StateFile("{0}/binary.state".format(self.path))
+        np.testing.assert_array_equal(binary.data, text.data)
+        np.testing.assert_array_equal(binary.nodes, text.nodes)
+        text = self._updateArrays(self.filename)
+        binary = self._updateArrays("{0}/binary.state".format(self.path))
+        np.testing.assert_array_equal(binary.data, text.data)
+        np.testing.assert_array_equal(state.StateFile("{0}/binary.state".format(self.path)).data, text.data)
+        binary.write("{0}/text.state".format(self.path), binary=False)
+        np.testing.assert_allclose(state.StateFile("{0}/text.state".format(self.path)).data, text.data, atol=1e-6)
@@ -8,6 +8,8 @@
 """
 
 
-from vic import VIC
+from vic import VIC, droughtvars
 import output
 import state
+import parameters
+import library
@@ -0,0 +1,86 @@
+""" Module for the library of VIC spin-up states
+
+.. module:: library
+   :synopsis: Definition of the VIC state library module
+
+.. moduleauthor:: Kostas Andreadis <kandread@jpl.nasa.gov>
+
+"""
+
+import os
+import re
+import gzip
+import shutil
+import time
+import hashlib
+import logging
+
+
+def digest(text):
+    """Short hash of *text*, for keying states on values that do not fit in a file name."""
+    return hashlib.md5(text.encode("utf-8")).hexdigest()[:10]
+
+
+class StateLibrary(object):
+    """Library of VIC states generated by spin-up runs, stored compressed in *directory*
+    and keyed by simulation *name*, basin grid cells *gids*, resolution, forcing datasets,
+    date and member seed. States older than *maxage* days are removed, as well as the
+    least recently used ones when the library is larger than *maxsize* megabytes. The
+    age of a state is measured from when it was added (its modification time), and its
+    last use is its access time."""
+
+    def __init__(self, directory, name, res, forcings, gids=None, maxage=None, maxsize=None):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        forcing = "_".join(forcings[k] for k in sorted(forcings))
+        self.prefix = re.sub(r"[^\w.]", "-", "{0}_{1}_{2}".format(name, res, forcing))
+        if gids is not None:
+            # simulations with the same name can cover different basins
+            self.prefix += "_" + digest(",".join(str(g) for g in sorted(gids)))
+        self.maxage = maxage
+        self.maxsize = maxsize
+
+    def _filename(self, dt, seed):
+        return "{0}/{1}_{2:04d}{3:02d}{4:02d}_{5}.state.gz".format(self.directory, self.prefix, dt.year, dt.month, dt.day, seed)
+
+    def get(self, dt, seed, statefile):
+        """Write the state at date *dt* for *seed* to *statefile* if it is in the library.
+        Returns the state file, or None if the state has not been generated yet."""
+        log = logging.getLogger(__name__)
+        filename = self._filename(dt, seed)
+        if not os.path.exists(filename):
+            return None
+        with open(statefile, 'wb') as fout:
+            fin = gzip.open(filename, 'rb')
+            shutil.copyfileobj(fin, fout)
+            fin.close()
+        # mark as recently used, keeping the time the state was added
+        os.utime(filename, (time.time(), os.path.getmtime(filename)))
+        log.info("Using state {0} from the state library.".format(os.path.basename(filename)))
+        return statefile
+
+    def put(self, dt, seed, statefile):
+        """Add *statefile* as the state at date *dt* for *seed* to the library."""
+        filename = self._filename(dt, seed)
+        with open(statefile, 'rb') as fin:
+            fout = gzip.open(filename + ".tmp", 'wb')
+            shutil.copyfileobj(fin, fout)
+            fout.close()
+        os.rename(filename + ".tmp", filename)
+        self.collect()
+
+    def collect(self):
+        """Remove the states that are older than the maximum age, and the least recently
+        used states in excess of the maximum size."""
+        log = logging.getLogger(__name__)
+        files = [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith(".state.gz")]
+        files = sorted(files, key=os.path.getatime, reverse=True)
+        size = 0
+        for filename in files:
+            expired = self.maxage is not None and time.time() - os.path.getmtime(filename) > self.maxage * 86400
+            if expired or (self.maxsize is not None and size + os.path.getsize(filename) > self.maxsize * 1024 * 1024):
+                log.info("Removing state {0} from the state library.".format(os.path.basename(filename)))
+                os.remove(filename)
+            else:
+                size += os.path.getsize(filename)
@@ -0,0 +1,138 @@
+""" Module for the VIC vegetation and snow band parameter tables
+
+.. module:: parameters
+   :synopsis: Definition of the VIC parameter tables module
+
+.. moduleauthor:: Kostas Andreadis <kandread@jpl.nasa.gov>
+
+"""
+
+import os
+import logging
+import numpy as np
+import rpath
+import state
+
+
+_vegetation = {}
+_snowbands = {}
+_files = {}
+
+
+class Vegetation(object):
+    """Vegetation tile fractions of each grid cell, stored as flat arrays sorted by cell id."""
+
+    def __init__(self, cells, nveg, fractions, bare):
+        self.cells = cells
+        self.nveg = nveg
+        self.start = np.append(0, np.cumsum(nveg))
+        self.fractions = fractions
+        self.bare = bare
+
+    def index(self, cellids):
+        """Return the table index of grid cells *cellids*."""
+        return _index(self.cells, cellids)
+
+    def __getitem__(self, k):
+        i = self.index(k)
+        return self.fractions[self.start[i]:self.start[i + 1]]
+
+    def __contains__(self, k):
+        return k in self.cells
+
+    def keys(self):
+        return list(self.cells)
+
+
+class Snowbands(object):
+    """Area fractions and elevations of the snow bands of each grid cell, sorted by cell id."""
+
+    def __init__(self, cells, fractions, elevations):
+        self.cells = cells
+        self.fractions = fractions
+        self.elevations = elevations
+        self.nbands = fractions.shape[1]
+
+    def index(self, cellids):
+        """Return the table index of grid cells *cellids*."""
+        return _index(self.cells, cellids)
+
+    def __getitem__(self, k):
+        return self.fractions[self.index(k)]
+
+    def __contains__(self, k):
+        return k in self.cells
+
+    def keys(self):
+        return list(self.cells)
+
+
+def _index(cells, cellids):
+    i = np.searchsorted(cells, cellids)
+    if np.any(np.take(cells, i, mode='clip') != cellids):
+        raise KeyError("Grid cell(s) not found in VIC parameter table")
+    return i
+
+
+def _parseVegetation(filename):
+    veg = state.readVegetation(filename)
+    cells = np.array(sorted(veg), dtype='int')
+    return {'cells': cells, 'nveg': np.array([len(veg[k]) for k in cells], dtype='int'),
+            'fractions': np.concatenate([np.zeros(0)] + [veg[k] for k in cells]),
+            'bare': np.array([1.0 - sum(veg[k]) for k in cells])}
+
+
+def _parseSnowbands(filename):
+    bands, elev = state.readSnowbands(filename)
+    cells = np.array(sorted(bands), dtype='int')
+    return {'cells': cells, 'fractions': np.array([bands[k] for k in cells]),
+            'elevations': np.array([elev[k] for k in cells])}
+
+
+def _cached(filename, parse):
+    """Load the arrays parsed from *filename*, saving them next to it as a .npz file
+    that is used instead of the parameter file as long as it is newer."""
+    log = logging.getLogger(__name__)
+    cache = "{0}.npz".format(filename)
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(filename):
+        data = np.load(cache)
+        arrays = dict((k, data[k]) for k in data.files)
+        data.close()
+    else:
+        arrays = parse(filename)
+        try:
+            np.savez(cache, **arrays)
+        except (IOError, OSError):
+            log.warning("Could not save VIC parameter cache {0}.".format(cache))
+    return arrays
+
+
+def vegetationTable(filename):
+    """Return the vegetation table of VIC parameter file *filename*, parsed once per process."""
+    if filename not in _vegetation:
+        _vegetation[filename] = Vegetation(**_cached(filename, _parseVegetation))
+    return _vegetation[filename]
+
+
+def snowbandTable(filename):
+    """Return the snow band table of VIC parameter file *filename*, parsed once per process."""
+    if filename not in _snowbands:
+        _snowbands[filename] = Snowbands(**_cached(filename, _parseSnowbands))
+    return _snowbands[filename]
+
+
+def tables(model):
+    """Return the vegetation and snow band tables for the resolution of *model*."""
+    key = (model.dbname, model.res)
+    if key not in _files:
+        _, vegparam, snowbands = model.paramFromDB()
+        _files[key] = ("{0}/{1}".format(rpath.data, vegparam), "{0}/{1}".format(rpath.data, snowbands))
+    vegfile, snowbandfile = _files[key]
+    return vegetationTable(vegfile), snowbandTable(snowbandfile)
+
+
+def clear():
+    """Clear the parameter tables loaded in this process."""
+    _vegetation.clear()
+    _snowbands.clear()
+    _files.clear()
@@ -9,9 +9,15 @@
 
 
 from collections import OrderedDict
+import os
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
 import numpy as np
 
 
+_shared = {}
+
+
 def readStateFile(filename):
     """Reads VIC initial state file."""
     state = OrderedDict()
@@ -100,7 +106,7 @@ def readSnowbands(filename):
     with open(filename) as fin:
         for line in fin:
             data = line.split()
-            nbands = (len(data) - 1) / 3
+            nbands = (len(data) - 1) // 3
             bands[int(data[0])] = np.array(data[1:nbands + 1], 'float')
             elev[int(data[0])] = np.array(
                 data[nbands + 1:2 * nbands + 1], 'float')
@@ -169,8 +175,306 @@ def updateVariable(model, state, x, xa, alat, alon, agid, veg, bands, nlayer, va
 
 def writeStateFile(filename, state, header):
     """Write state file after updating variable."""
-    with open(filename, 'w') as fout:
+    with open(filename + ".tmp", 'w') as fout:
         fout.write("{0}\n".format(header))
         for k in state.keys():
             for line in state[k]:
                 fout.write("{0}\n".format(line.strip()))
+    os.rename(filename + ".tmp", filename)
+
+
+class StateFile(object):
+    """Structured representation of a VIC state file, parsed once into numpy arrays
+    with one row per (cell, vegetation, snow band) record and one column per state
+    field. Bare soil records get an empty dew column so that all records share the
+    same columns. Both the text and the binary VIC state formats are supported."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.binary = isBinary(filename)
+        if self.binary:
+            self._readBinary(filename)
+        else:
+            self._readText(filename)
+        self._index = dict(zip(self.cells, range(len(self.cells))))
+        self.dirty = np.zeros(len(self.data), dtype='bool')
+
+    def _columns(self, nlayer, nnodes):
+        """Set the column of each state field."""
+        self.nlayer, self.nnodes = nlayer, nnodes
+        self.MOIST = 2
+        self.DEW = 2 + 2 * nlayer
+        self.MELTING = 4 + 2 * nlayer
+        self.COVERAGE = 5 + 2 * nlayer
+        self.SWQ = 6 + 2 * nlayer
+        self.nfields = 14 + 2 * nlayer + nnodes
+
+    def _records(self, cells, nveg, nbands):
+        """Index the records of each cell by cell, vegetation and snow band."""
+        self.cells = np.array(cells, dtype='int')
+        self.nveg = np.array(nveg, dtype='int')
+        self.nbands = np.array(nbands, dtype='int')
+        nrec = (self.nveg + 1) * self.nbands
+        self.start = np.append(0, np.cumsum(nrec))
+        self.rcell = np.repeat(np.arange(len(self.cells)), nrec)
+        r = np.arange(self.start[-1]) - self.start[self.rcell]
+        self.rveg = r // self.nbands[self.rcell]
+        self.rband = r % self.nbands[self.rcell]
+        self.bare = self.rveg == self.nveg[self.rcell]
+
+    def _readText(self, filename):
+        with open(filename) as fin:
+            self.dateline = fin.readline().strip()
+            nlayer, nnodes = map(int, fin.readline().split())
+            lines = [l for l in fin.read().splitlines() if l.strip()]
+        self._columns(nlayer, nnodes)
+        cells, nveg, nbands, self.headers, self.lines = [], [], [], [], []
+        c = 0
+        while c < len(lines):
+            cellid, nv, nb = map(int, lines[c].split()[:3])
+            cells.append(cellid)
+            nveg.append(nv)
+            nbands.append(nb)
+            self.headers.append(lines[c].strip())
+            self.lines += [l.strip() for l in lines[c + 1:c + (nv + 1) * nb + 1]]
+            c += (nv + 1) * nb + 1
+        self._records(cells, nveg, nbands)
+        self.nodes = np.array([h.split()[3:3 + 2 * nnodes] for h in self.headers], dtype='float').reshape(-1, 2 * nnodes)
+        self.extra = None
+        self.tokens = np.empty((len(self.lines), self.nfields), dtype='object')
+        self.data = np.zeros((len(self.lines), self.nfields))
+        bcols = np.array([j for j in range(self.nfields) if j != self.DEW])
+        for rows, cols in [(np.where(~self.bare)[0], np.arange(self.nfields)), (np.where(self.bare)[0], bcols)]:
+            tokens = " ".join(self.lines[i] for i in rows).split()
+            self.tokens[np.ix_(rows, cols)] = np.array(tokens, dtype='object').reshape(len(rows), len(cols))
+            self.data[np.ix_(rows, cols)] = np.array(tokens, dtype='float').reshape(len(rows), len(cols))
+
+    def _recordTypes(self):
+        """Binary layout of vegetation and bare soil records (see write_model_state.c)."""
+        fields = [('veg', 'i4'), ('band', 'i4'), ('moist', 'f8', (self.nlayer,)), ('ice', 'f8', (self.nlayer,)),
+                  ('dew', 'f8'), ('last_snow', 'i4'), ('melting', 'i1'), ('snow', 'f8', (9,)), ('T', 'f8', (self.nnodes,))]
+        return np.dtype(fields), np.dtype([f for f in fields if f[0] != 'dew'])
+
+    def _readBinary(self, filename):
+        with open(filename, 'rb') as fin:
+            raw = fin.read()
+        year, month, day, nlayer, nnodes = np.frombuffer(raw, 'i4', 5)
+        self.dateline = "{0} {1} {2}".format(year, month, day)
+        self._columns(nlayer, nnodes)
+        vtype, btype = self._recordTypes()
+        cells, nveg, nbands, nodes, vrecs, brecs, self.extra = [], [], [], [], [], [], []
+        offset = 20
+        while offset < len(raw):
+            cellid, nv, nb, nbytes = np.frombuffer(raw, 'i4', 4, offset)
+            offset += 16
+            end = offset + nbytes
+            cells.append(cellid)
+            nveg.append(nv)
+            nbands.append(nb)
+            nodes.append(np.frombuffer(raw, 'f8', 2 * nnodes, offset))
+            offset += 16 * nnodes
+            vrecs.append(np.frombuffer(raw, vtype, nv * nb, offset))
+            offset += vtype.itemsize * nv * nb
+            brecs.append(np.frombuffer(raw, btype, nb, offset))
+            offset += btype.itemsize * nb
+            # lake records are kept as they are
+            self.extra.append(raw[offset:end])
+            offset = end
+        self._records(cells, nveg, nbands)
+        self.nodes = np.array(nodes).reshape(-1, 2 * nnodes)
+        self.headers = self.lines = self.tokens = None
+        self.data = np.zeros((self.start[-1], self.nfields))
+        for rows, recs in [(~self.bare, vrecs), (self.bare, brecs)]:
+            recs = np.concatenate(recs)
+            dew = recs['dew'] if 'dew' in recs.dtype.names else np.zeros(len(recs))
+            self.data[rows] = np.column_stack([recs['veg'], recs['band'], recs['moist'], recs['ice'], dew,
+                                               recs['last_snow'], recs['melting'], recs['snow'], recs['T']])
+
+    def cellIndex(self, model, alat, alon):
+        """Return the state file index of the cells at coordinates *alat*, *alon*."""
+        return self.index([model.lgid[(alat[i], alon[i])] for i in range(len(alat))])
+
+    def index(self, cellids):
+        """Return the state file index of grid cells *cellids*."""
+        return np.array([self._index[k] for k in cellids], dtype='int')
+
+    def weights(self, veg, bands):
+        """Area fraction of each record from the vegetation and snow band tables
+        (see :mod:`vic.parameters`)."""
+        i = veg.index(self.cells)[self.rcell]
+        vf = np.zeros(len(self.data))
+        vf[~self.bare] = veg.fractions[veg.start[i[~self.bare]] + self.rveg[~self.bare]]
+        vf[self.bare] = veg.bare[i[self.bare]]
+        return vf * bands.fractions[bands.index(self.cells)[self.rcell], self.rband]
+
+    def read(self, varname, cells, weights):
+        """Read area-averaged variable for state file *cells*."""
+        if varname == 'swe':
+            values = self.data[:, self.SWQ] * 1000.0
+        elif varname == 'snow_cover':
+            values = self.data[:, self.COVERAGE]
+        else:
+            values = self.data[:, self.MOIST:self.MOIST + self.nlayer].sum(axis=1)
+        out = np.bincount(self.rcell, weights=weights * values, minlength=len(self.cells))
+        return out[cells].reshape(-1, 1)
+
+    def _set(self, rows, col, tokens):
+        """Set field *col* of *rows* to formatted values *tokens*."""
+        tokens = np.asarray(tokens, dtype='object')
+        self.data[rows, col] = tokens.astype('float')
+        if self.tokens is not None:
+            self.tokens[rows, col] = tokens
+
+    def update(self, varname, cells, x, xa):
+        """Update variable for state file *cells* from its prior *x* to the analysis *xa*."""
+        x = np.asarray(x, dtype='float').ravel()
+        xa = np.asarray(xa, dtype='float').ravel()
+        obs = -np.ones(len(self.cells), dtype='int')
+        obs[cells] = np.arange(len(cells))
+        i = obs[self.rcell]
+        rows = np.where(i >= 0)[0]
+        x, xa = x[i[rows]], xa[i[rows]]
+        if varname == 'swe':
+            self._updateSwe(rows, x, xa)
+        elif varname == 'soil_moist':
+            self._updateSoilMoist(rows[x != 0.0], x[x != 0.0], xa[x != 0.0])
+
+    def _updateSwe(self, rows, x, xa):
+        k = self.SWQ
+        xa = np.where(xa < 0.0, 0.0, xa)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            s = np.where(x == 0.0, xa / 1000.0, self.data[rows, k] * xa / x)
+        melted = xa == 0.0
+        for col in [k - 1] + list(range(k + 1, k + 7)):
+            self._set(rows[melted], col, np.repeat("0.0", melted.sum()))
+        self._set(rows[melted], k - 2, np.repeat("0", melted.sum()))
+        snowed = (xa > 0.0) & (x == 0.0)
+        self._set(rows[snowed], k - 1, np.repeat("1.0", snowed.sum()))
+        self._set(rows[snowed], k + 5, np.repeat("150.0", snowed.sum()))
+        self._set(rows[snowed], k + 6, [str(np.float64(v)) for v in -2102. * 1000. * s[snowed] * 273.15])
+        self._set(rows, k, np.char.mod("%.6f", s))
+        self.dirty[rows] = True
+
+    def _updateSoilMoist(self, rows, x, xa):
+        for l in range(self.nlayer):
+            self._set(rows, self.MOIST + l, np.char.mod("%.6f", self.data[rows, self.MOIST + l] * xa / x))
+        self.dirty[rows] = True
+
+    def _recordLines(self):
+        """Format the text lines of all records, keeping the original text of the unchanged ones."""
+        if self.lines is not None:
+            lines = list(self.lines)
+            for i in np.where(self.dirty)[0]:
+                tokens = self.tokens[i] if not self.bare[i] else np.delete(self.tokens[i], self.DEW)
+                lines[i] = " ".join(tokens)
+        else:
+            vfmt = " ".join(["%d %d"] + ["%f"] * (2 * self.nlayer + 1) + ["%d %d"] + ["%f"] * (9 + self.nnodes))
+            bfmt = " ".join(["%d %d"] + ["%f"] * (2 * self.nlayer) + ["%d %d"] + ["%f"] * (9 + self.nnodes))
+            lines = [bfmt % tuple(np.delete(r, self.DEW)) if b else vfmt % tuple(r) for r, b in zip(self.data, self.bare)]
+        return lines
+
+    def _writeText(self, fout):
+        fout.write("{0}\n{1} {2}\n".format(self.dateline, self.nlayer, self.nnodes))
+        lines = self._recordLines()
+        for c in range(len(self.cells)):
+            if self.headers is not None:
+                header = self.headers[c]
+            else:
+                header = " ".join(["{0} {1} {2}".format(self.cells[c], self.nveg[c], self.nbands[c])] + ["%f" % v for v in self.nodes[c]])
+            fout.write("{0}\n".format(header))
+            for line in lines[self.start[c]:self.start[c + 1]]:
+                fout.write("{0}\n".format(line))
+
+    def _writeBinary(self, fout):
+        fout.write(np.array(list(map(int, self.dateline.split())) + [self.nlayer, self.nnodes], dtype='i4').tobytes())
+        vtype, btype = self._recordTypes()
+        recs = {}
+        for rtype, rows in [(vtype, ~self.bare), (btype, self.bare)]:
+            data = self.data[rows]
+            rec = np.zeros(len(data), dtype=rtype)
+            rec['veg'], rec['band'] = data[:, 0], data[:, 1]
+            rec['moist'] = data[:, self.MOIST:self.MOIST + self.nlayer]
+            rec['ice'] = data[:, self.MOIST + self.nlayer:self.DEW]
+            if 'dew' in rtype.names:
+                rec['dew'] = data[:, self.DEW]
+            rec['last_snow'], rec['melting'] = data[:, self.DEW + 1], data[:, self.MELTING]
+            rec['snow'] = data[:, self.COVERAGE:self.COVERAGE + 9]
+            rec['T'] = data[:, self.COVERAGE + 9:]
+            recs[rtype] = rec
+        v = b = 0
+        for c in range(len(self.cells)):
+            nv, nb = self.nveg[c] * self.nbands[c], self.nbands[c]
+            extra = self.extra[c] if self.extra is not None else b""
+            nbytes = 16 * self.nnodes + nv * vtype.itemsize + nb * btype.itemsize + len(extra)
+            fout.write(np.array([self.cells[c], self.nveg[c], self.nbands[c], nbytes], dtype='i4').tobytes())
+            fout.write(self.nodes[c].astype('f8').tobytes())
+            fout.write(recs[vtype][v:v + nv].tobytes())
+            fout.write(recs[btype][b:b + nb].tobytes())
+            fout.write(extra)
+            v += nv
+            b += nb
+
+    def write(self, filename=None, binary=None):
+        """Write the state file in one pass, to *filename* (defaults to the file read) and
+        in the binary or text format (defaults to the format read)."""
+        if filename is None:
+            filename = self.filename
+        if binary is None:
+            binary = self.binary
+        # replace the file instead of writing in place, since state files can be
+        # linked to the ones of other ensemble members
+        if binary:
+            with open(filename + ".tmp", 'wb') as fout:
+                self._writeBinary(fout)
+        else:
+            with open(filename + ".tmp", 'w') as fout:
+                self._writeText(fout)
+        os.rename(filename + ".tmp", filename)
+
+
+def isBinary(filename):
+    """Is *filename* a binary VIC state file? Text state files start with the state date."""
+    with open(filename, 'rb') as fin:
+        head = fin.read(20)
+    return any(c not in bytearray(b"0123456789 \t\r\n") for c in bytearray(head))
+
+
+def _initUpdate(data, veg, bands):
+    """Attach the analysis shared by all state file updates."""
+    _shared['data'] = [(var, cellids, np.ctypeslib.as_array(xa).reshape(len(cellids), -1)) for var, cellids, xa in data]
+    _shared['veg'] = veg
+    _shared['bands'] = bands
+
+
+def _updateStateFile(args):
+    """Update the state file of ensemble member *e* with the shared analysis."""
+    e, statefile = args
+    states = StateFile(statefile)
+    weights = states.weights(_shared['veg'], _shared['bands'])
+    for var, cellids, xa in _shared['data']:
+        cells = states.index(cellids)
+        x = states.read(var, cells, weights)
+        states.update(var, cells, x, xa[:, e])
+    states.write()
+
+
+def updateStateFiles(statefiles, data, cellids, veg, bands, nprocs=1):
+    """Update the state files of the ensemble members with the analysis *data*
+    (a dictionary of arrays with one column per member) of each variable at
+    grid cells *cellids*. Members are updated by a pool of *nprocs* processes,
+    one member per task, with the analysis in shared memory."""
+    shared = []
+    for var in data:
+        xa = RawArray('d', data[var].size)
+        np.ctypeslib.as_array(xa)[:] = np.asarray(data[var], dtype='float64').ravel()
+        shared.append((var, cellids[var], xa))
+    if nprocs > 1 and len(statefiles) > 1:
+        pool = Pool(min(nprocs, len(statefiles)), _initUpdate, (shared, veg, bands))
+        pool.map(_updateStateFile, enumerate(statefiles))
+        pool.close()
+        pool.join()
+    else:
+        _initUpdate(shared, veg, bands)
+        for args in enumerate(statefiles):
+            _updateStateFile(args)
+    _shared.clear()
@@ -9,10 +9,12 @@
 
 from __future__ import division
 import output as vicoutput
+import parameters
 from osgeo import ogr, gdal, osr
 import decimal
 import sys
 import subprocess
+import threading
 import os
 import string
 from datetime import date, datetime, timedelta
@@ -29,6 +31,12 @@ from raster import TileReader
 import logging
 
 
+_basins = {}
+
+droughtvars = ["spi1", "spi3", "spi6", "spi12", "sri1", "sri3", "sri6", "sri12", "severity", "dryspells", "smdi", "cdi"]
+layervars = ["soil_moist", "soil_temp", "smliqfrac", "smfrozfrac"]
+
+
 class VIC:
 
     def __init__(self, path, dbname, resolution, startyear, startmonth, startday,
@@ -50,6 +58,8 @@ class VIC:
         self.enddate = datetime(endyear, endmonth, endday)
         self.nlayers = nlayer
         self.dbname = dbname
+        # ensemble member number of the model's output in the database, if any
+        self.ensemble = None
         db = dbio.connect(dbname)
         cur = db.cursor()
         cur.execute(
@@ -83,20 +93,18 @@ class VIC:
 
     def _getSnowbands(self, snowbands):
         """Find number of snow bands from file."""
-        filename = "{0}/{1}".format(rpath.data, snowbands)
-        with open(filename) as f:
-            line = f.readline()
-        return int((len(line.split()) - 1) / 3)
+        return parameters.snowbandTable("{0}/{1}".format(rpath.data, snowbands)).nbands
 
-    def writeSoilFile(self, shapefile):
-        """Write soil parameter file for current simulation based on basin shapefile."""
-        ds = ogr.Open(shapefile)
-        lyr = ds.GetLayer()
+    def _loadBasin(self, shapefile):
+        """Load the grid cells of the basin from the database, creating the basin table from
+        *shapefile* for a new simulation."""
         db = dbio.connect(self.dbname)
         cur = db.cursor()
         cur.execute(
             "select * from information_schema.tables where table_name='basin' and table_schema=%s", (self.name,))
         if not bool(cur.rowcount):
+            ds = ogr.Open(shapefile)
+            lyr = ds.GetLayer()
             temptable = ''.join(random.SystemRandom().choice(
                 string.ascii_letters) for _ in range(8))
             cur.execute(
@@ -129,20 +137,29 @@ class VIC:
         sql = "select line,gid,st_y(geom),st_x(geom),elev,depths from {0}.basin order by gid".format(
             self.name)
         cur.execute(sql)
-        lines = cur.fetchall()
-        with open(self.model_path + '/soil.txt', 'w') as fout:
-            for line in lines:
-                gid, lat, lon, elev, depths = line[1:]
-                fout.write("{0}\n".format(line[0]))
-                self.lat.append(lat)
-                self.lon.append(lon)
-                self.gid[gid] = (lat, lon)
-                self.lgid[(lat, lon)] = gid
-                self.depths[gid] = depths
-                self.elev[gid] = elev
-        cur.execute("alter table {0}.basin drop column line".format(self.name))
+        rows = cur.fetchall()
         cur.close()
         db.close()
+        basin = {'soil': "".join("{0}\n".format(r[0]) for r in rows), 'lat': [r[2] for r in rows], 'lon': [r[3] for r in rows],
+                 'gid': OrderedDict((r[1], (r[2], r[3])) for r in rows), 'lgid': OrderedDict(((r[2], r[3]), r[1]) for r in rows),
+                 'depths': OrderedDict((r[1], r[5]) for r in rows), 'elev': OrderedDict((r[1], r[4]) for r in rows)}
+        return basin
+
+    def writeSoilFile(self, shapefile):
+        """Write soil parameter file for current simulation based on basin shapefile.
+        The basin grid cells are loaded once per simulation and shared by all models."""
+        key = (self.dbname, self.name, self.res)
+        if key not in _basins:
+            _basins[key] = self._loadBasin(shapefile)
+        basin = _basins[key]
+        with open(self.model_path + '/soil.txt', 'w') as fout:
+            fout.write(basin['soil'])
+        self.lat = list(basin['lat'])
+        self.lon = list(basin['lon'])
+        self.gid = OrderedDict(basin['gid'])
+        self.lgid = OrderedDict(basin['lgid'])
+        self.depths = OrderedDict(basin['depths'])
+        self.elev = OrderedDict(basin['elev'])
 
     def stateFile(self):
         """Retrieve state file path from database."""
@@ -198,7 +215,7 @@ class VIC:
         cur.close()
         db.close()
 
-    def writeParamFile(self, nodes=3, time_step=24, save_state="", init_state=False, state_file="", save_state_to_db=False):
+    def writeParamFile(self, nodes=3, time_step=24, save_state="", init_state=False, state_file="", save_state_to_db=False, binary_state=False):
         """Write VIC global parameter file for current simulation."""
         db = dbio.connect(self.dbname)
         cur = db.cursor()
@@ -253,7 +270,7 @@ class VIC:
                 self.endyear, self.endmonth, self.endday)
             if save_state_to_db:
                 self._stateToDb(save_state)
-        fout.write("BINARY_STATE_FILE\tFALSE\n")
+        fout.write("BINARY_STATE_FILE\t{0}\n".format("TRUE" if binary_state else "FALSE"))
         fout.write(
             "FORCING1\t{0:s}/data_\n".format(self.model_path + "/forcings"))
         fout.write("FORCE_FORMAT\tASCII\nFORCE_ENDIAN\tLITTLE\nN_TYPES\t4\n")
@@ -373,46 +390,66 @@ class VIC:
         self.wind = options['wind']
         return data['precip'], data['tmax'], data['tmin'], data['wind']
 
-    def writeForcings(self, prec, tmax, tmin, wind, lai=None):
-        """Write VIC meteorological forcing data files."""
+    def forcingArrays(self, *data):
+        """Convert meteorological forcings retrieved from the database (lists of
+        (gid, date, value) rows ordered by grid cell) to (cell, day) arrays starting
+        from the earliest date, with missing values set to NaN. Returns the grid cell
+        ids and an array for each forcing variable."""
+        gids = np.array(list(OrderedDict.fromkeys(r[0] for r in data[0])), dtype='int')
+        cells = dict(zip(gids, range(len(gids))))
+        t0 = min(r[1] for r in data[0])
+        ndays = (max(r[1] for r in data[0]) - t0).days + 1
+        arrays = []
+        for d in data:
+            a = np.full((len(gids), ndays), np.nan)
+            a[[cells[r[0]] for r in d], [(r[1] - t0).days for r in d]] = [r[2] for r in d]
+            arrays.append(a)
+        return [gids] + arrays
+
+    def writeForcings(self, prec, tmax, tmin, wind, lai=None, gids=None):
+        """Write VIC meteorological forcing data files. The forcings are either lists of
+        (gid, date, value) rows from the database or, if the grid cell ids *gids* are
+        given, (cell, day) arrays."""
         log = logging.getLogger(__name__)
         if not os.path.exists(self.model_path + '/forcings'):
             os.mkdir(self.model_path + '/forcings')
         ndays = (date(self.endyear, self.endmonth, self.endday) -
                  date(self.startyear, self.startmonth, self.startday)).days + 1
         try:
-            assert len(prec) == len(self.lat) * ndays and len(tmax) == len(self.lat) * ndays and len(tmin) == len(self.lat) * ndays and len(wind) == len(self.lat) * ndays
+            if gids is None:
+                assert len(prec) == len(self.lat) * ndays and len(tmax) == len(self.lat) * ndays and len(tmin) == len(self.lat) * ndays and len(wind) == len(self.lat) * ndays
+                gids, prec, tmax, tmin, wind = self.forcingArrays(prec, tmax, tmin, wind)
+            else:
+                assert all(np.shape(f) == (len(self.lat), ndays) and not np.isnan(f).any() for f in [prec, tmax, tmin, wind])
         except AssertionError:
             log.error("Missing meteorological data in database for VIC simulation. Exiting...")
             sys.exit()
-        cgid = None
-        fout = None
-        for i in range(len(prec)):
-            gid = prec[i][0]
-            if cgid is None or gid != cgid:
-                if cgid is not None:
-                    fout.close()
-                cgid = gid
-                filename = "data_{0:.{2}f}_{1:.{2}f}".format(
-                    self.gid[gid][0], self.gid[gid][1], self.grid_decimal)
-                fout = open(
-                    "{0}/forcings/{1}".format(self.model_path, filename), 'w')
-                log.info("writing " + filename)
-                fout.write("{0:f} {1:.2f} {2:.2f} {3:.1f}\n".format(
-                    prec[i][2], tmax[i][2], tmin[i][2], wind[i][2]))
-            else:
-                fout.write("{0:f} {1:.2f} {2:.2f} {3:.1f}\n".format(
-                    prec[i][2], tmax[i][2], tmin[i][2], wind[i][2]))
+        for c, gid in enumerate(gids):
+            filename = "data_{0:.{2}f}_{1:.{2}f}".format(
+                self.gid[gid][0], self.gid[gid][1], self.grid_decimal)
+            log.info("writing " + filename)
+            with open("{0}/forcings/{1}".format(self.model_path, filename), 'w') as fout:
+                fout.write("".join("{0:f} {1:.2f} {2:.2f} {3:.1f}\n".format(p, tx, tn, w)
+                                   for p, tx, tn, w in zip(prec[c], tmax[c], tmin[c], wind[c])))
 
-    def run(self, vicexec):
-        """Run VIC model."""
+    def run(self, vicexec, timeout=None):
+        """Run VIC model, killing it if it runs longer than *timeout* seconds.
+        Returns the exit code of VIC."""
         log = logging.getLogger(__name__)
         log.info("Running VIC...")
         if not os.path.exists(self.model_path + '/output'):
             os.mkdir(self.model_path + '/output')
         proc = subprocess.Popen([vicexec, "-g", "{0}/global.txt".format(self.model_path)], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, proc.kill)
+            timer.start()
         for line in iter(proc.stdout.readline, ''):
             log.debug(line.strip())
+        returncode = proc.wait()
+        if timer is not None:
+            timer.cancel()
+        return returncode
 
     def getOutputStruct(self, globalfile):
         """Creates a dictionary with output variable-file pairs."""
@@ -442,152 +479,201 @@ class VIC:
         self.skipyear = skipyear
         return out
 
-    def saveToDB(self, args, initialize=True, skipsave=0):
-        """Reads VIC output for selected variables."""
+    def readOutput(self, args):
+        """Reads VIC output for selected variables into (time, layer, row, column) arrays.
+        Drought indices are allocated but left to be calculated by :meth:`droughtOutput`.
+        Returns the arrays and the simulation dates."""
         log = logging.getLogger(__name__)
-        droughtvars = ["spi1", "spi3", "spi6", "spi12", "sri1", "sri3", "sri6", "sri12", "severity", "dryspells", "smdi", "cdi"]
-        layervars = ["soil_moist", "soil_temp", "smliqfrac", "smfrozfrac"]
         outvars = self.getOutputStruct(self.model_path + "/global.txt")
         outdata = {}
+        nrows = int(np.round((max(self.lat) - min(self.lat)) / self.res) + 1)
+        ncols = int(np.round((max(self.lon) - min(self.lon)) / self.res) + 1)
+        nt = (date(self.endyear, self.endmonth, self.endday) -
+              date(self.startyear + self.skipyear, self.startmonth, self.startday)).days + 1
+        for var in vicoutput.variableGroup(args):
+            if var in outvars or var in droughtvars:
+                if var in layervars:
+                    outdata[var] = np.zeros((nt, self.nlayers, nrows, ncols)) + self.nodata
+                else:
+                    outdata[var] = np.zeros((nt, 1, nrows, ncols)) + self.nodata
+            else:
+                log.warning("Variable {0} not found in output files. Skipping import.".format(var))
+        prefix = set([outvars[v][0] for v in outdata.keys() if v not in droughtvars])
+        startdate = "{0}-{1}-{2}".format(self.startyear, self.startmonth, self.startday)
+        enddate = "{0}-{1}-{2}".format(self.endyear, self.endmonth, self.endday)
+        dates = pandas.date_range(startdate, enddate).values
+        for c in range(len(self.lat)):
+            pdata = {}
+            for p in prefix:
+                filename = "{0}/{1}_{2:.{4}f}_{3:.{4}f}".format(self.model_path, p, self.lat[c], self.lon[c], self.grid_decimal)
+                pdata[p] = pandas.read_csv(filename, delim_whitespace=True, header=None).values
+            i = int((max(self.lat) + self.res / 2.0 - self.lat[c]) / self.res)
+            j = int((self.lon[c] - min(self.lon) + self.res / 2.0) / self.res)
+            for v in [v for v in outdata if v not in droughtvars]:
+                if v in layervars:
+                    for lyr in range(self.nlayers):
+                        outdata[v][:, lyr, i, j] = pdata[outvars[v][0]][:, outvars[v][1] + lyr]
+                else:
+                    outdata[v][:, 0, i, j] = pdata[outvars[v][0]][:, outvars[v][1]]
+            log.info("Read output for {0}|{1}".format(self.lat[c], self.lon[c]))
+        return outdata, dates
+
+    def droughtOutput(self, outdata, incremental=False, memory=None):
+        """Calculates the drought indices allocated in *outdata*, after the variables
+        they depend on have been written to the database. Indices that cannot be
+        calculated are set to None."""
+        dvars = [v for v in outdata if v in droughtvars]
+        if len(dvars) > 0:
+            for tiles in drought.chunks(self, memory):
+                for var in [v for v in dvars if outdata[v] is not None]:
+                    dout = drought.calc(var, self, incremental, tiles)
+                    if dout is not None:
+                        mi, mj = drought.pixels(self, tiles)
+                        outdata[var][:, 0, mi, mj] = dout
+                    else:
+                        outdata[var] = None
+                # only keep the climatologies of a single chunk in memory
+                drought.clearClimatology()
+        return outdata
+
+    def saveToDB(self, args, initialize=True, skipsave=0, incremental=False, memory=None):
+        """Reads VIC output for selected variables. Drought indices can be
+        updated *incremental*-ly from the previous simulation, and are calculated
+        in chunks of raster tiles that fit within *memory* megabytes if given."""
+        log = logging.getLogger(__name__)
+        outdata = {}
         if len(self.lat) > 0 and len(self.lon) > 0:
-            nrows = int(np.round((max(self.lat) - min(self.lat)) / self.res) + 1)
-            ncols = int(np.round((max(self.lon) - min(self.lon)) / self.res) + 1)
-            mask = np.zeros((nrows, ncols), dtype='bool')
-            nt = (date(self.endyear, self.endmonth, self.endday) -
-                  date(self.startyear + self.skipyear, self.startmonth, self.startday)).days + 1
             args = vicoutput.variableGroup(args)
             if len(args) > 0:
-                for var in args:
-                    if var in outvars or var in droughtvars:
-                        if var in layervars:
-                            outdata[var] = np.zeros((nt, self.nlayers, nrows, ncols)) + self.nodata
-                        else:
-                            outdata[var] = np.zeros((nt, 1, nrows, ncols)) + self.nodata
-                    else:
-                        log.warning("Variable {0} not found in output files. Skipping import.".format(var))
-                prefix = set([outvars[v][0] for v in outdata.keys() if v not in droughtvars])
-                startdate = "{0}-{1}-{2}".format(self.startyear, self.startmonth, self.startday)
-                enddate = "{0}-{1}-{2}".format(self.endyear, self.endmonth, self.endday)
-                dates = pandas.date_range(startdate, enddate).values
-                for c in range(len(self.lat)):
-                    pdata = {}
-                    for p in prefix:
-                        filename = "{0}/{1}_{2:.{4}f}_{3:.{4}f}".format(self.model_path, p, self.lat[c], self.lon[c], self.grid_decimal)
-                        pdata[p] = pandas.read_csv(filename, delim_whitespace=True, header=None).values
-                    i = int((max(self.lat) + self.res / 2.0 - self.lat[c]) / self.res)
-                    j = int((self.lon[c] - min(self.lon) + self.res / 2.0) / self.res)
-                    mask[i, j] = True
-                    for v in [v for v in outdata if v not in droughtvars]:
-                        if v in layervars:
-                            for lyr in range(self.nlayers):
-                                outdata[v][:, lyr, i, j] = pdata[outvars[v][0]][:, outvars[v][1] + lyr]
-                        else:
-                            outdata[v][:, 0, i, j] = pdata[outvars[v][0]][:, outvars[v][1]]
-                    log.info("Read output for {0}|{1}".format(self.lat[c], self.lon[c]))
-                for var in args:
-                    if var in droughtvars:
-                        dout = drought.calc(var, self)
-                        if dout is not None:
-                            mi, mj = np.where(mask)
-                            outdata[var][:, 0, mi, mj] = dout
-                        else:
-                            outdata[var] = None
-                    if outdata[var] is not None:
-                        self.writeToDB(outdata[var], dates, "{0}".format(var), initialize, skipsave=skipsave)
+                outdata, dates = self.readOutput(args)
+                for var in [v for v in args if v in outdata and v not in droughtvars]:
+                    self.writeToDB(outdata[var], dates, "{0}".format(var), initialize, skipsave=skipsave)
+                outdata = self.droughtOutput(outdata, incremental, memory)
+                for var in [v for v in args if v in outdata and v in droughtvars and outdata[v] is not None]:
+                    self.writeToDB(outdata[var], dates, "{0}".format(var), initialize, skipsave=skipsave)
         else:
             log.info("No pixels simulated, not saving any output!")
         return outdata
 
     def _writeRaster(self, data, filename):
-        """Writes GeoTIFF raster temporarily so that it can be imported into the database."""
-        nrows, ncols = data.shape
+        """Writes GeoTIFF raster temporarily so that it can be imported into the database.
+        Three-dimensional *data* are written as a multi-band raster."""
+        if data.ndim < 3:
+            data = data[np.newaxis]
+        nbands, nrows, ncols = data.shape
         driver = gdal.GetDriverByName("GTiff")
-        ods = driver.Create(filename, ncols, nrows, 1, gdal.GDT_Float32)
+        ods = driver.Create(filename, ncols, nrows, nbands, gdal.GDT_Float32)
         ods.SetGeoTransform([min(self.lon) - self.res / 2.0, self.res,
                              0, max(self.lat) + self.res / 2.0, 0, -self.res])
         srs = osr.SpatialReference()
         srs.SetWellKnownGeogCS("WGS84")
         ods.SetProjection(srs.ExportToWkt())
-        ods.GetRasterBand(1).WriteArray(data)
-        ods.GetRasterBand(1).SetNoDataValue(self.nodata)
+        for b in range(nbands):
+            ods.GetRasterBand(b + 1).WriteArray(data[b])
+            ods.GetRasterBand(b + 1).SetNoDataValue(self.nodata)
         ods = None
 
     def writeToDB(self, data, dates, tablename, initialize, ensemble=False, skipsave=0):
-        """Writes output data into database."""
+        """Writes (time, layer, row, column) output data into database, recording the
+        *ensemble* member if given. Data with a band dimension before the rows are
+        written as multi-band rasters."""
+        members = [int(ensemble)] if bool(ensemble) else None
+        self._writeToDB(data[np.newaxis], tablename, initialize, members, skipsave)
+
+    def writeEnsembleToDB(self, data, dates, tablename, initialize, members=None, skipsave=0):
+        """Writes output data of ensemble *members* (numbered from 1 if not given),
+        stacked along the first dimension of *data*, into database with a single import."""
+        if members is None:
+            members = range(1, data.shape[0] + 1)
+        self._writeToDB(data, tablename, initialize, list(members), skipsave)
+
+    def _writeToDB(self, data, tablename, initialize, members=None, skipsave=0):
+        """Imports (member, time, layer, row, column) *data* into a table, creating
+        its indexes after all rasters have been inserted if they do not exist. Data
+        with a band dimension before the rows are imported as multi-band rasters.
+        Existing rasters for the saved dates are deleted if *initialize* is set,
+        otherwise only those of the ensemble *members* being written are replaced."""
         log = logging.getLogger(__name__)
+        ensemble = members is not None
+        layered = data.shape[2] > 1
         db = dbio.connect(self.dbname)
         cur = db.cursor()
         if dbio.tableExists(self.dbname, self.name, tablename) and ensemble and not dbio.columnExists(self.dbname, self.name, tablename, "ensemble"):
             log.warning("Table {0} exists but does not contain ensemble information. Overwriting entire table!".format(tablename))
-            cur.execute("drop table {0}.{1}".format(self.name, tablename))
+            cur.execute("drop table {0}.{1} cascade".format(self.name, tablename))
             db.commit()
+        t0 = date(self.startyear, self.startmonth, self.startday)
+        if skipsave > 0:
+            t0 += timedelta(skipsave)
+            data = data[:, skipsave:]
+        t1 = t0 + timedelta(data.shape[1] - 1)
         if dbio.tableExists(self.dbname, self.name, tablename):
             if initialize:
-                for dt in [self.startdate + timedelta(t) for t in range((self.enddate - self.startdate).days+1)]:
-                    dbio.deleteRasters(self.dbname, "{0}.{1}".format(self.name, tablename), dt)
+                dbio.deleteRasterRange(self.dbname, "{0}.{1}".format(self.name, tablename), t0, t1)
+            elif ensemble:
+                # members replace their own rasters for the saved dates
+                dbio.deleteRasterRange(self.dbname, "{0}.{1}".format(self.name, tablename), t0, t1,
+                                       "and ensemble in ({0})".format(",".join(str(e) for e in members)))
         else:
             sql = "create table {0}.{1} (id serial not null primary key, rid int not null, fdate date not null, rast raster)".format(
                 self.name, tablename)
             cur.execute(sql)
-            if data.shape[1] > 1:
+            if layered:
                 cur.execute("alter table {0}.{1} add column layer int".format(self.name, tablename))
             if ensemble:
                 cur.execute("alter table {0}.{1} add column ensemble int".format(self.name, tablename))
             db.commit()
-        startyear, startmonth, startday = self.startyear, self.startmonth, self.startday
-        if skipsave > 0:
-            ts = date(self.startyear, self.startmonth,
-                      self.startday) + timedelta(skipsave)
-            data = data[skipsave:]
-            startyear, startmonth, startday = ts.year, ts.month, ts.day
+            dbio.partitionTable(self.dbname, self.name, tablename)
         tiffiles = []
-        for t in range(data.shape[0]):
-            dt = date(startyear, startmonth, startday) + timedelta(t)
-            for lyr in range(data.shape[1]):
-                filename = "{0}/{1}_{2}{3:02d}{4:02d}_{5:02d}.tif".format(
-                    self.model_path, tablename, dt.year, dt.month, dt.day, lyr + 1)
-                self._writeRaster(data[t, lyr, :, :], filename)
-                tiffiles.append(filename)
+        for m in range(data.shape[0]):
+            for t in range(data.shape[1]):
+                dt = t0 + timedelta(t)
+                for lyr in range(data.shape[2]):
+                    filename = "{0}/{1}_{2}{3:02d}{4:02d}_{5:02d}".format(
+                        self.model_path, tablename, dt.year, dt.month, dt.day, lyr + 1)
+                    if ensemble:
+                        filename += "_{0}".format(members[m])
+                    self._writeRaster(data[m, t, lyr], filename + ".tif")
+                    tiffiles.append(filename + ".tif")
         cmd = " ".join(["{0}/raster2pgsql".format(rpath.bins), "-s", "4326", "-F", "-d", "-t", "auto"] + tiffiles + ["temp", "|", "{0}/psql".format(rpath.bins), "-d", self.dbname])
         proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
         sout, err = proc.communicate()
         log.debug(sout)
+        columns = ["fdate"]
         cur.execute("alter table temp add column fdate date")
         cur.execute("update temp set fdate = date (concat_ws('-',substring(filename from {0} for 4),substring(filename from {1} for 2),substring(filename from {2} for 2)))".format(
             len(tablename) + 2, len(tablename) + 6, len(tablename) + 8))
-        if data.shape[1] > 1:
+        if layered:
+            columns.append("layer")
             cur.execute("alter table temp add column layer int")
             cur.execute("update temp set layer=(substring(filename from {0} for 2))::int".format(
                 len(tablename) + 11))
+        if ensemble:
+            columns.append("ensemble")
+            cur.execute("alter table temp add column ensemble int")
+            cur.execute("update temp set ensemble=(substring(filename from {0} for char_length(filename)-{1}))::int".format(
+                len(tablename) + 14, len(tablename) + 17))
         cur.execute("select count(*) from temp")
         n = int(cur.fetchone()[0])
-        ntiles = n / data.shape[0]
-        if data.shape[1] > 1:
-            cur.execute(
-                "insert into {0}.{1} (rid,fdate,layer,rast) select ((rid+{2}) % {2})+1,fdate,layer,rast from temp".format(self.name, tablename, ntiles))
+        ntiles = n // (data.shape[0] * data.shape[1])
+        if dbio.isPartitioned(self.dbname, self.name, tablename):
+            # insert the rasters of each year directly into its partition
+            targets = [(dbio.partition(self.dbname, self.name, tablename, year), "where fdate>=date'{0}-1-1' and fdate<date'{1}-1-1'".format(year, year + 1))
+                       for year in range(t0.year, t1.year + 1)]
         else:
-            cur.execute(
-                "insert into {0}.{1} (rid,fdate,rast) select ((rid+{2}) % {2})+1,fdate,rast from temp".format(self.name, tablename, ntiles))
-        if bool(ensemble):
-            sql = "update {0}.{1} set ensemble = {2} where ensemble is null".format(
-                self.name, tablename, int(ensemble))
-            cur.execute(sql)
-        cur.execute("drop index if exists {0}.{1}_dtidx".format(
-            self.name, tablename))
-        cur.execute("create index {1}_dtidx on {0}.{1}(fdate)".format(
-            self.name, tablename))
-        cur.execute("drop index if exists {0}.{1}_spidx".format(
-            self.name, tablename))
-        cur.execute("create index {1}_spidx on {0}.{1} using gist(st_convexhull(rast))".format(
-            self.name, tablename))
+            targets = [("{0}.{1}".format(self.name, tablename), "")]
+        for target, where in targets:
+            cur.execute("insert into {0} (rid,{2},rast) select ((rid+{1}) % {1})+1,{2},rast from temp {3}".format(
+                target, ntiles, ",".join(columns), where))
         db.commit()
         cur.close()
         db.close()
+        dbio.indexRasterTable(self.dbname, self.name, tablename)
 
-    def save(self, saveto, args, initialize=True, skipsave=0):
+    def save(self, saveto, args, initialize=True, skipsave=0, incremental=False, memory=None):
         """Reads and saves selected output data variables into the database or a user-defined directory."""
         if saveto == "db":
-            self.saveToDB(args, initialize=initialize, skipsave=skipsave)
+            self.saveToDB(args, initialize=initialize, skipsave=skipsave, incremental=incremental, memory=memory)
         else:
             if initialize:
                 if os.path.isdir(saveto):